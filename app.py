@@ -1,22 +1,57 @@
-from typing import List, Optional, Dict, Union
+from typing import Any, Awaitable, Callable, List, Optional, Dict, Tuple, Union
 from pydantic import BaseModel, validator, ValidationError
 import asyncio
+import base64
+import binascii
+import bisect
 import uvicorn
 import os
-from dotenv import load_dotenv
+from dotenv import dotenv_values, find_dotenv, load_dotenv
 import sys
 import logging
-import itertools
 import json
+import time
+import contextlib
+import math
+import mimetypes
+import multiprocessing
+import signal
+import hashlib
+import random
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import uuid
+from collections import deque, OrderedDict
+import httpx
 from httpx import AsyncClient
 from fastapi import FastAPI, HTTPException, Depends, APIRouter, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import StreamingResponse, JSONResponse
-from fastapi_poe.types import ProtocolMessage
-from fastapi_poe.client import get_bot_response, get_final_response, QueryRequest, BotError
+from fastapi.responses import StreamingResponse, JSONResponse, Response
+from starlette.background import BackgroundTask
+from fastapi_poe.types import Attachment, ProtocolMessage
+try:
+    import orjson
+except ImportError:  # orjson 为可选依赖，未安装时使用标准库
+    orjson = None
+try:
+    import h2
+except ImportError:  # h2 为可选依赖，未安装时不能启用 HTTP/2
+    h2 = None
+try:
+    import tiktoken
+except ImportError:  # tiktoken 为可选依赖，未安装时使用启发式分词估算
+    tiktoken = None
+from fastapi_poe.client import (get_bot_response, get_final_response, upload_file, QueryRequest, BotError,
+                                BotErrorNoRetry)
 
 # 加载环境变量
-load_dotenv()
+ENV_FILE = find_dotenv()  # 热重载时重新读取的 .env 文件，找不到时为空字符串
+PROCESS_ENV_NAMES = set(os.environ)  # 进程启动时已有的环境变量，优先于 .env，热重载时同样不覆盖
+load_dotenv(ENV_FILE)
+DOTENV_NAMES = set(os.environ) - PROCESS_ENV_NAMES  # 上一次从 .env 读取的变量，从 .env 删除后热重载时一并移除
 
 app = FastAPI()
 security = HTTPBearer()
@@ -27,6 +62,9 @@ PORT = int(os.getenv("PORT", 3700))
 TIMEOUT = int(os.getenv("TIMEOUT", 120))
 PROXY = os.getenv("PROXY", "")
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()  # 新增：日志级别配置，默认为 INFO
+POE_BASE_URL = os.getenv("POE_BASE_URL", "https://api.poe.com/bot/").rstrip("/") + "/"  # Poe 机器人接口地址，可指向本地模拟服务
+WORKERS = max(1, int(os.getenv("WORKERS", 1)))  # 工作进程数，大于 1 时启用多进程模式
+SHARED_SPARE_ROWS = 64  # 多进程模式下为热重载新增的密钥与访问令牌各预留的共享表行数
 
 # 解析JSON数组格式的环境变量
 def parse_json_env(env_name, default=None):
@@ -46,8 +84,12 @@ def parse_json_env(env_name, default=None):
     return default or []
 
 ACCESS_TOKENS = set(parse_json_env("ACCESS_TOKENS"))
+# 按令牌覆盖限流参数与排队权重，例如 {"sk-team-a": {"rate": 5, "burst": 10, "concurrency": 20, "weight": 3}}
+TOKEN_LIMITS = parse_json_env("TOKEN_LIMITS") or {}
 BOT_NAMES = parse_json_env("BOT_NAMES")
+VIRTUAL_MODELS = parse_json_env("VIRTUAL_MODELS") or {}  # 虚拟模型名 -> 实际机器人列表（按顺序）或 {机器人: 权重}
 POE_API_KEYS = parse_json_env("POE_API_KEYS")
+ADMIN_TOKENS = set(parse_json_env("ADMIN_TOKENS"))  # 管理接口 /admin/* 的访问令牌，为空时关闭管理接口
 
 # 设置日志
 logging.basicConfig(
@@ -56,222 +98,3141 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# 初始化代理
-proxy = None
-if not PROXY:
-    proxy = AsyncClient(timeout=TIMEOUT)
-else:
-    proxy = AsyncClient(proxy=PROXY, timeout=TIMEOUT)
+# 上游 HTTP 连接池配置（客户端在监控指标定义之后创建）
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 100))  # 连接池最大连接数
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", 20))  # 保持空闲的长连接数
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 30))  # 空闲长连接的保留时间（秒）
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 10))  # 建立连接（含 TLS 握手）的超时时间（秒）
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", TIMEOUT))  # 两次读取之间的最长间隔（秒）
+HTTP_POOL_TIMEOUT = float(os.getenv("HTTP_POOL_TIMEOUT", 30))  # 等待连接池空闲连接的超时时间（秒）
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "false").lower() == "true"  # 对 Poe 使用 HTTP/2 多路复用，需要安装 h2
+HTTP_PREWARM_CONNECTIONS = int(os.getenv("HTTP_PREWARM_CONNECTIONS", 4))  # 启动时预先建立的连接数，0 表示不预热
 
-# 初始化客户端字典和API密钥循环
-client_dict = {}
-api_key_cycle = None
+# 密钥池配置
+KEY_MAX_CONCURRENCY = int(os.getenv("KEY_MAX_CONCURRENCY", 0))  # 单个密钥最大并发数，0 表示不限制
+KEY_QUEUE_TIMEOUT = float(os.getenv("KEY_QUEUE_TIMEOUT", TIMEOUT))  # 所有密钥饱和时请求排队的最长等待时间（秒）
+KEY_RATE_LIMIT_COOLDOWN = float(os.getenv("KEY_RATE_LIMIT_COOLDOWN", 10))  # 密钥遇到限流/额度错误后暂避的时间（秒）
+CIRCUIT_BREAKER_THRESHOLD = int(os.getenv("CIRCUIT_BREAKER_THRESHOLD", 3))  # 连续失败多少次后熔断该密钥
+CIRCUIT_BREAKER_COOLDOWN = float(os.getenv("CIRCUIT_BREAKER_COOLDOWN", 30))  # 熔断持续时间（秒），之后放行一次试探请求
 
-bot_names_map = {name.lower(): name for name in BOT_NAMES}
+# 密钥验证配置
+KEY_VALIDATION_CONCURRENCY = int(os.getenv("KEY_VALIDATION_CONCURRENCY", 8))  # 启动时并发验证密钥的数量
+KEY_VALIDATION_TIMEOUT = float(os.getenv("KEY_VALIDATION_TIMEOUT", 30))  # 单个密钥验证的超时时间（秒）
+LAZY_KEY_VALIDATION = os.getenv("LAZY_KEY_VALIDATION", "false").lower() == "true"  # 首个密钥验证通过即开始服务
+KEY_REVALIDATE_INTERVAL = float(os.getenv("KEY_REVALIDATE_INTERVAL", 0))  # 定期重新验证密钥的间隔（秒），0 表示关闭
+KEY_REVALIDATE_FAILURES = int(os.getenv("KEY_REVALIDATE_FAILURES", 2))  # 连续验证失败多少次后移出密钥
+CONFIG_WATCH_INTERVAL = float(os.getenv("CONFIG_WATCH_INTERVAL", 0))  # 检查 .env 是否变化并热重载的间隔（秒），0 表示关闭
 
+# 失败重试配置
+MAX_RETRIES = int(os.getenv("MAX_RETRIES", 2))  # 首字节前失败时换密钥重试的最大次数
+RETRY_BACKOFF_BASE = float(os.getenv("RETRY_BACKOFF_BASE", 0.5))  # 退避基数（秒），按指数增长并加入随机抖动
+RETRY_BACKOFF_MAX = float(os.getenv("RETRY_BACKOFF_MAX", 4))  # 单次退避上限（秒）
 
-class Message(BaseModel):
-    role: str
-    content: Union[str, List[Dict[str, str]], Dict[str, str]] = ""
-    name: Optional[str] = None
-    function_call: Optional[Dict] = None
-    tool_calls: Optional[List[Dict]] = None
-    tool_call_id: Optional[str] = None
+# 响应缓存配置
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 3600))  # 缓存有效期（秒）
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 1000))  # 内存缓存最大条数
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024))  # 内存缓存最大字节数
+RESPONSE_CACHE_SQLITE_PATH = os.getenv("RESPONSE_CACHE_SQLITE_PATH", "")  # SQLite 持久化文件路径，留空表示仅使用内存
+RESPONSE_CACHE_MAX_TEMPERATURE = float(os.getenv("RESPONSE_CACHE_MAX_TEMPERATURE", 0))  # 温度高于该值的请求不缓存
+RESPONSE_CACHE_REPLAY_CHUNK_SIZE = 256  # 流式回放缓存时每个分块的字符数
+
+# 客户端断开与输出限制配置
+DISCONNECT_POLL_INTERVAL = float(os.getenv("DISCONNECT_POLL_INTERVAL", 0.5))  # 检测客户端断开的轮询间隔（秒）
+ENFORCE_OUTPUT_LIMITS = os.getenv("ENFORCE_OUTPUT_LIMITS", "true").lower() == "true"  # 在代理端执行 max_tokens 与 stop
+
+# SSE 分块合并配置：在时间窗口内合并上游的细碎增量，减少下游写入次数（首个增量总是立即发送）
+SSE_FLUSH_INTERVAL_MS = float(os.getenv("SSE_FLUSH_INTERVAL_MS", 0))  # 合并窗口（毫秒），0 表示不合并
+SSE_FLUSH_MAX_BYTES = int(os.getenv("SSE_FLUSH_MAX_BYTES", 4096))  # 缓冲达到该长度时立即发送
+SSE_FLUSH_INTERVAL_MAX_MS = 1000  # 请求头 X-SSE-Flush-Interval 允许的最大值
+
+# 请求合并配置：完全相同的并发请求共享一次上游调用
+REQUEST_COALESCING_ENABLED = os.getenv("REQUEST_COALESCING_ENABLED", "false").lower() == "true"
+REQUEST_COALESCING_MAX_TEMPERATURE = float(os.getenv("REQUEST_COALESCING_MAX_TEMPERATURE", 2))  # 温度高于该值的请求不合并
+
+# n > 1 与批量补全配置
+MAX_CHOICES = int(os.getenv("MAX_CHOICES", 8))  # 单个请求 n 的上限，每个 choice 占用一个密钥并发调用
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 8))  # 每个批量请求同时执行的补全数
+BATCH_MAX_RETRIES = int(os.getenv("BATCH_MAX_RETRIES", 2))  # 单行在换密钥重试之外整体重试的次数
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", 50000))  # 单个批量请求最多包含的行数
+
+# 访问令牌限流配置：按 ACCESS_TOKENS 中的每个令牌分别计算
+TOKEN_RATE_LIMIT = float(os.getenv("TOKEN_RATE_LIMIT", 0))  # 每个令牌每秒允许的请求数，0 表示不限制
+TOKEN_RATE_BURST = float(os.getenv("TOKEN_RATE_BURST", 0))  # 令牌桶容量（允许的突发请求数），0 表示取 max(1, TOKEN_RATE_LIMIT)
+TOKEN_MAX_CONCURRENCY = int(os.getenv("TOKEN_MAX_CONCURRENCY", 0))  # 每个令牌同时进行的请求数上限，0 表示不限制
+TOKEN_CONCURRENCY_RETRY_AFTER = 1  # 并发超限时建议客户端重试的等待时间（秒）
+
+# 对冲请求配置：首字迟迟未到时在另一个密钥上并行发起第二次调用，仅用于流式请求
+HEDGE_MODELS = parse_json_env("HEDGE_MODELS")  # 默认启用对冲的模型，请求头 X-Hedge: true/false 可逐个请求覆盖
+HEDGE_DELAY_MS = float(os.getenv("HEDGE_DELAY_MS", 0))  # 发起对冲前等待首字的时间（毫秒），0 表示取该模型近期首字延迟的 p95
+HEDGE_BUDGET_PERCENT = float(os.getenv("HEDGE_BUDGET_PERCENT", 5))  # 对冲调用占可对冲请求的比例上限（%）
+HEDGE_DEFAULT_DELAY = 2.0  # 首字延迟样本不足时使用的对冲阈值（秒）
+HEDGE_MIN_DELAY = 0.05  # 自适应阈值的下限（秒）
+HEDGE_MIN_SAMPLES = 20  # 计算 p95 所需的最少样本数
+HEDGE_WINDOW = 200  # 每个模型保留的首字延迟样本数
+HEDGE_BURST = 5  # 对冲预算最多累积的次数，避免长时间空闲后集中对冲
+
+SHARED_STATE_POLL_INTERVAL = 0.05  # 多进程模式下排队请求检查其他进程释放名额的间隔（秒）
+
+KEY_EWMA_ALPHA = 0.2  # 延迟与错误率的指数加权系数
+KEY_DEFAULT_LATENCY = 1.0  # 机器人尚无延迟样本时的默认估计值（秒）
+KEY_ERROR_PENALTY = 4.0  # 错误率对调度得分的惩罚倍数
+
+# 用量统计的分词配置
+TOKENIZER = os.getenv("TOKENIZER", "auto").lower()  # auto（有 tiktoken 时使用）/ tiktoken / heuristic / whitespace
+TIKTOKEN_ENCODING = os.getenv("TIKTOKEN_ENCODING", "o200k_base")  # tiktoken 使用的编码
+TOKENIZE_THREAD_THRESHOLD = int(os.getenv("TOKENIZE_THREAD_THRESHOLD", 65536))  # 待分词文本超过该字符数时在线程池中计算
+PROMPT_TOKEN_CACHE_SIZE = int(os.getenv("PROMPT_TOKEN_CACHE_SIZE", 4096))  # 按内容哈希缓存的消息 token 数条目上限
+PROMPT_TOKEN_CACHE_MIN_CHARS = 256  # 短于该长度的消息直接计数，不值得计算哈希
+PROTOCOL_MESSAGE_CACHE_SIZE = int(os.getenv("PROTOCOL_MESSAGE_CACHE_SIZE", 4096))  # 复用的 ProtocolMessage 条目上限，0 表示关闭
+PROTOCOL_MESSAGE_CACHE_MAX_CHARS = 32 * 1024 * 1024  # 复用的 ProtocolMessage 内容总字符数上限
+TOKEN_CARRY_MAX = 64  # 流式计数时暂缓结算的尾部最大长度（字符）
+
+# 上下文压缩配置：提示词超过模型的上下文预算时，在转发给 Poe 之前裁剪历史消息
+CONTEXT_BUDGETS = {str(model).lower(): int(budget) for model, budget in
+                   (parse_json_env("CONTEXT_BUDGETS") or {}).items()}  # 模型名 -> 提示词 token 上限，"*" 为默认值
+CONTEXT_COMPACTION = [item.strip() for item in os.getenv(
+    "CONTEXT_COMPACTION", "truncate_tools,drop_oldest").split(",") if item.strip()]  # 按顺序执行的压缩策略
+CONTEXT_TOOL_OUTPUT_MAX_TOKENS = int(os.getenv("CONTEXT_TOOL_OUTPUT_MAX_TOKENS", 2000))  # 截断后工具输出保留的 token 数
+CONTEXT_STRATEGIES = ("truncate_tools", "drop_oldest")
+
+# 图片与文件附件配置：image_url / file 内容块上传到 Poe 后作为消息附件转发，按内容哈希复用上传结果
+ATTACHMENTS_ENABLED = os.getenv("ATTACHMENTS_ENABLED", "true").lower() == "true"  # 关闭时与之前一样只转发文本
+POE_UPLOAD_URL = os.getenv("POE_UPLOAD_URL", "https://www.quora.com/poe_api/")  # Poe 文件上传接口地址
+ATTACHMENT_MAX_BYTES = int(os.getenv("ATTACHMENT_MAX_BYTES", 20 * 1024 * 1024))  # 单个内联附件（data URL）的大小上限
+ATTACHMENT_CACHE_TTL = float(os.getenv("ATTACHMENT_CACHE_TTL", 6 * 3600))  # 上传结果的复用时间（秒）
+ATTACHMENT_CACHE_SIZE = int(os.getenv("ATTACHMENT_CACHE_SIZE", 2048))  # 上传结果缓存的条目上限
+ATTACHMENT_UPLOAD_CONCURRENCY = int(os.getenv("ATTACHMENT_UPLOAD_CONCURRENCY", 4))  # 同时进行的上传数
+ATTACHMENT_THREAD_THRESHOLD = 256 * 1024  # 超过该长度的内联附件在线程池中计算哈希与解码
+
+# 结构化请求日志配置：每个请求结束时写入一行 JSON，由后台任务批量落盘
+REQUEST_LOG_PATH = os.getenv("REQUEST_LOG_PATH", "")  # JSONL 文件路径，留空表示关闭
+REQUEST_LOG_MAX_BYTES = int(os.getenv("REQUEST_LOG_MAX_BYTES", 50 * 1024 * 1024))  # 文件超过该大小时轮转，0 表示不轮转
+REQUEST_LOG_BACKUPS = int(os.getenv("REQUEST_LOG_BACKUPS", 5))  # 轮转保留的历史文件数
+REQUEST_LOG_FLUSH_INTERVAL = float(os.getenv("REQUEST_LOG_FLUSH_INTERVAL", 1))  # 批量写入的间隔（秒）
+REQUEST_LOG_QUEUE_SIZE = 10000  # 等待写入的记录上限，磁盘跟不上时丢弃新记录而不是占用更多内存
+
+# 监控指标配置
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"  # 是否开放 /metrics 接口
+METRICS_REQUIRE_AUTH = os.getenv("METRICS_REQUIRE_AUTH", "false").lower() == "true"  # /metrics 是否要求 ACCESS_TOKENS 鉴权
+METRICS_SNAPSHOT_INTERVAL = 1.0  # 多进程模式下各工作进程写入指标快照的间隔（秒）
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+QUEUE_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+CHUNK_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+TOKEN_BUCKETS = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 50000, 100000)
+
+
+def escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra: str = "") -> str:
+    parts = [f'{name}="{escape_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    """单调递增计数器，标签值按固定顺序的元组传入"""
+
+    __slots__ = ("name", "help", "labelnames", "values")
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[tuple, float] = {}
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self, values: Optional[Dict[tuple, float]] = None) -> List[str]:
+        values = self.values if values is None else values
+        return [f"{self.name}{format_labels(self.labelnames, labels)} {value}"
+                for labels, value in values.items()]
+
+
+class Histogram:
+    """固定分桶的直方图；观测时只记录落入的桶，导出时再累加为 Prometheus 的累计分桶"""
+
+    __slots__ = ("name", "help", "labelnames", "buckets", "series")
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 每个标签组合对应 [各分桶计数..., +Inf 计数, 总和]
+        self.series: Dict[tuple, list] = {}
+
+    def observe(self, labels: tuple, value: float):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self, series_by_labels: Optional[Dict[tuple, list]] = None) -> List[str]:
+        lines = []
+        bounds = [f'le="{bound}"' for bound in self.buckets] + ['le="+Inf"']
+        series_by_labels = self.series if series_by_labels is None else series_by_labels
+        for labels, series in series_by_labels.items():
+            cumulative = 0
+            for bound, count in zip(bounds, series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, labels, bound)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {series[-1]}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class CallbackMetric:
+    """抓取时才计算取值的指标，用于密钥池状态等已有数据，请求路径上没有任何开销"""
+
+    __slots__ = ("name", "help", "labelnames", "type", "collect")
+
+    def __init__(self, name: str, help: str, labelnames, type: str, collect):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.type = type
+        self.collect = collect
+
+    def render(self, values: Optional[Dict[tuple, float]] = None) -> List[str]:
+        items = self.collect() if values is None else values.items()
+        return [f"{self.name}{format_labels(self.labelnames, labels)} {value}" for labels, value in items]
+
+
+class MetricsRegistry:
+    """进程内的最小 Prometheus 指标注册表，以文本格式导出
+
+    多进程模式下各工作进程把计数器与直方图的快照写入共享目录（按进程号命名，已退出进程的快照保留），
+    应答抓取的进程先写入自己的最新快照再汇总全部快照，保证计数器不会因请求落到不同进程而回退；
+    仪表盘类指标取自应答的进程，其中密钥池状态本身位于共享内存，各进程一致"""
+
+    def __init__(self):
+        self.metrics = []
+        self.directory = ""
+
+    def counter(self, name: str, help: str, labelnames=()) -> Counter:
+        metric = Counter(name, help, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labelnames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def callback(self, name: str, help: str, labelnames=(), type: str = "gauge"):
+        """装饰器：注册一个返回 (标签值元组, 取值) 序列的函数"""
+        def register(collect):
+            self.metrics.append(CallbackMetric(name, help, labelnames, type, collect))
+            return collect
+        return register
+
+    def share(self, directory: str):
+        self.directory = directory
+
+    def snapshot(self) -> Dict[str, list]:
+        """本进程的计数器与直方图取值，标签元组转为列表以便序列化"""
+        data = {}
+        for metric in self.metrics:
+            if metric.type not in ("counter", "histogram"):
+                continue
+            try:
+                if isinstance(metric, Histogram):
+                    data[metric.name] = [[list(labels), list(series)] for labels, series in metric.series.items()]
+                elif isinstance(metric, Counter):
+                    data[metric.name] = [[list(labels), value] for labels, value in metric.values.items()]
+                else:
+                    data[metric.name] = [[list(labels), value] for labels, value in metric.collect()]
+            except Exception as e:
+                logger.warning(f"Failed to collect metric {metric.name}: {str(e)}")
+        return data
+
+    def write_snapshot(self):
+        path = os.path.join(self.directory, f"metrics.{os.getpid()}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.snapshot(), f)
+        # 原子替换，汇总时不会读到写了一半的文件
+        os.replace(path + ".tmp", path)
+
+    def aggregate(self) -> Dict[str, Dict[tuple, Any]]:
+        """汇总共享目录中所有进程的快照：计数器按标签相加，直方图逐个分桶相加"""
+        self.write_snapshot()
+        totals: Dict[str, Dict[tuple, Any]] = {}
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for metric_name, entries in data.items():
+                merged = totals.setdefault(metric_name, {})
+                for labels, value in entries:
+                    labels = tuple(labels)
+                    current = merged.get(labels)
+                    if current is None:
+                        merged[labels] = value
+                    elif isinstance(value, list):
+                        merged[labels] = [a + b for a, b in zip(current, value)]
+                    else:
+                        merged[labels] = current + value
+        return totals
+
+    def render(self) -> str:
+        totals = None
+        if self.directory:
+            try:
+                totals = self.aggregate()
+            except OSError as e:
+                logger.warning(f"Failed to aggregate worker metrics, reporting this worker only: {str(e)}")
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            try:
+                if totals is not None and metric.type in ("counter", "histogram"):
+                    lines.extend(metric.render(totals.get(metric.name, {})))
+                else:
+                    lines.extend(metric.render())
+            except Exception as e:
+                logger.warning(f"Failed to collect metric {metric.name}: {str(e)}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+# 标签只使用 BOT_NAMES 中的模型名与密钥指纹，保证时间序列数量有界
+REQUESTS_TOTAL = metrics.counter(
+    "poe_requests_total", "Chat completion requests by model, mode and outcome", ("model", "stream", "status"))
+REQUEST_TTFT = metrics.histogram(
+    "poe_request_ttft_seconds", "Time from request arrival to the first streamed chunk", ("model",))
+REQUEST_DURATION = metrics.histogram(
+    "poe_request_duration_seconds", "Total time spent serving a request", ("model", "stream"))
+RESPONSE_CHUNKS = metrics.histogram(
+    "poe_response_chunks", "SSE content chunks sent per streamed request", ("model",), CHUNK_BUCKETS)
+PROMPT_TOKENS = metrics.histogram(
+    "poe_prompt_tokens", "Prompt tokens per request", ("model",), TOKEN_BUCKETS)
+COMPLETION_TOKENS = metrics.histogram(
+    "poe_completion_tokens", "Completion tokens per request", ("model",), TOKEN_BUCKETS)
+UPSTREAM_TTFT = metrics.histogram(
+    "poe_upstream_ttft_seconds", "Time from starting an upstream call to its first delta", ("model", "key"))
+UPSTREAM_DURATION = metrics.histogram(
+    "poe_upstream_duration_seconds", "Duration of upstream Poe calls", ("model", "key"))
+UPSTREAM_ERRORS = metrics.counter(
+    "poe_upstream_errors_total", "Failed upstream Poe calls by error type", ("model", "key", "type"))
+KEY_QUEUE_WAIT = metrics.histogram(
+    "poe_key_queue_wait_seconds", "Time spent waiting for a free API key", ("model",), QUEUE_WAIT_BUCKETS)
+KEY_POOL_EXHAUSTED = metrics.counter(
+    "poe_key_pool_exhausted_total", "Requests rejected because every API key stayed saturated", ("model",))
+RATE_LIMITED = metrics.counter(
+    "poe_rate_limited_total", "Requests rejected by per-access-token limits", ("reason",))
+HEDGES_FIRED = metrics.counter(
+    "poe_hedges_fired_total", "Hedged upstream calls started because the first token was late", ("model",))
+HEDGES_WON = metrics.counter(
+    "poe_hedges_won_total", "Hedged upstream calls that produced the first token before the original", ("model",))
+HEDGES_SKIPPED = metrics.counter(
+    "poe_hedges_skipped_total", "Hedges not started because of the budget or no free key", ("model", "reason"))
+VIRTUAL_MODEL_ROUTED = metrics.counter(
+    "poe_virtual_model_routed_total", "Requests for virtual models by the real bot that served them", ("model", "bot"))
+CONTEXT_COMPACTIONS = metrics.counter(
+    "poe_context_compactions_total", "Requests whose prompt was compacted to fit the context budget", ("model",))
+CONTEXT_BYTES_SAVED = metrics.counter(
+    "poe_context_bytes_saved_total", "Prompt bytes removed by context compaction", ("model", "strategy"))
+ATTACHMENTS = metrics.counter(
+    "poe_attachments_total", "Image and file attachments by whether an upload was needed", ("result",))
+REQUEST_LOG_DROPPED = metrics.counter(
+    "poe_request_log_dropped_total", "Request log records dropped because the write queue was full")
+CONFIG_RELOADS = metrics.counter(
+    "poe_config_reloads_total", "Runtime reloads of keys and models by trigger and outcome", ("source", "result"))
+
+
+def classify_error(error: BaseException) -> str:
+    """把上游异常归为有限的几类，避免错误信息进入指标标签"""
+    if is_local_pool_error(error):
+        return "pool_timeout"
+    if isinstance(error, asyncio.TimeoutError):
+        return "timeout"
+    if is_rate_limit_error(error):
+        return "rate_limit"
+    if isinstance(error, BotErrorNoRetry):
+        return "bot_error_no_retry"
+    if isinstance(error, BotError):
+        return "bot_error"
+    if isinstance(error, httpx.TimeoutException):
+        return "timeout"
+    if isinstance(error, httpx.HTTPError):
+        return "http_error"
+    return "other"
+
+
+class RequestLog:
+    """结构化请求日志：请求结束时只把记录追加到内存队列，由后台任务按批在线程中序列化并写入 JSONL 文件，
+    事件循环不会阻塞在磁盘 I/O 上；文件超过 max_bytes 时轮转为 path.1、path.2 ..."""
+
+    def __init__(self, path: str, max_bytes: int, backups: int, flush_interval: float):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.pending: deque = deque()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
 
     @property
-    def is_valid_role(self) -> bool:
-        return self.role in ["system", "user", "assistant", "function", "tool"]
+    def enabled(self) -> bool:
+        return bool(self.path)
 
-    def get_content_text(self) -> str:
-        """获取消息内容的文本表示"""
-        if isinstance(self.content, str):
-            return self.content
-        elif isinstance(self.content, list):
-            # 处理列表格式的内容，例如 [{"type": "text", "text": "some content"}]
-            return " ".join(item.get("text", "") for item in self.content if item.get("type") == "text")
-        elif isinstance(self.content, dict):
-            # 处理字典格式的内容
-            return self.content.get("text", "")
-        return ""
+    def record(self, entry: Dict):
+        if len(self.pending) >= REQUEST_LOG_QUEUE_SIZE:
+            REQUEST_LOG_DROPPED.inc()
+            return
+        self.pending.append(entry)
+        if self._task is None and not self._closing:
+            self._task = spawn_background(self._run())
 
-    class Config:
-        json_schema_extra = {
-            "example": {
-                "role": "user",
-                "content": "Hello!"
-            }
+    async def _run(self):
+        while not self._closing:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        if self.pending:
+            batch = list(self.pending)
+            self.pending.clear()
+            await asyncio.to_thread(self._write, batch)
+
+    async def close(self):
+        """停止后台任务并写入剩余记录"""
+        self._closing = True
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def _rotate(self):
+        if self.backups <= 0:
+            os.remove(self.path)
+            return
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    def _write(self, batch: List[Dict]):
+        # 在线程中执行，只由后台任务或 close 串行调用
+        data = b"".join(dumps_json(entry) + b"\n" for entry in batch)
+        try:
+            if self.max_bytes > 0 and os.path.exists(self.path):
+                size = os.path.getsize(self.path)
+                if size and size + len(data) > self.max_bytes:
+                    self._rotate()
+            with open(self.path, "ab") as f:
+                f.write(data)
+        except OSError as e:
+            logger.warning(f"Failed to write {len(batch)} records to request log {self.path}: {str(e)}")
+
+
+request_log = RequestLog(REQUEST_LOG_PATH, REQUEST_LOG_MAX_BYTES, REQUEST_LOG_BACKUPS, REQUEST_LOG_FLUSH_INTERVAL)
+
+
+def observe_request(model: str, stream: bool, status: str, started: float, first_chunk_at: Optional[float] = None,
+                    chunks: Optional[int] = None, usage: Optional[Dict[str, int]] = None,
+                    details: Optional[Dict] = None):
+    """记录一次请求的结果与耗时；details 为请求日志的附加字段（见 request_details），为 None 时不写请求日志"""
+    now = time.monotonic()
+    stream_label = "true" if stream else "false"
+    REQUESTS_TOTAL.inc((model, stream_label, status))
+    REQUEST_DURATION.observe((model, stream_label), now - started)
+    if first_chunk_at is not None:
+        REQUEST_TTFT.observe((model,), first_chunk_at - started)
+    if chunks is not None:
+        RESPONSE_CHUNKS.observe((model,), chunks)
+    if usage is not None:
+        PROMPT_TOKENS.observe((model,), usage["prompt_tokens"])
+        COMPLETION_TOKENS.observe((model,), usage["completion_tokens"])
+    if details is not None:
+        entry = {
+            "time": round(time.time(), 3),
+            **details,
+            "model": model,
+            "stream": stream,
+            "status": status,
+            "ttft_ms": round((first_chunk_at - started) * 1000, 1) if first_chunk_at is not None else None,
+            "duration_ms": round((now - started) * 1000, 1),
+            "prompt_tokens": usage["prompt_tokens"] if usage is not None else None,
+            "completion_tokens": usage["completion_tokens"] if usage is not None else None,
         }
+        if chunks is not None:
+            entry["chunks"] = chunks
+        request_log.record(entry)
 
-class CompletionRequest(BaseModel):
-    model: str
-    messages: List[Message]
-    stream: Optional[bool] = False
-    temperature: Optional[float] = 0.7
-    top_p: Optional[float] = 1.0
-    n: Optional[int] = 1
-    max_tokens: Optional[int] = None
-    presence_penalty: Optional[float] = 0.0
-    frequency_penalty: Optional[float] = 0.0
-    logit_bias: Optional[Dict[str, int]] = None
-    user: Optional[str] = None
-    response_format: Optional[Dict[str, str]] = None
-    seed: Optional[int] = None
-    stop: Optional[Union[str, List[str]]] = None
-    functions: Optional[List[Dict]] = None
-    function_call: Optional[Union[str, Dict]] = None
-    tools: Optional[List[Dict]] = None
-    tool_choice: Optional[Union[str, Dict]] = None
-    skip_system_prompt: Optional[bool] = None
 
-    @validator('messages')
-    def validate_messages(cls, v):
-        if not v:
-            raise ValueError("messages cannot be empty")
-        for msg in v:
-            if not msg.is_valid_role:
-                raise ValueError(f"Invalid role: {msg.role}. Must be one of: system, user, assistant, function, tool")
-        return v
+HTTP_POOL_WAIT = metrics.histogram(
+    "poe_http_pool_wait_seconds", "Time upstream requests waited for a connection from the HTTP pool", (),
+    QUEUE_WAIT_BUCKETS)
+HTTP_CONNECT_DURATION = metrics.histogram(
+    "poe_http_connect_seconds", "Time to open a new upstream connection, including TLS and proxy setup", (),
+    QUEUE_WAIT_BUCKETS)
+HTTP_CONNECTIONS_OPENED = metrics.counter(
+    "poe_http_connections_opened_total", "New upstream HTTP connections opened")
 
-    @validator('temperature')
-    def validate_temperature(cls, v):
-        if v is not None and not (0 <= v <= 2):
-            raise ValueError("temperature must be between 0 and 2")
-        return v
 
-    @validator('top_p')
-    def validate_top_p(cls, v):
-        if v is not None and not (0 <= v <= 1):
-            raise ValueError("top_p must be between 0 and 1")
-        return v
+class HttpTrace:
+    """httpcore 的 trace 回调：首个事件到达即说明已从连接池拿到连接，据此统计排队时间与新建连接耗时"""
 
-    @validator('n')
-    def validate_n(cls, v):
-        if v is not None and v < 1:
-            raise ValueError("n must be greater than 0")
-        return v
+    __slots__ = ("started", "acquired", "connect_started")
 
-    @validator('presence_penalty', 'frequency_penalty')
-    def validate_penalty(cls, v):
-        if v is not None and not (-2 <= v <= 2):
-            raise ValueError("penalty must be between -2 and 2")
-        return v
+    def __init__(self):
+        self.started = time.monotonic()
+        self.acquired = False
+        self.connect_started: Optional[float] = None
 
-    class Config:
-        json_schema_extra = {
-            "example": {
-                "model": "GPT-4o",
-                "messages": [
-                    {"role": "system", "content": "You are a helpful assistant."},
-                    {"role": "user", "content": "Hello!"}
-                ],
-                "stream": True,
-                "temperature": 0.7
-            }
+    async def __call__(self, event: str, info: Dict):
+        now = time.monotonic()
+        if not self.acquired:
+            self.acquired = True
+            HTTP_POOL_WAIT.observe((), now - self.started)
+        if event == "connection.connect_tcp.started":
+            self.connect_started = now
+            HTTP_CONNECTIONS_OPENED.inc()
+        elif self.connect_started is not None and event.endswith("send_request_headers.started"):
+            HTTP_CONNECT_DURATION.observe((), now - self.connect_started)
+            self.connect_started = None
+
+
+async def trace_upstream_request(request: httpx.Request):
+    # fastapi_poe 内部发起请求，无法逐个传入 extensions，因此通过请求钩子挂载 trace
+    request.extensions["trace"] = HttpTrace()
+
+
+def create_http_client() -> AsyncClient:
+    """创建访问 Poe 的共享 HTTP 客户端，代理（PROXY）与直连使用相同的连接池与超时配置"""
+    http2 = HTTP2_ENABLED
+    if http2 and h2 is None:
+        logger.warning("HTTP2_ENABLED is set but the h2 package is not installed, falling back to HTTP/1.1")
+        http2 = False
+    kwargs = {}
+    if PROXY:
+        kwargs["proxy"] = PROXY
+    return AsyncClient(
+        timeout=httpx.Timeout(TIMEOUT, connect=HTTP_CONNECT_TIMEOUT, read=HTTP_READ_TIMEOUT, pool=HTTP_POOL_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+        ),
+        http2=http2,
+        event_hooks={"request": [trace_upstream_request]},
+        **kwargs
+    )
+
+
+# 初始化代理
+proxy = create_http_client()
+
+
+async def prewarm_connections(count: int = HTTP_PREWARM_CONNECTIONS):
+    """启动时并发建立若干条到 Poe 的连接并放回连接池，避免首批请求承担 TCP/TLS 握手耗时"""
+    if count <= 0:
+        return
+
+    async def touch():
+        # 响应状态无关紧要，只需要连接被建立并保持
+        await proxy.head(POE_BASE_URL, timeout=HTTP_CONNECT_TIMEOUT)
+
+    results = await asyncio.gather(*(touch() for _ in range(count)), return_exceptions=True)
+    failed = [result for result in results if isinstance(result, BaseException)]
+    if failed:
+        logger.warning(f"Pre-warmed {count - len(failed)}/{count} upstream connections, "
+                       f"last error: {type(failed[-1]).__name__}: {str(failed[-1])[:200]}")
+    else:
+        logger.info(f"Pre-warmed {count} upstream connections to {POE_BASE_URL}")
+
+
+def is_local_pool_error(error: Optional[BaseException]) -> bool:
+    """连接池排队超时是本地资源不足，与密钥好坏无关；fastapi_poe 会把它包装为 BotError，需沿异常链查找"""
+    while error is not None:
+        if isinstance(error, httpx.PoolTimeout):
+            return True
+        error = error.__cause__
+    return False
+
+
+class KeyPoolExhausted(Exception):
+    """所有密钥均已饱和且排队超时"""
+
+
+def is_cancellation(error: Optional[BaseException]) -> bool:
+    return isinstance(error, (asyncio.CancelledError, GeneratorExit))
+
+
+def is_retryable_error(error: BaseException) -> bool:
+    """判断失败是否值得换一个密钥重试"""
+    if isinstance(error, BotErrorNoRetry):
+        # Poe 明确禁止重试的错误，只有与密钥本身相关（限流/额度）时才换密钥
+        return is_rate_limit_error(error)
+    return isinstance(error, (BotError, httpx.HTTPError, asyncio.TimeoutError))
+
+
+def retry_backoff(attempt: int) -> float:
+    # 指数退避 + 全抖动
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * (2 ** attempt)))
+
+
+def is_rate_limit_error(error: BaseException) -> bool:
+    """判断异常是否为限流或额度不足类错误"""
+    text = str(getattr(error, "text", "") or error).lower()
+    return any(marker in text for marker in (
+        "rate limit", "rate_limit", "too many requests", "429", "quota", "insufficient", "compute points"
+    ))
+
+
+# 单进程模式下状态只在事件循环内修改，无需加锁
+NO_LOCK = contextlib.nullcontext()
+
+
+def key_fingerprint(token: str) -> str:
+    """日志、监控指标与管理接口中代替密钥本身的短指纹"""
+    return hashlib.sha256(token.encode()).hexdigest()[:8]
+
+
+class KeyState:
+    """单个 Poe API 密钥的负载与健康状态"""
+
+    enabled = True
+    lock = NO_LOCK
+
+    def __init__(self, token: str):
+        self.token = token
+        self.fingerprint = key_fingerprint(token)
+        self.inflight = 0
+        # 流式请求的首字延迟与非流式请求的总耗时量级不同，分别统计
+        self.ewma_ttft: Optional[float] = None
+        self.ewma_total: Optional[float] = None
+        self.error_rate = 0.0
+        self.throttled_until = 0.0
+        self.consecutive_failures = 0
+        self.circuit_open_until = 0.0
+        self.total_requests = 0
+        self.total_errors = 0
+        self.last_error: Optional[str] = None
+
+    def is_throttled(self, now: float) -> bool:
+        return self.throttled_until > now
+
+    def circuit_state(self, now: float) -> str:
+        if self.consecutive_failures < CIRCUIT_BREAKER_THRESHOLD:
+            return "closed"
+        if self.circuit_open_until > now:
+            return "open"
+        return "half_open"
+
+    def is_saturated(self) -> bool:
+        return KEY_MAX_CONCURRENCY > 0 and self.inflight >= KEY_MAX_CONCURRENCY
+
+    def try_reserve(self) -> bool:
+        """占用一个并发名额；多进程模式下其他进程可能已抢先占满"""
+        with self.lock:
+            if self.is_saturated():
+                return False
+            self.inflight += 1
+            return True
+
+    def relative_latency(self, means: Dict[str, Optional[float]]) -> float:
+        """相对于密钥池平均值的延迟倍数，首字延迟与总耗时分别比较后取平均；没有样本的一项按平均值估计"""
+        ratios = []
+        for field, mean in means.items():
+            if mean:
+                value = getattr(self, field)
+                ratios.append(value / mean if value is not None else 1.0)
+        return sum(ratios) / len(ratios) if ratios else 1.0
+
+    def score(self, means: Dict[str, Optional[float]]) -> Tuple[int, float]:
+        # 在途请求少的密钥优先，相同时再比较相对延迟与错误惩罚，越小越优先
+        return self.inflight, self.relative_latency(means) * (1 + KEY_ERROR_PENALTY * self.error_rate)
+
+    def record(self, latency: Optional[float], error: Optional[BaseException], field: str = "ewma_total"):
+        self.total_requests += 1
+        if latency is not None and error is None:
+            current = getattr(self, field)
+            setattr(self, field, latency if current is None else current + KEY_EWMA_ALPHA * (latency - current))
+        self.error_rate += KEY_EWMA_ALPHA * ((1.0 if error is not None else 0.0) - self.error_rate)
+        if error is not None:
+            now = time.monotonic()
+            self.total_errors += 1
+            self.last_error = str(error)[:200]
+            if is_rate_limit_error(error):
+                self.throttled_until = now + KEY_RATE_LIMIT_COOLDOWN
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= CIRCUIT_BREAKER_THRESHOLD:
+                # 半开状态下的试探失败同样会重新熔断
+                self.circuit_open_until = now + CIRCUIT_BREAKER_COOLDOWN
+                logger.warning(f"Circuit opened for API key {self.fingerprint} after "
+                               f"{self.consecutive_failures} consecutive failures")
+        else:
+            if self.consecutive_failures >= CIRCUIT_BREAKER_THRESHOLD:
+                logger.info(f"Circuit closed for API key {self.fingerprint}")
+            self.consecutive_failures = 0
+            self.circuit_open_until = 0.0
+
+    def snapshot(self) -> Dict:
+        return {
+            "fingerprint": self.fingerprint,
+            "enabled": self.enabled,
+            "inflight": self.inflight,
+            "ewma_ttft": self.ewma_ttft,
+            "ewma_total": self.ewma_total,
+            "error_rate": round(self.error_rate, 4),
+            "throttled": self.is_throttled(time.monotonic()),
+            "circuit": self.circuit_state(time.monotonic()),
+            "total_requests": self.total_requests,
+            "total_errors": self.total_errors,
+            "last_error": self.last_error,
         }
-        
-        schema_extra = {
-            "examples": [
-                {
-                    "model": "GPT-4o",
-                    "messages": [
-                        {
-                            "role": "system",
-                            "content": "You are a helpful assistant."
-                        },
-                        {
-                            "role": "user",
-                            "content": "Hello!"
-                        }
-                    ]
-                }
-            ]
+
+
+class SharedTable:
+    """多进程模式下位于共享内存的定长数值表，每行对应一个密钥或访问令牌，由主进程创建后传给各工作进程"""
+
+    def __init__(self, context, fields, rows: int):
+        self.fields = {name: index for index, name in enumerate(fields)}
+        self.width = len(fields)
+        self.rows = max(1, rows)
+        self.values = context.RawArray("d", self.rows * self.width)
+        self.lock = context.Lock()
+
+
+def shared_field(name: str, cast=float):
+    """把状态对象的属性映射到共享表中本行的对应列，NaN 表示 None"""
+    def get(self):
+        value = self.table.values[self.offset + self.table.fields[name]]
+        if math.isnan(value):
+            return None
+        return cast(value)
+
+    def set(self, value):
+        self.table.values[self.offset + self.table.fields[name]] = math.nan if value is None else float(value)
+
+    return property(get, set)
+
+
+KEY_LATENCY_FIELDS = ("ewma_ttft", "ewma_total")
+KEY_STATE_FIELDS = ("enabled", "inflight", "ewma_ttft", "ewma_total", "error_rate", "throttled_until",
+                    "consecutive_failures", "circuit_open_until", "total_requests", "total_errors")
+
+
+class SharedKeyState(KeyState):
+    """状态存放在共享内存中的密钥，所有工作进程看到同一份在途数、健康度与限流冷却时间"""
+
+    enabled = shared_field("enabled", bool)
+    inflight = shared_field("inflight", int)
+    ewma_ttft = shared_field("ewma_ttft")
+    ewma_total = shared_field("ewma_total")
+    error_rate = shared_field("error_rate")
+    throttled_until = shared_field("throttled_until")
+    consecutive_failures = shared_field("consecutive_failures", int)
+    circuit_open_until = shared_field("circuit_open_until")
+    total_requests = shared_field("total_requests", int)
+    total_errors = shared_field("total_errors", int)
+
+    def __init__(self, token: str, table: SharedTable, row: int, initialize: bool = False):
+        self.table = table
+        self.offset = row * table.width
+        self.lock = table.lock
+        if initialize:
+            # 只由主进程初始化，工作进程直接沿用共享表中的数据
+            with self.lock:
+                super().__init__(token)
+        else:
+            self.token = token
+            self.fingerprint = key_fingerprint(token)
+            self.last_error = None
+
+
+class KeyLease:
+    """一次请求对某个密钥的占用，release 可重复调用"""
+
+    def __init__(self, pool: "KeyPool", state: KeyState, model: str = "", tenant: str = "", weight: int = 1):
+        self.pool = pool
+        self.state = state
+        self.model = model
+        self.tenant = tenant
+        self.weight = weight
+        self.started = time.monotonic()
+        self.first_token_latency: Optional[float] = None
+        self.released = False
+
+    @property
+    def token(self) -> str:
+        return self.state.token
+
+    def mark_first_token(self):
+        if self.first_token_latency is None:
+            self.first_token_latency = time.monotonic() - self.started
+            hedge_policy.observe(self.model, self.first_token_latency)
+
+    def release(self, error: Optional[BaseException] = None):
+        if self.released:
+            return
+        self.released = True
+        # 流式请求以首字延迟衡量密钥快慢，非流式请求以总耗时衡量
+        duration = time.monotonic() - self.started
+        latency = self.first_token_latency
+        if latency is None:
+            latency = duration
+        self.pool.release(self.state, latency, error,
+                          "ewma_ttft" if self.first_token_latency is not None else "ewma_total")
+        bot_router.record(self.model, latency, error)
+        if not is_cancellation(error):
+            labels = (self.model, self.state.fingerprint)
+            UPSTREAM_DURATION.observe(labels, duration)
+            if self.first_token_latency is not None:
+                UPSTREAM_TTFT.observe(labels, self.first_token_latency)
+            if error is not None:
+                UPSTREAM_ERRORS.inc(labels + (classify_error(error),))
+
+
+class FairQueue:
+    """按访问令牌分组的等待队列：各令牌按权重轮流获得唤醒机会，避免单个调用方占满队列"""
+
+    def __init__(self):
+        self.queues: Dict[str, deque] = {}
+        self.weights: Dict[str, int] = {}
+        self.order = deque()  # 有等待者的令牌，队首为当前轮到的令牌
+        self.credit = 0  # 队首令牌在本轮剩余的唤醒次数
+
+    def __len__(self) -> int:
+        return sum(1 for queue in self.queues.values() for waiter in queue if not waiter.done())
+
+    def push(self, tenant: str, waiter: asyncio.Future, weight: int = 1, front: bool = False):
+        queue = self.queues.get(tenant)
+        if queue is None:
+            queue = self.queues[tenant] = deque()
+            self.order.append(tenant)
+        self.weights[tenant] = max(1, weight)
+        if front:
+            queue.appendleft(waiter)
+        else:
+            queue.append(waiter)
+
+    def pop(self) -> Optional[asyncio.Future]:
+        """按加权轮询取出下一个仍在等待的请求，已取消的等待者在这里惰性丢弃"""
+        while self.order:
+            tenant = self.order[0]
+            queue = self.queues[tenant]
+            while queue and queue[0].done():
+                queue.popleft()
+            if not queue:
+                self._retire(tenant)
+                continue
+            if self.credit <= 0:
+                self.credit = self.weights[tenant]
+            waiter = queue.popleft()
+            self.credit -= 1
+            if not queue:
+                self._retire(tenant)
+            elif self.credit <= 0:
+                self.order.rotate(-1)
+            return waiter
+        return None
+
+    def _retire(self, tenant: str):
+        self.order.popleft()
+        del self.queues[tenant]
+        del self.weights[tenant]
+        self.credit = 0
+
+
+class KeyPool:
+    """按负载调度 Poe API 密钥：选择在途请求少、延迟低、错误少的密钥，全部饱和时按访问令牌公平排队
+
+    排空（drain）中的密钥不再接收新请求，已借出的租约照常完成；retiring 中的密钥在在途请求归零后移出密钥池。
+    排空标记按密钥记录在密钥池上，密钥因验证失败被移出又恢复后仍保持排空"""
+
+    def __init__(self):
+        self.keys: Dict[str, KeyState] = {}
+        self._waiters = FairQueue()
+        self.shared: Optional[SharedTable] = None
+        self.rows: Dict[str, int] = {}
+        self.draining: set = set()
+        self.retiring: set = set()
+
+    def __len__(self) -> int:
+        return sum(1 for state in self.keys.values() if self.schedulable(state))
+
+    def __contains__(self, token: str) -> bool:
+        state = self.keys.get(token)
+        return state is not None and state.enabled
+
+    def share(self, table: SharedTable, tokens: List[str]):
+        """切换到多进程共享状态，tokens 的顺序决定各密钥在共享表中的行号，所有进程必须一致"""
+        self.shared = table
+        self.rows = {token: row for row, token in enumerate(tokens)}
+
+    def attach(self):
+        """工作进程挂载共享表中的全部密钥（已挂载的保持不变），是否参与调度由共享的 enabled 标记决定"""
+        for token, row in self.rows.items():
+            if token not in self.keys:
+                self.keys[token] = SharedKeyState(token, self.shared, row)
+
+    def allocate(self, token: str) -> bool:
+        """主进程为热重载新增的密钥分配共享表中的空闲行并初始化（暂不启用），工作进程随后挂载；没有空闲行时返回 False"""
+        if token in self.rows:
+            return True
+        row = len(self.rows)
+        if row >= self.shared.rows:
+            return False
+        self.rows[token] = row
+        self.keys[token] = SharedKeyState(token, self.shared, row, initialize=True)
+        return True
+
+    def add(self, token: str) -> KeyState:
+        state = self.keys.get(token)
+        if state is None:
+            if self.shared is not None and token in self.rows:
+                state = SharedKeyState(token, self.shared, self.rows[token], initialize=True)
+            else:
+                state = KeyState(token)
+            self.keys[token] = state
+        if not state.enabled:
+            state.enabled = True
+        self._wake_next()
+        return state
+
+    def remove(self, token: str) -> Optional[KeyState]:
+        # 已借出的租约仍持有状态对象，释放时不会出错
+        state = self.keys.get(token)
+        if isinstance(state, SharedKeyState):
+            # 共享表中的这一行可能仍被其他进程的租约使用，只标记停用而不重建
+            state.enabled = False
+            return state
+        return self.keys.pop(token, None)
+
+    def schedulable(self, state: KeyState) -> bool:
+        return state.enabled and state.token not in self.draining
+
+    def status(self, state: KeyState) -> str:
+        # 多进程模式下由持有最后一个租约的进程完成移出，其他进程从共享的 enabled 标记得知
+        if not state.enabled:
+            return "disabled"
+        if state.token in self.retiring:
+            return "retiring"
+        return "draining" if state.token in self.draining else "active"
+
+    def find(self, fingerprint: str, candidates=()) -> Optional[str]:
+        """按指纹查找密钥池或 candidates 中的密钥，管理接口不回显完整密钥"""
+        for token in dict.fromkeys(list(self.keys) + list(candidates)):
+            if key_fingerprint(token) == fingerprint:
+                return token
+        return None
+
+    def drain(self, token: str, retire: bool = False) -> Optional[KeyState]:
+        """停止向密钥分配新请求；retire 为 True 时在途请求全部完成后移出密钥池"""
+        state = self.keys.get(token)
+        if state is None:
+            return None
+        self.draining.add(token)
+        if retire:
+            self.retiring.add(token)
+            if state.inflight <= 0:
+                self._retire(token)
+        return state
+
+    def resume(self, token: str) -> Optional[KeyState]:
+        self.draining.discard(token)
+        self.retiring.discard(token)
+        state = self.keys.get(token)
+        if state is not None:
+            self._wake_next()
+        return state
+
+    def _retire(self, token: str):
+        self.retiring.discard(token)
+        self.draining.discard(token)
+        self.remove(token)
+        logger.info(f"API key {key_fingerprint(token)} drained and removed from the pool")
+
+    def _pick(self, exclude=None) -> Optional[KeyState]:
+        now = time.monotonic()
+        enabled = [s for s in self.keys.values() if self.schedulable(s)]
+        candidates = [s for s in enabled if not exclude or s.token not in exclude]
+        if not candidates:
+            # 需要排除的密钥覆盖了全部密钥时，允许复用
+            candidates = enabled
+        available = [s for s in candidates if not s.is_saturated()]
+        if not available:
+            return None
+        # 优先级：健康 > 熔断半开（每次只放行一个试探请求）> 限流冷却中 > 熔断中
+        # 没有更好的选择时仍会使用熔断中的密钥，避免单密钥部署被完全拒绝服务
+        circuits = {s.token: s.circuit_state(now) for s in available}
+        tiers = (
+            [s for s in available if circuits[s.token] == "closed" and not s.is_throttled(now)],
+            [s for s in available if circuits[s.token] == "half_open" and s.inflight == 0],
+            [s for s in available if circuits[s.token] == "closed"],
+            available,
+        )
+        means = self.latency_means(enabled)
+        for tier in tiers:
+            if tier:
+                return min(tier, key=lambda state: state.score(means))
+        return None
+
+    @staticmethod
+    def latency_means(states: List[KeyState]) -> Dict[str, Optional[float]]:
+        """各类延迟在有样本的密钥上的平均值，作为比较相对快慢的基准"""
+        means = {}
+        for field in KEY_LATENCY_FIELDS:
+            values = [value for value in (getattr(state, field) for state in states) if value is not None]
+            means[field] = sum(values) / len(values) if values else None
+        return means
+
+    def _wake_next(self):
+        waiter = self._waiters.pop()
+        if waiter is not None:
+            waiter.set_result(None)
+
+    async def acquire(self, exclude=None, timeout: Optional[float] = None, model: str = "",
+                      tenant: str = "", weight: int = 1) -> KeyLease:
+        if not len(self):
+            raise HTTPException(status_code=500, detail="No valid API tokens available")
+        timeout = KEY_QUEUE_TIMEOUT if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        loop = asyncio.get_running_loop()
+        woken = False
+        while True:
+            state = self._pick(exclude)
+            if state is not None and state.try_reserve():
+                KEY_QUEUE_WAIT.observe((model,), time.monotonic() - started)
+                return KeyLease(self, state, model, tenant, weight)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                KEY_POOL_EXHAUSTED.inc((model,))
+                raise KeyPoolExhausted(f"All {len(self)} API keys are saturated")
+            waiter = loop.create_future()
+            # 被唤醒后名额又被抢走时回到本令牌队列的队首，不丢失排队位置
+            self._waiters.push(tenant, waiter, weight, front=woken)
+            # 其他进程释放名额不会唤醒本进程的等待者，多进程模式下需要定期重试
+            wait = remaining if self.shared is None else min(remaining, SHARED_STATE_POLL_INTERVAL)
+            try:
+                await asyncio.wait_for(waiter, wait)
+                woken = True
+            except asyncio.TimeoutError:
+                if wait < remaining:
+                    woken = True
+                    continue
+                KEY_POOL_EXHAUSTED.inc((model,))
+                raise KeyPoolExhausted(f"All {len(self)} API keys are saturated")
+            except BaseException:
+                # 被唤醒后又取消时，把名额让给下一个等待者
+                if waiter.done() and not waiter.cancelled():
+                    self._wake_next()
+                raise
+
+    def pick_token(self) -> Optional[str]:
+        """为上传附件等辅助调用挑选一个密钥，不占用并发名额，也不计入调度统计"""
+        state = self._pick() or next((s for s in self.keys.values() if self.schedulable(s)), None)
+        return state.token if state is not None else None
+
+    def try_acquire(self, exclude, model: str = "", tenant: str = "", weight: int = 1) -> Optional[KeyLease]:
+        """不排队地占用 exclude 之外的一个密钥，没有空闲或健康的密钥时返回 None"""
+        if all(not self.schedulable(s) or s.token in exclude for s in self.keys.values()):
+            return None
+        state = self._pick(exclude)
+        if state is None or state.circuit_state(time.monotonic()) == "open" or not state.try_reserve():
+            return None
+        return KeyLease(self, state, model, tenant, weight)
+
+    def release(self, state: KeyState, latency: Optional[float], error: Optional[BaseException],
+                field: str = "ewma_total"):
+        with state.lock:
+            state.inflight = max(0, state.inflight - 1)
+            # 客户端取消与本地连接池排队超时不代表密钥的好坏，不计入统计
+            if not is_cancellation(error) and not is_local_pool_error(error):
+                state.record(latency, error, field)
+        if state.token in self.retiring and state.inflight <= 0 and self.keys.get(state.token) is state:
+            self._retire(state.token)
+        self._wake_next()
+
+    def snapshot(self) -> List[Dict]:
+        return [dict(state.snapshot(), status=self.status(state)) for state in list(self.keys.values())]
+
+
+key_pool = KeyPool()
+
+
+class HedgePolicy:
+    """决定何时发起对冲：阈值取各模型近期首字延迟的 p95，预算按可对冲请求数的百分比累积"""
+
+    def __init__(self, models, delay_ms: float, budget_percent: float):
+        self.models = {model.lower() for model in models or []}
+        self.fixed_delay = delay_ms / 1000 if delay_ms > 0 else None
+        self.rate = max(0.0, budget_percent) / 100
+        self.credit = 0.0
+        self.samples: Dict[str, deque] = {}
+        self.p95: Dict[str, float] = {}
+
+    def enabled_for(self, model: str, header: Optional[str]) -> bool:
+        if header is not None and header.strip().lower() in ("true", "false", "1", "0"):
+            enabled = header.strip().lower() in ("true", "1")
+        else:
+            enabled = model.lower() in self.models
+        if enabled:
+            # 每个可对冲的请求为预算贡献 rate 次对冲机会
+            self.credit = min(HEDGE_BURST, self.credit + self.rate)
+        return enabled
+
+    def has_budget(self) -> bool:
+        return self.credit >= 1
+
+    def spend(self):
+        self.credit -= 1
+
+    def observe(self, model: str, ttft: float):
+        samples = self.samples.get(model)
+        if samples is None:
+            samples = self.samples[model] = deque(maxlen=HEDGE_WINDOW)
+        samples.append(ttft)
+        if len(samples) >= HEDGE_MIN_SAMPLES and len(samples) % 10 == 0:
+            # 每 10 个样本重新排序一次，避免每个请求都排序整个窗口
+            ordered = sorted(samples)
+            self.p95[model] = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def delay(self, model: str) -> float:
+        if self.fixed_delay is not None:
+            return self.fixed_delay
+        return max(HEDGE_MIN_DELAY, self.p95.get(model, HEDGE_DEFAULT_DELAY))
+
+
+hedge_policy = HedgePolicy(HEDGE_MODELS, HEDGE_DELAY_MS, HEDGE_BUDGET_PERCENT)
+
+
+class RateLimitExceeded(Exception):
+    """访问令牌超出请求速率或并发上限"""
+
+    def __init__(self, message: str, retry_after: float, reason: str):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class TokenBucket:
+    """令牌桶：按固定速率补充，取不到令牌时给出需要等待的时间"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, now: float) -> float:
+        """成功取出一个令牌返回 0，否则返回距下一个令牌可用的秒数"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class AccessTokenState:
+    """单个访问令牌的限流状态"""
+
+    __slots__ = ("bucket", "max_concurrency", "active", "weight", "lock")
+
+    def __init__(self, rate: float, burst: float, max_concurrency: int, weight: int):
+        self.bucket = TokenBucket(rate, burst or max(1.0, rate)) if rate > 0 else None
+        self.max_concurrency = max_concurrency
+        self.active = 0
+        self.weight = max(1, weight)
+        self.lock = NO_LOCK
+
+
+ACCESS_TOKEN_FIELDS = ("tokens", "updated", "active")
+
+
+class SharedTokenBucket(TokenBucket):
+    """桶中余量存放在共享内存中的令牌桶，多个工作进程共用同一个速率限制"""
+
+    __slots__ = ("table", "offset")
+    tokens = shared_field("tokens")
+    updated = shared_field("updated")
+
+    def __init__(self, rate: float, capacity: float, table: SharedTable, row: int, initialize: bool):
+        self.table = table
+        self.offset = row * table.width
+        if initialize:
+            super().__init__(rate, capacity)
+        else:
+            self.rate = rate
+            self.capacity = capacity
+
+
+class SharedAccessTokenState(AccessTokenState):
+    """并发数与令牌桶存放在共享内存中的访问令牌状态"""
+
+    __slots__ = ("table", "offset")
+    active = shared_field("active", int)
+
+    def __init__(self, rate: float, burst: float, max_concurrency: int, weight: int,
+                 table: SharedTable, row: int, initialize: bool):
+        self.table = table
+        self.offset = row * table.width
+        self.bucket = SharedTokenBucket(rate, burst or max(1.0, rate), table, row, initialize) if rate > 0 else None
+        self.max_concurrency = max_concurrency
+        self.weight = max(1, weight)
+        self.lock = table.lock
+        if initialize:
+            self.active = 0
+
+
+class AccessTokenSlot:
+    """一次请求占用的并发名额，release 可重复调用"""
+
+    __slots__ = ("state", "released")
+
+    def __init__(self, state: AccessTokenState):
+        self.state = state
+        self.released = False
+
+    @property
+    def weight(self) -> int:
+        return self.state.weight
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            with self.state.lock:
+                self.state.active -= 1
+
+
+class AccessTokenLimiter:
+    """按访问令牌执行请求速率与并发限制，每个请求 O(1)；单进程模式下在事件循环内同步完成，无需加锁，
+    多进程模式下状态位于共享内存，只在极短的临界区内持有进程锁"""
+
+    def __init__(self, overrides: Dict):
+        self.overrides = overrides if isinstance(overrides, dict) else {}
+        if not isinstance(overrides, dict):
+            logger.warning("TOKEN_LIMITS must be a JSON object keyed by access token, ignoring it")
+        self.states: Dict[str, AccessTokenState] = {}
+        self.shared: Optional[SharedTable] = None
+        self.rows: Dict[str, int] = {}
+
+    def share(self, table: SharedTable, tokens: List[str], initialize: bool = False):
+        """切换到多进程共享状态；由主进程以 initialize=True 调用一次写入初始值"""
+        self.shared = table
+        self.rows = {token: row for row, token in enumerate(tokens)}
+        self.states.clear()
+        if initialize:
+            for token in tokens:
+                self._state(token, initialize=True)
+
+    def allocate(self, token: str) -> bool:
+        """主进程为热重载新增的访问令牌分配共享表中的空闲行并初始化，工作进程随后挂载；没有空闲行时返回 False"""
+        if token in self.rows:
+            return True
+        row = len(self.rows)
+        if row >= self.shared.rows:
+            return False
+        self.rows[token] = row
+        self.states.pop(token, None)
+        self._state(token, initialize=True)
+        return True
+
+    def attach(self, tokens: List[str]):
+        """工作进程挂载主进程新分配的行（tokens 的顺序即行号），此前按进程各自统计的状态改用共享状态"""
+        for row, token in enumerate(tokens):
+            if token not in self.rows:
+                self.rows[token] = row
+                self.states.pop(token, None)
+
+    def _state(self, token: str, initialize: bool = False) -> AccessTokenState:
+        state = self.states.get(token)
+        if state is None:
+            limits = self.overrides.get(token) or {}
+            params = (
+                float(limits.get("rate", TOKEN_RATE_LIMIT)),
+                float(limits.get("burst", TOKEN_RATE_BURST)),
+                int(limits.get("concurrency", TOKEN_MAX_CONCURRENCY)),
+                int(limits.get("weight", 1)),
+            )
+            if self.shared is not None and token in self.rows:
+                state = SharedAccessTokenState(*params, self.shared, self.rows[token], initialize)
+            else:
+                state = AccessTokenState(*params)
+            self.states[token] = state
+        return state
+
+    def admit(self, token: str, observe: bool = True) -> AccessTokenSlot:
+        state = self._state(token)
+        with state.lock:
+            return self._admit(state, observe)
+
+    async def wait_admit(self, token: str) -> AccessTokenSlot:
+        """与 admit 相同的速率与并发限制，但超限时排队等待而不是拒绝，供批量请求的每一行使用"""
+        while True:
+            try:
+                return self.admit(token, observe=False)
+            except RateLimitExceeded as e:
+                await asyncio.sleep(e.retry_after if e.reason == "rate" else SHARED_STATE_POLL_INTERVAL)
+
+    def max_concurrency(self, token: str) -> int:
+        return self._state(token).max_concurrency
+
+    def _admit(self, state: AccessTokenState, observe: bool = True) -> AccessTokenSlot:
+        if state.max_concurrency > 0 and state.active >= state.max_concurrency:
+            if observe:
+                RATE_LIMITED.inc(("concurrency",))
+            raise RateLimitExceeded(
+                f"Rate limit reached for concurrent requests: limit {state.max_concurrency}. "
+                f"Please try again in {TOKEN_CONCURRENCY_RETRY_AFTER}s.",
+                TOKEN_CONCURRENCY_RETRY_AFTER, "concurrency"
+            )
+        if state.bucket is not None:
+            wait = state.bucket.take(time.monotonic())
+            if wait > 0:
+                if observe:
+                    RATE_LIMITED.inc(("rate",))
+                raise RateLimitExceeded(
+                    f"Rate limit reached for requests: limit {state.bucket.rate:g}/s. "
+                    f"Please try again in {wait:.2f}s.",
+                    wait, "rate"
+                )
+        state.active += 1
+        return AccessTokenSlot(state)
+
+
+access_limiter = AccessTokenLimiter(TOKEN_LIMITS)
+
+bot_names_map = {name.lower(): name for name in BOT_NAMES}
+
+
+class BotHealth:
+    """单个 Poe 机器人的近期延迟与错误率，连续失败时暂时视为不可用，供虚拟模型选择机器人"""
+
+    def __init__(self):
+        self.ewma_latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+
+    def is_healthy(self, now: float) -> bool:
+        return self.unhealthy_until <= now
+
+    def score(self) -> float:
+        latency = self.ewma_latency if self.ewma_latency is not None else KEY_DEFAULT_LATENCY
+        return latency * (1 + KEY_ERROR_PENALTY * self.error_rate)
+
+    def record(self, latency: Optional[float], error: Optional[BaseException]):
+        if latency is not None and error is None:
+            if self.ewma_latency is None:
+                self.ewma_latency = latency
+            else:
+                self.ewma_latency += KEY_EWMA_ALPHA * (latency - self.ewma_latency)
+        self.error_rate += KEY_EWMA_ALPHA * ((1.0 if error is not None else 0.0) - self.error_rate)
+        if error is None:
+            self.consecutive_failures = 0
+            self.unhealthy_until = 0.0
+            return
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= CIRCUIT_BREAKER_THRESHOLD:
+            self.unhealthy_until = time.monotonic() + CIRCUIT_BREAKER_COOLDOWN
+
+    def snapshot(self) -> Dict:
+        return {
+            "healthy": self.is_healthy(time.monotonic()),
+            "ewma_latency": self.ewma_latency,
+            "error_rate": round(self.error_rate, 4),
+            "consecutive_failures": self.consecutive_failures,
+        }
+
+
+class VirtualModel:
+    """映射到多个等价机器人的模型名：ordered 时按配置顺序优先，否则按权重与机器人健康度随机分配"""
+
+    def __init__(self, name: str, bots: Dict[str, float], ordered: bool):
+        self.name = name
+        self.bots = bots
+        self.ordered = ordered
+
+
+class BotRoute:
+    """一次请求的候选机器人，首字节前失败时依次换下一个；served 与 key 为实际产出响应的机器人与密钥指纹"""
+
+    def __init__(self, bots: List[str]):
+        self.bots = bots
+        self.index = 0
+        self.served: Optional[str] = None
+        self.key: Optional[str] = None
+        # 虚拟模型至少让每个候选机器人都有一次机会
+        self.max_retries = max(MAX_RETRIES, len(bots) - 1)
+
+    @property
+    def bot(self) -> str:
+        return self.bots[self.index]
+
+    def mark_served(self, key: str):
+        self.served = self.bots[self.index]
+        self.key = key
+
+    def advance(self) -> bool:
+        if self.index + 1 >= len(self.bots):
+            return False
+        self.index += 1
+        return True
+
+
+class BotRouter:
+    """解析虚拟模型并按各机器人的实时错误率与延迟排列候选顺序"""
+
+    def __init__(self, config):
+        self.models: Dict[str, VirtualModel] = {}
+        self.health: Dict[str, BotHealth] = {}
+        self.config: Dict = {}
+        self.configure(config)
+
+    def configure(self, config):
+        """解析虚拟模型配置并整体替换，已经选好机器人的请求不受影响，机器人健康度保留"""
+        if not isinstance(config, dict):
+            logger.warning("VIRTUAL_MODELS must be a JSON object, ignoring it")
+            config = {}
+        models = {}
+        for name, bots in config.items():
+            if name.lower() in bot_names_map:
+                logger.warning(f"Virtual model {name} shadows a bot in BOT_NAMES, ignoring it")
+                continue
+            ordered = isinstance(bots, list)
+            weights = {bot: 1.0 for bot in bots} if ordered else bots
+            if not isinstance(weights, dict) or not weights:
+                logger.warning(f"Virtual model {name} must map to a non-empty list or object of bots, ignoring it")
+                continue
+            weights = {bot_names_map.get(bot.lower(), bot): max(0.0, float(weight))
+                       for bot, weight in weights.items()}
+            models[name.lower()] = VirtualModel(name, weights, ordered)
+        self.config = {model.name: config[model.name] for model in models.values()}
+        self.models = models
+
+    def get(self, model: str) -> Optional[VirtualModel]:
+        return self.models.get(model.lower())
+
+    def health_of(self, bot: str) -> BotHealth:
+        health = self.health.get(bot)
+        if health is None:
+            health = self.health[bot] = BotHealth()
+        return health
+
+    def record(self, bot: str, latency: Optional[float], error: Optional[BaseException]):
+        # 取消、本地连接池排队与密钥限流都与机器人本身无关
+        if not bot or is_cancellation(error) or is_local_pool_error(error):
+            return
+        if error is not None and is_rate_limit_error(error):
+            return
+        self.health_of(bot).record(latency, error)
+
+    def route(self, model: str) -> BotRoute:
+        virtual = self.get(model)
+        if virtual is None:
+            return BotRoute([model])
+        now = time.monotonic()
+        healthy = [bot for bot in virtual.bots if self.health_of(bot).is_healthy(now)]
+        unhealthy = sorted((bot for bot in virtual.bots if bot not in healthy),
+                           key=lambda bot: self.health_of(bot).score())
+        if not virtual.ordered:
+            # 按 权重 / 预计代价 依次抽取，延迟低、错误少的机器人分到更多请求
+            remaining = list(healthy)
+            healthy = []
+            while remaining:
+                weights = [virtual.bots[bot] / self.health_of(bot).score() for bot in remaining]
+                if sum(weights) <= 0:
+                    healthy.extend(sorted(remaining, key=lambda bot: self.health_of(bot).score()))
+                    break
+                pick = random.choices(remaining, weights)[0]
+                healthy.append(pick)
+                remaining.remove(pick)
+        # 暂时不可用的机器人排在最后，所有机器人都不可用时仍会尝试
+        return BotRoute(healthy + unhealthy)
+
+
+bot_router = BotRouter(VIRTUAL_MODELS)
+
+
+class Message(BaseModel):
+    role: str
+    # 内容块的值可以是嵌套对象，例如 {"type": "image_url", "image_url": {"url": "..."}}
+    content: Union[str, List[Dict[str, Any]], Dict[str, Any]] = ""
+    name: Optional[str] = None
+    function_call: Optional[Dict] = None
+    tool_calls: Optional[List[Dict]] = None
+    tool_call_id: Optional[str] = None
+
+    @property
+    def is_valid_role(self) -> bool:
+        return self.role in ["system", "user", "assistant", "function", "tool"]
+
+    def get_content_text(self) -> str:
+        """获取消息内容的文本表示"""
+        if isinstance(self.content, str):
+            return self.content
+        elif isinstance(self.content, list):
+            # 处理列表格式的内容，例如 [{"type": "text", "text": "some content"}]
+            return " ".join(item.get("text", "") for item in self.content if item.get("type") == "text")
+        elif isinstance(self.content, dict):
+            # 处理字典格式的内容
+            return self.content.get("text", "")
+        return ""
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "role": "user",
+                "content": "Hello!"
+            }
+        }
+
+class CompletionRequest(BaseModel):
+    model: str
+    messages: List[Message]
+    stream: Optional[bool] = False
+    temperature: Optional[float] = 0.7
+    top_p: Optional[float] = 1.0
+    n: Optional[int] = 1
+    max_tokens: Optional[int] = None
+    presence_penalty: Optional[float] = 0.0
+    frequency_penalty: Optional[float] = 0.0
+    logit_bias: Optional[Dict[str, int]] = None
+    user: Optional[str] = None
+    response_format: Optional[Dict[str, str]] = None
+    seed: Optional[int] = None
+    stop: Optional[Union[str, List[str]]] = None
+    functions: Optional[List[Dict]] = None
+    function_call: Optional[Union[str, Dict]] = None
+    tools: Optional[List[Dict]] = None
+    tool_choice: Optional[Union[str, Dict]] = None
+    skip_system_prompt: Optional[bool] = None
+
+    @validator('messages')
+    def validate_messages(cls, v):
+        if not v:
+            raise ValueError("messages cannot be empty")
+        for msg in v:
+            if not msg.is_valid_role:
+                raise ValueError(f"Invalid role: {msg.role}. Must be one of: system, user, assistant, function, tool")
+        return v
+
+    @validator('temperature')
+    def validate_temperature(cls, v):
+        if v is not None and not (0 <= v <= 2):
+            raise ValueError("temperature must be between 0 and 2")
+        return v
+
+    @validator('top_p')
+    def validate_top_p(cls, v):
+        if v is not None and not (0 <= v <= 1):
+            raise ValueError("top_p must be between 0 and 1")
+        return v
+
+    @validator('n')
+    def validate_n(cls, v):
+        if v is not None and v < 1:
+            raise ValueError("n must be greater than 0")
+        if v is not None and v > MAX_CHOICES:
+            raise ValueError(f"n must be at most {MAX_CHOICES}")
+        return v
+
+    @validator('presence_penalty', 'frequency_penalty')
+    def validate_penalty(cls, v):
+        if v is not None and not (-2 <= v <= 2):
+            raise ValueError("penalty must be between -2 and 2")
+        return v
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "model": "GPT-4o",
+                "messages": [
+                    {"role": "system", "content": "You are a helpful assistant."},
+                    {"role": "user", "content": "Hello!"}
+                ],
+                "stream": True,
+                "temperature": 0.7
+            }
+        }
+        
+        schema_extra = {
+            "examples": [
+                {
+                    "model": "GPT-4o",
+                    "messages": [
+                        {
+                            "role": "system",
+                            "content": "You are a helpful assistant."
+                        },
+                        {
+                            "role": "user",
+                            "content": "Hello!"
+                        }
+                    ]
+                }
+            ]
+        }
+
+CJK_CHARS = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+CJK_PATTERN = re.compile(f"[{CJK_CHARS}]")
+WORD_RUN_PATTERN = re.compile(f"[^\\W_{CJK_CHARS}]+")
+SYMBOL_PATTERN = re.compile(r"[^\w\s]|_")
+HEURISTIC_PATTERN = re.compile(f"[{CJK_CHARS}]|(?P<word>[^\\W_{CJK_CHARS}]+)|[^\\w\\s]|_")
+WORD_PATTERN = re.compile(r"\S+")
+
+
+def word_run_tokens(length: int) -> int:
+    # 拉丁等字母文字平均约 4 个字符一个 token
+    return max(1, (length + 2) // 4)
+
+
+class WhitespaceTokenizer:
+    """按空白切分计数，即最初的估算方式"""
+
+    name = "whitespace"
+
+    def count(self, text: str) -> int:
+        return len(text.split())
+
+    def truncate(self, text: str, limit: int) -> int:
+        """返回 text 中不超过 limit 个 token 的最长前缀长度"""
+        for index, match in enumerate(WORD_PATTERN.finditer(text)):
+            if index >= limit:
+                return match.start()
+        return len(text)
+
+
+class HeuristicTokenizer:
+    """不依赖词表的估算：中日韩文字与标点各计 1 个 token，其他文字按单词长度估算"""
+
+    name = "heuristic"
+
+    def count(self, text: str) -> int:
+        cjk = len(text) - len(CJK_PATTERN.sub("", text))
+        words = sum(word_run_tokens(len(word)) for word in WORD_RUN_PATTERN.findall(text))
+        return cjk + words + len(SYMBOL_PATTERN.findall(text))
+
+    def truncate(self, text: str, limit: int) -> int:
+        tokens = 0
+        for match in HEURISTIC_PATTERN.finditer(text):
+            length = match.end() - match.start()
+            cost = word_run_tokens(length) if match.group("word") else 1
+            if tokens + cost > limit:
+                # 单词只能放下一部分时按每 token 4 个字符截断
+                return match.start() + (min(length, (limit - tokens) * 4) if cost > 1 else 0)
+            tokens += cost
+        return len(text)
+
+
+class TiktokenTokenizer:
+    """tiktoken 的 BPE 编码，计数与 OpenAI 模型一致；特殊 token 按普通文本处理"""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.name = f"tiktoken:{encoding.name}"
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode_ordinary(text))
+
+    def truncate(self, text: str, limit: int) -> int:
+        tokens = self.encoding.encode_ordinary(text)
+        if len(tokens) <= limit:
+            return len(text)
+        # 截断处可能落在多字节字符中间，丢弃不完整的尾部
+        return len(self.encoding.decode_bytes(tokens[:limit]).decode("utf-8", errors="ignore"))
+
+
+def create_tokenizer(kind: str):
+    if kind == "whitespace":
+        return WhitespaceTokenizer()
+    if kind in ("auto", "tiktoken") and tiktoken is not None:
+        try:
+            return TiktokenTokenizer(tiktoken.get_encoding(TIKTOKEN_ENCODING))
+        except Exception as e:
+            # 编码文件需要联网下载，失败时退回启发式估算
+            logger.warning(f"Failed to load tiktoken encoding {TIKTOKEN_ENCODING}: {str(e)}, "
+                           f"falling back to the heuristic tokenizer")
+    elif kind == "tiktoken":
+        logger.warning("TOKENIZER=tiktoken but tiktoken is not installed, falling back to the heuristic tokenizer")
+    elif kind not in ("auto", "heuristic"):
+        logger.warning(f"Unknown TOKENIZER {kind}, falling back to the heuristic tokenizer")
+    return HeuristicTokenizer()
+
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+
+def get_tokenizer():
+    """首次使用时按 TOKENIZER 配置加载分词器，之后复用同一个实例"""
+    global _tokenizer
+    if _tokenizer is None:
+        with _tokenizer_lock:
+            if _tokenizer is None:
+                _tokenizer = create_tokenizer(TOKENIZER)
+                logger.info(f"Using {_tokenizer.name} tokenizer for usage accounting")
+    return _tokenizer
+
+
+async def load_tokenizer():
+    """在线程中完成首次加载（tiktoken 可能需要读取或下载编码文件），避免阻塞事件循环"""
+    if _tokenizer is None:
+        await asyncio.to_thread(get_tokenizer)
+
+
+def count_tokens(text: str) -> int:
+    return get_tokenizer().count(text)
+
+
+async def count_tokens_async(text: str) -> int:
+    """大段文本在线程池中分词，避免阻塞事件循环"""
+    if len(text) >= TOKENIZE_THREAD_THRESHOLD:
+        return await asyncio.to_thread(count_tokens, text)
+    return count_tokens(text)
+
+
+class PromptTokenCache:
+    """按消息内容哈希缓存 token 数：智能体类客户端每轮都会重发完整的历史消息，只需为新消息分词"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def count_each(self, texts: List[str]) -> List[int]:
+        """返回每段文本的 token 数"""
+        tokenizer = get_tokenizer()
+        counts: List[Optional[int]] = []
+        missing = []
+        for text in texts:
+            if len(text) < PROMPT_TOKEN_CACHE_MIN_CHARS or self.max_entries <= 0:
+                counts.append(tokenizer.count(text))
+                continue
+            key = hashlib.blake2b(text.encode(), digest_size=16).digest()
+            cached = self._entries.get(key)
+            if cached is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+                missing.append((len(counts), key, text))
+            counts.append(cached)
+        if missing:
+            pending = [text for _, _, text in missing]
+            if sum(len(text) for text in pending) >= TOKENIZE_THREAD_THRESHOLD:
+                results = await asyncio.to_thread(lambda: [tokenizer.count(text) for text in pending])
+            else:
+                results = [tokenizer.count(text) for text in pending]
+            for (index, key, _), tokens in zip(missing, results):
+                self._entries[key] = tokens
+                counts[index] = tokens
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return counts
+
+    async def count(self, texts: List[str]) -> int:
+        return sum(await self.count_each(texts))
+
+
+prompt_token_cache = PromptTokenCache(PROMPT_TOKEN_CACHE_SIZE)
+
+
+async def build_usage(messages: List[Message], completion_tokens: int) -> Dict[str, int]:
+    prompt_tokens = await prompt_token_cache.count([msg.get_content_text() for msg in messages])
+    total_tokens = prompt_tokens + completion_tokens
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": total_tokens
+    }
+
+
+def context_budget(model: str) -> Optional[int]:
+    budget = CONTEXT_BUDGETS.get(model.lower(), CONTEXT_BUDGETS.get("*"))
+    return budget if budget and budget > 0 else None
+
+
+class CompactionReport:
+    """一次上下文压缩的结果，用于请求日志与指标"""
+
+    def __init__(self, tokens_before: int):
+        self.tokens_before = tokens_before
+        self.tokens_after = tokens_before
+        self.dropped: List[str] = []  # 被丢弃消息的 "序号:角色"
+        self.truncated: List[str] = []  # 被截断的工具输出的 "序号:角色"
+        self.bytes_saved: Dict[str, int] = {strategy: 0 for strategy in CONTEXT_STRATEGIES}
+
+    def describe(self) -> str:
+        parts = [f"{self.tokens_before} -> {self.tokens_after} tokens"]
+        if self.truncated:
+            parts.append(f"truncated tool outputs {', '.join(self.truncated)}")
+        if self.dropped:
+            parts.append(f"dropped messages {', '.join(self.dropped)}")
+        parts.append(f"{sum(self.bytes_saved.values())} bytes saved")
+        return "; ".join(parts)
+
+
+def content_bytes(message: Message) -> int:
+    return len(message.get_content_text().encode())
+
+
+def truncate_tool_output(text: str, tokens: int, limit: int) -> str:
+    # 保留开头部分，并注明被截断的 token 数，让模型知道输出不完整
+    end = get_tokenizer().truncate(text, limit)
+    return f"{text[:end]}\n...[truncated {tokens - limit} tokens]"
+
+
+async def compact_messages(messages: List[Message], budget: int) -> Tuple[List[Message], Optional[CompactionReport]]:
+    """提示词超过 budget 个 token 时依次执行 CONTEXT_COMPACTION 中的策略，直到不超过预算：
+    truncate_tools 从最早的开始截断超长的工具输出；drop_oldest 从最早的开始丢弃对话轮次（助手消息连同其后的工具结果），
+    system 消息与最后一条消息始终保留。未超出预算时返回 (messages, None)"""
+    counts = await prompt_token_cache.count_each([message.get_content_text() for message in messages])
+    total = sum(counts)
+    if total <= budget:
+        return messages, None
+    report = CompactionReport(total)
+    messages = list(messages)
+    indexes = list(range(len(messages)))  # 保留的消息在原请求中的序号
+    for strategy in CONTEXT_COMPACTION:
+        if total <= budget:
+            break
+        if strategy == "truncate_tools":
+            limit = CONTEXT_TOOL_OUTPUT_MAX_TOKENS
+            for position, message in enumerate(messages):
+                if total <= budget:
+                    break
+                if message.role not in ("tool", "function") or counts[position] <= limit:
+                    continue
+                text = truncate_tool_output(message.get_content_text(), counts[position], limit)
+                truncated = message.model_copy(update={"content": text})
+                report.bytes_saved[strategy] += content_bytes(message) - content_bytes(truncated)
+                report.truncated.append(f"{indexes[position]}:{message.role}")
+                messages[position] = truncated
+                remaining = get_tokenizer().count(text)
+                total -= counts[position] - remaining
+                counts[position] = remaining
+        elif strategy == "drop_oldest":
+            position = 0
+            while total > budget and position < len(messages) - 1:
+                if messages[position].role == "system":
+                    position += 1
+                    continue
+                # 助手的工具调用与紧随其后的工具结果是一个整体，一起丢弃或一起保留，避免留下没有对应调用的工具输出
+                end = position + 1
+                while end < len(messages) and messages[end].role in ("tool", "function"):
+                    end += 1
+                if end >= len(messages):
+                    # 这一轮包含必须保留的最后一条消息，整体保留
+                    break
+                for dropped in range(position, end):
+                    report.bytes_saved[strategy] += content_bytes(messages[dropped])
+                    report.dropped.append(f"{indexes[dropped]}:{messages[dropped].role}")
+                    total -= counts[dropped]
+                del messages[position:end], counts[position:end], indexes[position:end]
+        else:
+            logger.warning(f"Unknown context compaction strategy {strategy}, skipping it")
+    report.tokens_after = total
+    return messages, report
+
+
+async def apply_context_budget(completion_request: CompletionRequest, request_id: str) -> Optional[CompactionReport]:
+    """按模型的上下文预算压缩 completion_request.messages，并记录日志与指标；返回压缩结果，未超出预算时为 None"""
+    budget = context_budget(completion_request.model)
+    if budget is None:
+        return None
+    messages, report = await compact_messages(completion_request.messages, budget)
+    if report is None:
+        return None
+    if report.dropped or report.truncated:
+        completion_request.messages = messages
+        CONTEXT_COMPACTIONS.inc((completion_request.model,))
+        for strategy, saved in report.bytes_saved.items():
+            if saved:
+                CONTEXT_BYTES_SAVED.inc((completion_request.model, strategy), saved)
+        logger.info(f"Compacted context for request [{request_id}] with model {completion_request.model} "
+                    f"to fit {budget} tokens: {report.describe()}")
+    if report.tokens_after > budget:
+        logger.warning(f"Request [{request_id}] still exceeds the context budget of {completion_request.model} "
+                       f"after compaction ({report.tokens_after} > {budget} tokens), forwarding it anyway")
+    return report
+
+
+if orjson is not None:
+    def dumps_json(obj) -> bytes:
+        return orjson.dumps(obj)
+
+    def loads_json(data: Union[bytes, str]):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson 更严格（如不接受 NaN）且错误信息不同，出错时交给标准库，结果与错误信息保持不变
+            return json.loads(data)
+else:
+    _encode_json_string = json.encoder.encode_basestring_ascii
+
+    def dumps_json(obj) -> bytes:
+        if isinstance(obj, str):
+            return _encode_json_string(obj).encode()
+        return json.dumps(obj, separators=(",", ":")).encode()
+
+    loads_json = json.loads
+
+
+# SSE 分块合并统计：上游增量数与实际发送的帧数之差即为节省的帧数
+sse_frame_stats = {"upstream_deltas": 0, "frames_sent": 0}
+
+
+def resolve_flush_interval(request: Request) -> float:
+    """确定本次请求的 SSE 合并窗口（秒），请求头 X-SSE-Flush-Interval（毫秒）优先于部署配置"""
+    header = request.headers.get("x-sse-flush-interval")
+    if header is not None:
+        try:
+            return max(0.0, min(float(header), SSE_FLUSH_INTERVAL_MAX_MS)) / 1000
+        except ValueError:
+            logger.warning(f"Ignoring invalid X-SSE-Flush-Interval header: {header}")
+    return SSE_FLUSH_INTERVAL_MS / 1000
+
+
+class SSEChunkEncoder:
+    """按请求预先渲染 chat.completion.chunk 中不变的前后缀，每个分块只需转义增量文本"""
+
+    DONE = b"data: [DONE]\n\n"
+
+    def __init__(self, request_id: str, created: int, model: str):
+        self.base = {
+            "id": request_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "system_fingerprint": f"fp_{request_id}",
+        }
+        head = dumps_json(self.base)[:-1]
+        self._prefix = b"data: " + head + b',"choices":[{"delta":{"content":'
+        self._suffixes = {0: b'},"index":0,"finish_reason":null}]}\n\n'}
+
+    def content(self, text: str, index: int = 0) -> bytes:
+        suffix = self._suffixes.get(index)
+        if suffix is None:
+            suffix = self._suffixes[index] = b'},"index":%d,"finish_reason":null}]}\n\n' % index
+        return self._prefix + dumps_json(text) + suffix
+
+    def finish(self, finish_reason: str, usage: Optional[Dict[str, int]], index: int = 0) -> bytes:
+        end_chunk = dict(self.base)
+        end_chunk["choices"] = [{"delta": {}, "index": index, "finish_reason": finish_reason}]
+        if usage is not None:
+            end_chunk["usage"] = usage
+        return b"data: " + dumps_json(end_chunk) + b"\n\n"
+
+    @staticmethod
+    def error(error_response: Dict) -> bytes:
+        return b"data: " + dumps_json(error_response) + b"\n\n"
+
+
+class IncrementalTokenCounter:
+    """对流式增量逐块计数，无需保留全文：在空白处结算，最后一个空白之后的尾部与下一块拼接后再计数。
+    启发式与空白分词下结果与对完整文本计数一致，只有超过 TOKEN_CARRY_MAX 仍无空白的尾部会被强制结算"""
+
+    __slots__ = ("counted", "_carry", "_tokenizer")
+
+    def __init__(self):
+        self.counted = 0
+        self._carry = ""  # 尚未结算的尾部
+        self._tokenizer = get_tokenizer()
+
+    @property
+    def tokens(self) -> int:
+        return self.counted + (self._tokenizer.count(self._carry) if self._carry else 0)
+
+    @staticmethod
+    def _settle_point(text: str) -> int:
+        # 在最后一个空白之前结算，BPE 通常把空格与后面的单词编为一个 token
+        for index in range(len(text) - 1, max(0, len(text) - 1 - TOKEN_CARRY_MAX), -1):
+            if text[index].isspace():
+                return index
+        return len(text) if len(text) > TOKEN_CARRY_MAX else 0
+
+    def feed(self, text: str):
+        if text:
+            text = self._carry + text
+            cut = self._settle_point(text)
+            if cut:
+                self.counted += self._tokenizer.count(text[:cut])
+            self._carry = text[cut:]
+
+    def feed_until(self, text: str, limit: int) -> int:
+        """累加不超过 limit 个 token，返回 text 中可保留的前缀长度"""
+        if not text:
+            return 0
+        combined = self._carry + text
+        cut = self._settle_point(combined)
+        settled = self._tokenizer.count(combined[:cut]) if cut else 0
+        tail = combined[cut:]
+        if self.counted + settled + (self._tokenizer.count(tail) if tail else 0) <= limit:
+            self.counted += settled
+            self._carry = tail
+            return len(text)
+        end = self._tokenizer.truncate(combined, max(0, limit - self.counted)) - len(self._carry)
+        self.counted = limit
+        self._carry = ""
+        return max(0, end)
+
+
+class OutputLimiter:
+    """在代理端执行 max_tokens 与 stop 限制，达到限制后立即截断输出并结束上游流"""
+
+    def __init__(self, max_tokens: Optional[int], stop: Optional[Union[str, List[str]]]):
+        self.max_tokens = max_tokens if ENFORCE_OUTPUT_LIMITS and max_tokens else None
+        if isinstance(stop, str):
+            stop = [stop]
+        self.stops = [item for item in (stop or []) if item] if ENFORCE_OUTPUT_LIMITS else []
+        self.counter = IncrementalTokenCounter()
+        self.finish_reason: Optional[str] = None
+        self._pending = ""  # 可能是 stop 字符串前缀、暂缓发送的尾部
+
+    @property
+    def active(self) -> bool:
+        return self.max_tokens is not None or bool(self.stops)
+
+    def _hold_back(self, text: str) -> int:
+        # 文本末尾与某个 stop 字符串前缀重合的最大长度
+        longest = 0
+        for stop in self.stops:
+            for length in range(min(len(stop) - 1, len(text)), longest, -1):
+                if text.endswith(stop[:length]):
+                    longest = length
+                    break
+        return longest
+
+    def _limit_tokens(self, text: str) -> str:
+        if self.max_tokens is None or not text:
+            return text
+        end = self.counter.feed_until(text, self.max_tokens)
+        if end < len(text):
+            self.finish_reason = "length"
+            return text[:end]
+        return text
+
+    def feed(self, delta: str) -> str:
+        """输入一个增量，返回可以发送的文本；finish_reason 被设置后应停止读取上游"""
+        if self.finish_reason is not None:
+            return ""
+        text = self._pending + delta
+        self._pending = ""
+        if self.stops:
+            positions = [(text.find(stop), stop) for stop in self.stops]
+            hits = [position for position, _ in positions if position >= 0]
+            if hits:
+                emitted = self._limit_tokens(text[:min(hits)])
+                self.finish_reason = self.finish_reason or "stop"
+                return emitted
+            held = self._hold_back(text)
+            if held:
+                text, self._pending = text[:-held], text[-held:]
+        return self._limit_tokens(text)
+
+    def flush(self) -> str:
+        """上游正常结束时，发送暂缓的尾部"""
+        if self.finish_reason is not None:
+            return ""
+        text, self._pending = self._pending, ""
+        return self._limit_tokens(text)
+
+    def apply(self, text: str) -> str:
+        """对完整的非流式响应应用限制"""
+        return self.feed(text) + self.flush()
+
+
+def request_fingerprint(request: CompletionRequest, protocol_messages: List[ProtocolMessage]) -> str:
+    """对影响生成结果的请求字段做规范化哈希，作为缓存键"""
+    payload = {
+        "model": request.model,
+        "messages": [[msg.role, msg.content] + ([[item.url for item in msg.attachments]] if msg.attachments else [])
+                     for msg in protocol_messages],
+        "temperature": request.temperature,
+        "top_p": request.top_p,
+        "n": request.n,
+        "max_tokens": request.max_tokens,
+        "presence_penalty": request.presence_penalty,
+        "frequency_penalty": request.frequency_penalty,
+        "logit_bias": request.logit_bias,
+        "response_format": request.response_format,
+        "seed": request.seed,
+        "stop": request.stop,
+        "functions": request.functions,
+        "function_call": request.function_call,
+        "tools": request.tools,
+        "tool_choice": request.tool_choice,
+        "skip_system_prompt": request.skip_system_prompt,
+    }
+    canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class ResponseCache:
+    """完全相同请求的响应缓存：内存 LRU + TTL，可选 SQLite 持久化
+
+    缓存只是加速手段：持久化层出错（数据库被锁、磁盘已满等）时读取按未命中处理、写入直接放弃，
+    只记录日志与错误计数，不影响请求本身"""
+
+    def __init__(self, ttl: float, max_entries: int, max_bytes: int, sqlite_path: str = ""):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.errors = {"get": 0, "set": 0}
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (过期时间, 文本, 占用字节)
+        self._bytes = 0
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._writes = 0
+        if sqlite_path:
+            self._db = sqlite3.connect(sqlite_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    def is_cacheable(self, request: CompletionRequest) -> bool:
+        if request.n not in (None, 1):
+            return False
+        if "temperature" not in request.model_fields_set:
+            # 大多数客户端不传 temperature，未指定时视为不要求采样多样性，可以缓存
+            return True
+        temperature = request.temperature if request.temperature is not None else 1.0
+        return temperature <= RESPONSE_CACHE_MAX_TEMPERATURE
+
+    def _store_memory(self, key: str, expires_at: float, text: str):
+        size = sys.getsizeof(text)
+        if size > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= old[2]
+        self._entries[key] = (expires_at, text, size)
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, (_, _, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+
+    def _db_get(self, key: str) -> Optional[tuple]:
+        with self._db_lock:
+            return self._db.execute("SELECT value, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+
+    def _db_set(self, key: str, text: str, expires_at: float):
+        with self._db_lock:
+            self._db.execute("INSERT OR REPLACE INTO responses (key, value, expires_at) VALUES (?, ?, ?)",
+                             (key, text, expires_at))
+            self._writes += 1
+            if self._writes % 100 == 0:
+                self._db.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+            self._db.commit()
+
+    def _record_error(self, op: str, key: str, error: Exception):
+        self.errors[op] += 1
+        logger.warning(f"Response cache {op} failed for {key[:12]}: {type(error).__name__}: {error}")
+
+    async def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self._bytes -= entry[2]
+            del self._entries[key]
+        if self._db is not None:
+            # 磁盘读写放到线程池，避免阻塞事件循环
+            try:
+                row = await asyncio.to_thread(self._db_get, key)
+            except Exception as e:
+                self._record_error("get", key, e)
+                row = None
+            if row is not None and row[1] > now:
+                self._store_memory(key, row[1], row[0])
+                self.hits += 1
+                return row[0]
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, text: str):
+        expires_at = time.time() + self.ttl
+        self._store_memory(key, expires_at, text)
+        if self._db is not None:
+            try:
+                await asyncio.to_thread(self._db_set, key, text, expires_at)
+            except Exception as e:
+                self._record_error("set", key, e)
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "enabled": RESPONSE_CACHE_ENABLED,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "errors": dict(self.errors),
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "persistent": self._db is not None,
+        }
+
+
+response_cache = ResponseCache(
+    RESPONSE_CACHE_TTL,
+    RESPONSE_CACHE_MAX_ENTRIES,
+    RESPONSE_CACHE_MAX_BYTES,
+    RESPONSE_CACHE_SQLITE_PATH if RESPONSE_CACHE_ENABLED else "",
+)
+
+
+async def replay_cached_response(text: str):
+    """把缓存的完整响应切分为若干增量，按流式格式回放"""
+    for start in range(0, len(text), RESPONSE_CACHE_REPLAY_CHUNK_SIZE):
+        yield [text[start:start + RESPONSE_CACHE_REPLAY_CHUNK_SIZE]]
+
+
+class StreamFlight:
+    """一次在独立任务中进行的上游流式调用。
+
+    replay=True 时可被多个下游订阅，晚加入的订阅者会先补发已产生的增量；
+    replay=False 时只有一个订阅者，已消费的增量立即丢弃
+    """
+
+    def __init__(self, key: Optional[str], source, cleanup=None, replay: bool = True,
+                 route: Optional[BotRoute] = None):
+        self.key = key
+        self.replay = replay
+        self.route = route
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+        self._task = asyncio.create_task(self._run(source))
+        if cleanup is not None:
+            # 任务在开始迭代前就被取消时，生成器的 finally 不会执行，由回调兜底
+            self._task.add_done_callback(lambda _: cleanup())
+
+    async def _run(self, source):
+        try:
+            async for delta in source:
+                self.chunks.append(delta)
+                self._notify()
+        except asyncio.CancelledError:
+            self.error = asyncio.CancelledError()
+            raise
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+            single_flight.finish(self)
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def wake(self):
+        """唤醒所有订阅者，用于让断开连接的订阅者及时退出等待"""
+        self._notify()
+
+    def abandon(self):
+        """响应结束时仍无人订阅（例如客户端在开始读取前断开），取消上游调用"""
+        if self.subscribers == 0 and not self.done:
+            single_flight.finish(self)
+            self._task.cancel()
+
+    def _buffered_size(self, index: int) -> int:
+        return sum(len(chunk) for chunk in self.chunks[index:])
+
+    async def subscribe(self, disconnected: Optional[asyncio.Event] = None,
+                        flush_interval: float = 0, flush_bytes: int = 0):
+        """按批产出增量列表。
+
+        flush_interval > 0 时首批立即发出，之后的增量在时间窗口内合并，
+        窗口到期或累计长度达到 flush_bytes 时才发出下一批
+        """
+        self.subscribers += 1
+        index = 0
+        last_flush = None
+        try:
+            while True:
+                if index < len(self.chunks) and flush_interval > 0 and last_flush is not None:
+                    deadline = last_flush + flush_interval
+                    while not self.done and not (disconnected is not None and disconnected.is_set()):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0 or (flush_bytes and self._buffered_size(index) >= flush_bytes):
+                            break
+                        try:
+                            await asyncio.wait_for(self._changed.wait(), remaining)
+                        except asyncio.TimeoutError:
+                            break
+                if index < len(self.chunks):
+                    if self.replay:
+                        batch = self.chunks[index:]
+                        index = len(self.chunks)
+                    else:
+                        batch, self.chunks = self.chunks, []
+                    yield batch
+                    last_flush = time.monotonic()
+                    continue
+                if disconnected is not None and disconnected.is_set():
+                    return
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self._changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                # 最后一个订阅者离开，取消上游调用；先注销，避免新请求加入正在取消的调用
+                single_flight.finish(self)
+                self._task.cancel()
+
+
+class CallFlight:
+    """一次进行中的上游非流式调用，所有等待者共享同一个结果"""
+
+    def __init__(self, key: str, coro, cleanup=None, route: Optional[BotRoute] = None):
+        self.key = key
+        self.route = route
+        self.waiters = 0
+        self._task = asyncio.create_task(coro)
+        if cleanup is not None:
+            self._task.add_done_callback(lambda _: cleanup())
+        self._task.add_done_callback(lambda _: single_flight.finish(self))
+
+    async def wait(self) -> str:
+        self.waiters += 1
+        try:
+            return await asyncio.shield(self._task)
+        finally:
+            self.waiters -= 1
+            if self.waiters == 0 and not self._task.done():
+                single_flight.finish(self)
+                self._task.cancel()
+
+
+class SingleFlight:
+    """按请求指纹登记进行中的上游调用，相同请求加入已有调用而不是重新请求 Poe"""
+
+    def __init__(self):
+        self.flights: Dict[str, Union[StreamFlight, CallFlight]] = {}
+        self.started = 0
+        self.joined = 0
+
+    def is_coalescable(self, request: CompletionRequest) -> bool:
+        if request.n not in (None, 1):
+            return False
+        temperature = request.temperature if request.temperature is not None else 1.0
+        return temperature <= REQUEST_COALESCING_MAX_TEMPERATURE
+
+    def get(self, key: str):
+        flight = self.flights.get(key)
+        if flight is not None:
+            self.joined += 1
+        return flight
+
+    def start_stream(self, key: Optional[str], source, cleanup=None, replay: bool = True,
+                     route: Optional[BotRoute] = None) -> StreamFlight:
+        flight = StreamFlight(key, source, cleanup, replay, route)
+        if key is not None:
+            self.flights[key] = flight
+            self.started += 1
+        return flight
+
+    def start_call(self, key: str, coro, cleanup=None, route: Optional[BotRoute] = None) -> CallFlight:
+        flight = CallFlight(key, coro, cleanup, route)
+        self.flights[key] = flight
+        self.started += 1
+        return flight
+
+    def finish(self, flight):
+        if self.flights.get(flight.key) is flight:
+            del self.flights[flight.key]
+
+
+single_flight = SingleFlight()
+
+
+# 各模型流式响应总耗时的指数加权平均，用于估算客户端断开后节省的时间
+model_stream_duration: Dict[str, float] = {}
+
+
+def record_stream_duration(model: str, duration: float):
+    previous = model_stream_duration.get(model)
+    model_stream_duration[model] = duration if previous is None else previous + KEY_EWMA_ALPHA * (duration - previous)
+
+
+async def watch_disconnect(request: Request, disconnected: asyncio.Event, flights: List[StreamFlight]):
+    """轮询客户端连接状态，断开后通知订阅者退出，从而取消上游调用"""
+    while not disconnected.is_set():
+        await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+        if await request.is_disconnected():
+            disconnected.set()
+            for flight in flights:
+                flight.wake()
+
+
+class ChoiceStreams:
+    """交错合并 n 个 choice 的订阅流，按到达顺序产出 (index, 批次)；stop(index) 提前结束其中一路。
+    只有一路时直接迭代，不经过队列"""
+
+    def __init__(self, sources):
+        self.sources = sources
+        self.active = set(range(len(sources)))
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    async def _pump(self, index: int, source):
+        try:
+            async for batch in source:
+                self._queue.put_nowait((index, batch, None))
+            self._queue.put_nowait((index, None, None))
+        except Exception as e:
+            self._queue.put_nowait((index, None, e))
+
+    def stop(self, index: int):
+        self.active.discard(index)
+        if self._tasks:
+            # 取消订阅即取消该 choice 的上游调用
+            self._tasks[index].cancel()
+
+    async def __aiter__(self):
+        if len(self.sources) == 1:
+            async for batch in self.sources[0]:
+                yield 0, batch
+                if not self.active:
+                    return
+            return
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._pump(index, source)) for index, source in enumerate(self.sources)]
+        while self.active:
+            index, batch, error = await self._queue.get()
+            if index not in self.active:
+                continue
+            if error is not None:
+                raise error
+            if batch is None:
+                self.active.discard(index)
+                continue
+            yield index, batch
+
+    async def aclose(self):
+        for task in self._tasks:
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        for source in self.sources:
+            await source.aclose()
+
+
+async def probe_token(token: str) -> str:
+    """向 Poe 发送一次探测请求，验证密钥是否可用"""
+    try:
+        request = CompletionRequest(
+            model="GPT-4o",
+            messages=[Message(role="user", content="Please return 'OK'")],
+            temperature=0.7
+        )
+        ret = await asyncio.wait_for(get_responses(request, token), KEY_VALIDATION_TIMEOUT)
+        if ret == "OK":
+            return "ok"
+        logger.error(f"Failed to add apikey: {token[:6]}..., response: {ret}")
+        return "failed"
+    except asyncio.TimeoutError:
+        logger.error(f"Validation of apikey {token[:6]}... timed out after {KEY_VALIDATION_TIMEOUT}s")
+        return "failed: timeout"
+    except Exception as exception:
+        logger.error(f"Failed to connect to poe due to {str(exception)}")
+        if isinstance(exception, BotError):
+            try:
+                error_json = json.loads(exception.text)
+                return f"failed: {json.dumps(error_json)}"
+            except json.JSONDecodeError:
+                return f"failed: {str(exception)}"
+        return f"failed: {str(exception)}"
+
+
+async def add_token(token: str):
+    if not token:
+        logger.error("Empty token provided")
+        return "failed: empty token"
+
+    if token not in key_pool:
+        logger.debug(f"Attempting to add apikey: {token[:6]}...")  # 只记录前6位
+        ret = await probe_token(token)
+        if ret == "ok":
+            key_pool.add(token)
+            logger.info(f"API key {token[:6]}... added successfully")
+        return ret
+    else:
+        logger.debug(f"API key {token[:6]}... already exists")
+        return "exist"
+
+
+async def get_responses(request: CompletionRequest, token: str):
+    if not token:
+        raise HTTPException(status_code=400, detail="Token is required")
+
+    model_lower = request.model.lower()
+    if model_lower in bot_names_map:
+        request.model = bot_names_map[model_lower]
+        message = [
+            ProtocolMessage(role=msg.role if msg.role in ["user", "system"] else "bot", content=msg.content)
+            for msg in request.messages
+        ]
+        query = build_query(request, message)
+        try:
+            return await get_final_response(query, bot_name=request.model, api_key=token, session=proxy,
+                                            base_url=POE_BASE_URL)
+        except Exception as e:
+            logger.error(f"Error in get_final_response: {str(e)}")
+            raise HTTPException(status_code=500, detail=str(e))
+    else:
+        raise HTTPException(status_code=400, detail=f"Model {request.model} is not supported")
+
+
+def build_query(request: CompletionRequest, protocol_messages: List[ProtocolMessage]) -> QueryRequest:
+    additional_params = {
+        "temperature": request.temperature,
+        "skip_system_prompt": request.skip_system_prompt if request.skip_system_prompt is not None else False,
+        "logit_bias": request.logit_bias if request.logit_bias is not None else {},
+        "stop_sequences": request.stop if request.stop is not None else []
+    }
+    return QueryRequest(
+        query=protocol_messages,
+        user_id="",
+        conversation_id="",
+        message_id="",
+        version="1.0",
+        type="query",
+        **additional_params
+    )
+
+
+async def failover_lease(error: BaseException, lease: KeyLease, attempt: int, deadline: float, tried: set,
+                         request_id: str, route: BotRoute) -> KeyLease:
+    """决定失败后是否重试：虚拟模型还有备选机器人时立即换下一个机器人，否则可重试时退避并换一个密钥，
+    返回新的租约；不再重试时重新抛出原异常"""
+    if is_cancellation(error) or attempt >= route.max_retries:
+        raise error
+    failed_bot = route.bot
+    if route.advance():
+        delay = 0.0
+        target = f"bot {route.bot}"
+    elif not is_retryable_error(error) or attempt >= MAX_RETRIES:
+        raise error
+    else:
+        delay = retry_backoff(attempt)
+        target = "another key"
+    if time.monotonic() + delay >= deadline:
+        raise error
+    logger.warning(f"Request [{request_id}] failed before first byte on {failed_bot} "
+                   f"({type(error).__name__}: {str(error)[:200]}), retrying on {target} in {delay:.2f}s "
+                   f"(retry {attempt + 1}/{route.max_retries})")
+    await asyncio.sleep(delay)
+    return await key_pool.acquire(exclude=tried, timeout=min(KEY_QUEUE_TIMEOUT, deadline - time.monotonic()),
+                                  model=route.bot, tenant=lease.tenant, weight=lease.weight)
+
+
+async def get_responses_with_failover(request: CompletionRequest, protocol_messages: List[ProtocolMessage],
+                                      lease: KeyLease, request_id: str, route: BotRoute) -> str:
+    """非流式调用 Poe，失败时换机器人或密钥重试，整体耗时不超过 TIMEOUT"""
+    query = build_query(request, protocol_messages)
+    deadline = time.monotonic() + TIMEOUT
+    tried = set()
+    attempt = 0
+    while True:
+        tried.add(lease.token)
+        try:
+            response = await asyncio.wait_for(
+                get_final_response(query, bot_name=route.bot, api_key=lease.token, session=proxy,
+                                   base_url=POE_BASE_URL),
+                max(0.0, deadline - time.monotonic())
+            )
+        except BaseException as e:
+            lease.release(e)
+            if isinstance(e, asyncio.TimeoutError):
+                e = asyncio.TimeoutError(f"Poe request timed out after {TIMEOUT}s")
+            else:
+                logger.error(f"Error in get_final_response: {str(e)}")
+            lease = await failover_lease(e, lease, attempt, deadline, tried, request_id, route)
+            attempt += 1
+            continue
+        lease.release()
+        route.mark_served(lease.state.fingerprint)
+        return response
+
+
+ELAPSED_TIME_PATTERN = re.compile(r" \(\d+s elapsed\)$")
+STATUS_MESSAGES = ("Thinking...", "Generating image...")
+
+
+async def filter_deltas(upstream, lease: KeyLease):
+    """过滤 Poe 的状态消息与计时后缀并去重，产出真正的文本增量；首个增量到达时记录首字延迟"""
+    last_sent_base_content = None
+    try:
+        async for partial in upstream:
+            if partial and partial.text:
+                base_content = ELAPSED_TIME_PATTERN.sub("", partial.text)
+
+                # 先去掉计时后缀再判断，"Thinking... (3s elapsed)" 同样属于状态消息
+                if base_content.strip() in STATUS_MESSAGES:
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f"Skipping status message: {partial.text}")
+                    continue
+
+                if last_sent_base_content == base_content:
+                    continue
+
+                lease.mark_first_token()
+                yield base_content
+                last_sent_base_content = base_content
+    finally:
+        # 主动关闭上游生成器，及时断开与 Poe 的连接
+        await upstream.aclose()
+
+
+def open_stream(protocol_messages: List[ProtocolMessage], bot_name: str, lease: KeyLease):
+    upstream = get_bot_response(protocol_messages, bot_name=bot_name, api_key=lease.token, session=proxy,
+                                base_url=POE_BASE_URL)
+    return filter_deltas(upstream, lease)
+
+
+def start_hedge(protocol_messages: List[ProtocolMessage], bot_name: str, lease: KeyLease, tried: set,
+                request_id: str):
+    """在尚未尝试过的密钥上发起对冲调用；预算不足或没有空闲密钥时返回 None"""
+    if not hedge_policy.has_budget():
+        HEDGES_SKIPPED.inc((bot_name, "budget"))
+        return None
+    hedge_lease = key_pool.try_acquire(tried, model=lease.model, tenant=lease.tenant, weight=lease.weight)
+    if hedge_lease is None:
+        HEDGES_SKIPPED.inc((bot_name, "no_key"))
+        return None
+    hedge_policy.spend()
+    tried.add(hedge_lease.token)
+    HEDGES_FIRED.inc((bot_name,))
+    logger.info(f"Request [{request_id}] has no first token from key {lease.state.fingerprint} after "
+                f"{time.monotonic() - lease.started:.2f}s, hedging on key {hedge_lease.state.fingerprint}")
+    return open_stream(protocol_messages, bot_name, hedge_lease), hedge_lease
+
+
+async def race_first_delta(stream, lease: KeyLease, protocol_messages: List[ProtocolMessage], bot_name: str,
+                           tried: set, request_id: str):
+    """等待首个增量，超过对冲阈值仍未到达时在另一个密钥上并行发起调用，先产出首个增量的一方胜出，另一方被取消。
+    返回 (胜出的流, 其租约, 首个增量；流为空时为 None)，全部失败时各租约均已释放并抛出最后一个异常"""
+    attempts = {asyncio.ensure_future(stream.__anext__()): (stream, lease)}
+    hedge_lease = None
+    last_error = None
+    try:
+        await asyncio.wait(attempts, timeout=hedge_policy.delay(bot_name))
+        if not any(task.done() for task in attempts):
+            hedge = start_hedge(protocol_messages, bot_name, lease, tried, request_id)
+            if hedge is not None:
+                hedge_stream, hedge_lease = hedge
+                attempts[asyncio.ensure_future(hedge_stream.__anext__())] = hedge
+        while attempts:
+            done, _ = await asyncio.wait(attempts, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                candidate, candidate_lease = attempts.pop(task)
+                error = task.exception()
+                if error is None or isinstance(error, StopAsyncIteration):
+                    if candidate_lease is hedge_lease:
+                        HEDGES_WON.inc((bot_name,))
+                        logger.info(f"Hedged attempt won for request [{request_id}]")
+                    return candidate, candidate_lease, (task.result() if error is None else None)
+                candidate_lease.release(error)
+                await candidate.aclose()
+                last_error = error
+        raise last_error
+    finally:
+        # 取消落败或尚未完成的一方；先同步归还密钥，避免本任务被取消时泄漏租约
+        for task, (candidate, candidate_lease) in attempts.items():
+            candidate_lease.release(asyncio.CancelledError())
+            task.cancel()
+        if attempts:
+            await asyncio.gather(*attempts, return_exceptions=True)
+            for candidate, _ in attempts.values():
+                await candidate.aclose()
+
+
+async def stream_with_failover(protocol_messages: List[ProtocolMessage], route: BotRoute,
+                               lease: KeyLease, request_id: str, hedge: bool = False):
+    """流式调用 Poe 并产出过滤后的文本增量；在首个增量发出前失败时换机器人或密钥重试，
+    启用对冲时首个增量迟迟未到会在另一个密钥上并行发起第二次调用"""
+    deadline = time.monotonic() + TIMEOUT
+    tried = set()
+    attempt = 0
+    while True:
+        tried.add(lease.token)
+        sent = False
+        stream = open_stream(protocol_messages, route.bot, lease)
+        try:
+            if hedge:
+                stream, lease, first = await race_first_delta(stream, lease, protocol_messages, route.bot,
+                                                              tried, request_id)
+                if first is not None:
+                    sent = True
+                    route.mark_served(lease.state.fingerprint)
+                    yield first
+            async for base_content in stream:
+                if not sent:
+                    sent = True
+                    route.mark_served(lease.state.fingerprint)
+                yield base_content
+        except BaseException as e:
+            lease.release(e)
+            if sent:
+                raise
+            lease = await failover_lease(e, lease, attempt, deadline, tried, request_id, route)
+            attempt += 1
+            continue
+        finally:
+            await stream.aclose()
+        lease.release()
+        return
+
+
+def error_body(message: str, error_type: str, code: Optional[str] = None, param: Optional[str] = None,
+               **extra) -> Dict:
+    return {"error": {"message": message, "type": error_type, "param": param, "code": code, **extra}}
+
+
+def rate_limit_response(error: RateLimitExceeded) -> JSONResponse:
+    return JSONResponse(
+        status_code=429,
+        content=error_body(str(error), "requests", "rate_limit_exceeded"),
+        headers={"Retry-After": str(max(1, math.ceil(error.retry_after)))}
+    )
+
+
+def resolve_model(model: str) -> Tuple[Optional[str], Optional[VirtualModel]]:
+    """返回规范化的模型名与对应的虚拟模型（普通机器人为 None），未知模型返回 (None, None)"""
+    virtual_model = bot_router.get(model)
+    if virtual_model is not None:
+        return virtual_model.name, virtual_model
+    return bot_names_map.get(model.lower()), None
+
+
+class ProtocolMessageCache:
+    """按 (角色, 内容) 复用 ProtocolMessage：智能体类客户端每轮都会重发完整的历史消息，构造 pydantic 对象
+    是解析请求时最大的开销，复用后只需为新消息构造。fastapi_poe 只会序列化这些对象，可以在请求间共享"""
+
+    def __init__(self, max_entries: int, max_chars: int):
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self.chars = 0
+        self._entries: OrderedDict = OrderedDict()
+
+    def clear(self):
+        self._entries.clear()
+        self.chars = 0
+
+    def convert(self, messages: List[Message]) -> List[ProtocolMessage]:
+        entries = self._entries
+        result = []
+        for msg in messages:
+            role = msg.role if msg.role in ("user", "system") else "bot"
+            content = msg.get_content_text()
+            key = (role, content)
+            protocol_message = entries.get(key)
+            if protocol_message is not None:
+                entries.move_to_end(key)
+            else:
+                protocol_message = ProtocolMessage(role=role, content=content)
+                if self.max_entries > 0 and len(content) <= self.max_chars:
+                    entries[key] = protocol_message
+                    self.chars += len(content)
+                    while len(entries) > self.max_entries or self.chars > self.max_chars:
+                        (_, evicted), _ = entries.popitem(last=False)
+                        self.chars -= len(evicted)
+            result.append(protocol_message)
+        return result
+
+
+protocol_message_cache = ProtocolMessageCache(PROTOCOL_MESSAGE_CACHE_SIZE, PROTOCOL_MESSAGE_CACHE_MAX_CHARS)
+
+
+def to_protocol_messages(messages: List[Message]) -> List[ProtocolMessage]:
+    return protocol_message_cache.convert(messages)
+
+
+class AttachmentError(ValueError):
+    """内容块中的附件无法识别或超出大小限制"""
+
+
+class AttachmentSource:
+    """image_url / file 内容块描述的附件：内联的 base64 数据（data URL）或远程 URL"""
+
+    __slots__ = ("url", "data", "content_type", "name")
+
+    def __init__(self, url: Optional[str] = None, data: Optional[str] = None, content_type: str = "",
+                 name: str = ""):
+        self.url = url
+        self.data = data  # base64 文本，解码推迟到确实需要上传时
+        self.content_type = content_type
+        self.name = name
+
+    def cache_key(self) -> str:
+        # 内联数据按内容哈希，远程文件按 URL 哈希（由 Poe 下载，代理不读取内容）
+        if self.data is not None:
+            return "data:" + hashlib.sha256(self.data.encode()).hexdigest()
+        return "url:" + hashlib.sha256(self.url.encode()).hexdigest()
+
+    def decode(self) -> bytes:
+        try:
+            data = base64.b64decode(self.data, validate=True)
+        except (binascii.Error, ValueError):
+            raise AttachmentError(f"Attachment {self.name} is not valid base64 data")
+        if len(data) > ATTACHMENT_MAX_BYTES:
+            raise AttachmentError(f"Attachment {self.name} is larger than {ATTACHMENT_MAX_BYTES} bytes")
+        return data
+
+
+def parse_data_url(value: str, name: str) -> AttachmentSource:
+    header, sep, payload = value.partition(",")
+    if not sep or not header.endswith(";base64"):
+        raise AttachmentError("Only base64 data URLs are supported for attachments")
+    if len(payload) * 3 // 4 > ATTACHMENT_MAX_BYTES:
+        raise AttachmentError(f"Attachment {name} is larger than {ATTACHMENT_MAX_BYTES} bytes")
+    content_type = header[len("data:"):-len(";base64")] or "application/octet-stream"
+    if "." not in name:
+        name += mimetypes.guess_extension(content_type) or ""
+    return AttachmentSource(data=payload, content_type=content_type, name=name)
+
+
+def attachment_sources(message: Message) -> List[AttachmentSource]:
+    """提取消息中的 image_url 与 file 内容块，文本块由 get_content_text 处理"""
+    if not isinstance(message.content, list):
+        return []
+    sources = []
+    for index, part in enumerate(message.content):
+        part_type = part.get("type")
+        if part_type == "image_url":
+            image = part.get("image_url")
+            url = image.get("url") if isinstance(image, dict) else image
+            name = f"image-{index}"
+        elif part_type == "file":
+            file = part.get("file") if isinstance(part.get("file"), dict) else {}
+            if file.get("file_id"):
+                raise AttachmentError("Files referenced by file_id are not supported, send file_data instead")
+            url = file.get("file_data") or file.get("file_url")
+            name = file.get("filename") or f"file-{index}"
+            if isinstance(url, str) and url and not url.startswith(("data:", "http://", "https://")):
+                # file_data 也可以是不带前缀的 base64
+                url = f"data:{mimetypes.guess_type(name)[0] or 'application/octet-stream'};base64,{url}"
+        else:
+            continue
+        if not isinstance(url, str) or not url:
+            raise AttachmentError(f"Content part {index} of type {part_type} has no url or data")
+        if url.startswith("data:"):
+            sources.append(parse_data_url(url, name))
+        elif url.startswith(("http://", "https://")):
+            sources.append(AttachmentSource(url=url, name=url.rsplit("/", 1)[-1].split("?", 1)[0] or name))
+        else:
+            raise AttachmentError(f"Unsupported attachment URL in content part {index}")
+    return sources
+
+
+class AttachmentCache:
+    """内容哈希 -> 已上传到 Poe 的附件：多轮对话每轮重发同一张截图或文档时只上传一次。
+    条目在 ttl 后过期，超过 max_entries 时淘汰最久未用的；相同内容的并发上传合并为一次"""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()  # key -> (过期时间, Attachment)
+        self._uploads: Dict[str, asyncio.Task] = {}
+
+    async def get(self, key: str, upload: Callable[[], Awaitable[Attachment]]) -> Attachment:
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                ATTACHMENTS.inc(("hit",))
+                return entry[1]
+            del self._entries[key]
+        task = self._uploads.get(key)
+        if task is None:
+            ATTACHMENTS.inc(("upload",))
+            task = self._uploads[key] = asyncio.ensure_future(upload())
+            task.add_done_callback(lambda done: self._finish(key, done))
+        else:
+            ATTACHMENTS.inc(("hit",))
+        # 发起上传的请求被取消时上传继续进行，结果留给后续请求复用
+        return await asyncio.shield(task)
+
+    def _finish(self, key: str, task: asyncio.Task):
+        self._uploads.pop(key, None)
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            ATTACHMENTS.inc(("error",))
+            return
+        if self.max_entries > 0:
+            self._entries[key] = (time.monotonic() + self.ttl, task.result())
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+attachment_cache = AttachmentCache(ATTACHMENT_CACHE_TTL, ATTACHMENT_CACHE_SIZE)
+attachment_upload_slots = asyncio.Semaphore(max(1, ATTACHMENT_UPLOAD_CONCURRENCY))
+
+
+async def upload_attachment(source: AttachmentSource) -> Attachment:
+    token = key_pool.pick_token()
+    if token is None:
+        raise HTTPException(status_code=500, detail="No valid API tokens available")
+    data = None
+    if source.data is not None:
+        data = (await asyncio.to_thread(source.decode) if len(source.data) >= ATTACHMENT_THREAD_THRESHOLD
+                else source.decode())
+    kwargs = {"proxy": PROXY} if PROXY else {}
+    async with attachment_upload_slots:
+        started = time.monotonic()
+        # upload_file 结束时会关闭传入的客户端，因此不能使用共享连接池，每次上传使用独立的客户端
+        attachment = await upload_file(
+            file=data, file_url=source.url, file_name=source.name, api_key=token,
+            session=AsyncClient(timeout=httpx.Timeout(TIMEOUT, connect=HTTP_CONNECT_TIMEOUT), **kwargs),
+            on_error=lambda e, msg: logger.warning(f"Attachment upload attempt failed: {msg}"),
+            base_url=POE_UPLOAD_URL
+        )
+    logger.info(f"Uploaded attachment {source.name} ({len(data) if data is not None else 'remote'} bytes) "
+                f"to Poe in {time.monotonic() - started:.2f}s")
+    return attachment
+
+
+async def build_protocol_messages(messages: List[Message]) -> List[ProtocolMessage]:
+    """转换为 Poe 协议消息，并把图片与文件内容块作为附件附加；同一请求中的多个附件并发上传"""
+    protocol_messages = to_protocol_messages(messages)
+    if not ATTACHMENTS_ENABLED:
+        return protocol_messages
+    sources = [(position, attachment_sources(msg)) for position, msg in enumerate(messages)
+               if isinstance(msg.content, list)]
+    sources = [(position, items) for position, items in sources if items]
+    if not sources:
+        return protocol_messages
+
+    async def resolve(source: AttachmentSource) -> Attachment:
+        # 大块内联数据的哈希也放到线程中计算
+        if source.data is not None and len(source.data) >= ATTACHMENT_THREAD_THRESHOLD:
+            key = await asyncio.to_thread(source.cache_key)
+        else:
+            key = source.cache_key()
+        return await attachment_cache.get(key, lambda: upload_attachment(source))
+
+    results = await asyncio.gather(*(resolve(source) for _, items in sources for source in items))
+    protocol_messages = list(protocol_messages)
+    offset = 0
+    for position, items in sources:
+        # 复用的 ProtocolMessage 在请求间共享，附加附件时复制一份
+        protocol_messages[position] = protocol_messages[position].model_copy(
+            update={"attachments": list(results[offset:offset + len(items)])})
+        offset += len(items)
+    return protocol_messages
+
+
+class CompletionPlan:
+    """响应缓存与请求合并的查找结果：决定由缓存、进行中的相同调用还是新的上游调用提供响应"""
+
+    def __init__(self):
+        self.cache_key: Optional[str] = None
+        self.cached_response: Optional[str] = None
+        self.headers: Dict[str, str] = {}
+        self.coalesce_key: Optional[str] = None
+        self.flight: Optional[Union[StreamFlight, CallFlight]] = None
+        self.store_in_cache = False
+
+
+def request_details(request_id: str, routes=(), plan: Optional[CompletionPlan] = None,
+                    compaction: Optional[CompactionReport] = None) -> Optional[Dict]:
+    """请求日志中模型、耗时与 token 数之外的字段；未开启请求日志时返回 None，不产生额外开销"""
+    if not request_log.enabled:
+        return None
+    details = {"request_id": request_id}
+    served = [route for route in routes if route is not None and route.served is not None]
+    if served:
+        details["bots"] = [route.served for route in served]
+        details["keys"] = [route.key for route in served]
+    if plan is not None:
+        if plan.cached_response is not None:
+            details["cache"] = "hit"
+        elif plan.flight is not None:
+            details["coalesced"] = True
+    if compaction is not None:
+        details["compaction"] = {
+            "tokens_before": compaction.tokens_before,
+            "tokens_after": compaction.tokens_after,
+            "dropped": compaction.dropped,
+            "truncated": compaction.truncated,
+            "bytes_saved": sum(compaction.bytes_saved.values()),
         }
+    return details
 
-def count_tokens(text: str) -> int:
-    # 这是一个简单的token计数估算
-    # 实际应用中可以使用更准确的分词器
-    return len(text.split())
 
-def calculate_usage(messages: List[Message], response_text: str) -> Dict[str, int]:
-    prompt_tokens = sum(count_tokens(msg.get_content_text()) for msg in messages)
-    completion_tokens = count_tokens(response_text)
-    total_tokens = prompt_tokens + completion_tokens
-    return {
-        "prompt_tokens": prompt_tokens,
-        "completion_tokens": completion_tokens,
-        "total_tokens": total_tokens
-    }
+async def plan_completion(completion_request: CompletionRequest, protocol_messages: List[ProtocolMessage],
+                          cache_control: str, request_id: str) -> CompletionPlan:
+    plan = CompletionPlan()
+    # 响应缓存：Cache-Control: no-cache 跳过读取，no-store 跳过写入
+    fingerprint = None
+    if RESPONSE_CACHE_ENABLED and response_cache.is_cacheable(completion_request):
+        fingerprint = request_fingerprint(completion_request, protocol_messages)
+        plan.cache_key = fingerprint
+        if "no-cache" not in cache_control:
+            plan.cached_response = await response_cache.get(plan.cache_key)
+        plan.headers["X-Cache"] = "HIT" if plan.cached_response is not None else "MISS"
+        if "no-store" in cache_control:
+            plan.cache_key = None
 
-async def add_token(token: str):
-    global api_key_cycle
-    if not token:
-        logger.error("Empty token provided")
-        return "failed: empty token"
+    # 请求合并：相同请求正在进行时直接订阅其结果
+    if plan.cached_response is None and REQUEST_COALESCING_ENABLED and single_flight.is_coalescable(completion_request):
+        fingerprint = fingerprint or request_fingerprint(completion_request, protocol_messages)
+        plan.coalesce_key = ("stream:" if completion_request.stream else "final:") + fingerprint
+        plan.flight = single_flight.get(plan.coalesce_key)
+    # 只有发起上游调用的请求负责写缓存
+    plan.store_in_cache = bool(plan.cache_key) and plan.cached_response is None and plan.flight is None
 
-    if token not in client_dict:
-        try:
-            logger.debug(f"Attempting to add apikey: {token[:6]}...")  # 只记录前6位
-            request = CompletionRequest(
-                model="GPT-4o",
-                messages=[Message(role="user", content="Please return 'OK'")],
-                temperature=0.7
-            )
-            ret = await get_responses(request, token)
-            if ret == "OK":
-                client_dict[token] = token
-                api_key_cycle = itertools.cycle(client_dict.values())
-                logger.info(f"API key {token[:6]}... added successfully")
-                return "ok"
-            else:
-                logger.error(f"Failed to add apikey: {token[:6]}..., response: {ret}")
-                return "failed"
-        except Exception as exception:
-            logger.error(f"Failed to connect to poe due to {str(exception)}")
-            if isinstance(exception, BotError):
-                try:
-                    error_json = json.loads(exception.text)
-                    return f"failed: {json.dumps(error_json)}"
-                except json.JSONDecodeError:
-                    return f"failed: {str(exception)}"
-            return f"failed: {str(exception)}"
-    else:
-        logger.debug(f"API key {token[:6]}... already exists")
-        return "exist"
+    if plan.cached_response is not None:
+        logger.info(f"Serving request [{request_id}] with model {completion_request.model} from response cache")
+    elif plan.flight is not None:
+        logger.info(f"Request [{request_id}] joined an identical in-flight request for model {completion_request.model}")
+    return plan
 
 
-async def get_responses(request: CompletionRequest, token: str):
-    if not token:
-        raise HTTPException(status_code=400, detail="Token is required")
+async def acquire_routes(model: str, count: int, tenant: str, weight: int,
+                         request_id: str) -> List[Tuple[BotRoute, KeyLease]]:
+    """为 count 个 choice 各选择机器人并占用一个密钥（按负载依次挑选，自然分散到不同密钥），
+    任一占用失败时归还已占用的密钥"""
+    acquired = []
+    try:
+        for _ in range(count):
+            # 虚拟模型按各机器人的实时健康度排列候选，普通模型只有自身一个候选
+            route = bot_router.route(model)
+            lease = await key_pool.acquire(model=route.bot, tenant=tenant, weight=weight)
+            acquired.append((route, lease))
+            logger.info(f"Processing request [{request_id}] with model {model} on bot {route.bot} "
+                        f"and key {lease.state.fingerprint}")
+    except BaseException:
+        for _, lease in acquired:
+            lease.release(asyncio.CancelledError())
+        raise
+    return acquired
 
-    model_lower = request.model.lower()
-    if model_lower in bot_names_map:
-        request.model = bot_names_map[model_lower]
-        message = [
-            ProtocolMessage(role=msg.role if msg.role in ["user", "system"] else "bot", content=msg.content)
-            for msg in request.messages
-        ]
-        additional_params = {
-            "temperature": request.temperature,
-            "skip_system_prompt": request.skip_system_prompt if request.skip_system_prompt is not None else False,
-            "logit_bias": request.logit_bias if request.logit_bias is not None else {},
-            "stop_sequences": request.stop if request.stop is not None else []
-        }
-        query = QueryRequest(
-            query=message,
-            user_id="",
-            conversation_id="",
-            message_id="",
-            version="1.0",
-            type="query",
-            **additional_params
+
+async def complete_choices(completion_request: CompletionRequest, protocol_messages: List[ProtocolMessage],
+                           tenant: str, weight: int, request_id: str) -> List[Tuple[str, BotRoute]]:
+    """并发获取 n 个非流式回复，任一失败时取消其余调用"""
+    acquired = await acquire_routes(completion_request.model, completion_request.n or 1, tenant, weight, request_id)
+    tasks = []
+    for route, lease in acquired:
+        task = asyncio.ensure_future(
+            get_responses_with_failover(completion_request, protocol_messages, lease, request_id, route))
+        # 任务在开始执行前就被取消时由回调归还密钥
+        task.add_done_callback(lambda _, lease=lease: lease.release(asyncio.CancelledError()))
+        tasks.append(task)
+    try:
+        responses = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    return [(response, route) for response, (route, _) in zip(responses, acquired)]
+
+
+async def complete_non_stream(completion_request: CompletionRequest, protocol_messages: List[ProtocolMessage],
+                              plan: CompletionPlan, tenant: str, weight: int, request_id: str,
+                              created_time: int, started: float,
+                              compaction: Optional[CompactionReport] = None) -> Tuple[Dict, Dict[str, str]]:
+    """执行一次非流式补全，返回 chat.completion 响应体与响应头；HTTP 接口与批量补全共用"""
+    logger.info(f"Starting non-stream response for request [{request_id}]")
+    headers = dict(plan.headers)
+    if plan.cached_response is not None:
+        results = [(plan.cached_response, None)]
+    elif plan.flight is not None:
+        results = [(await plan.flight.wait(), plan.flight.route)]
+    elif plan.coalesce_key:
+        (route, lease), = await acquire_routes(completion_request.model, 1, tenant, weight, request_id)
+        flight = single_flight.start_call(
+            plan.coalesce_key,
+            get_responses_with_failover(completion_request, protocol_messages, lease, request_id, route),
+            cleanup=lease.release,
+            route=route
         )
-        try:
-            return await get_final_response(query, bot_name=request.model, api_key=token, session=proxy)
-        except Exception as e:
-            logger.error(f"Error in get_final_response: {str(e)}")
-            raise HTTPException(status_code=500, detail=str(e))
+        results = [(await flight.wait(), route)]
     else:
-        raise HTTPException(status_code=400, detail=f"Model {request.model} is not supported")
+        results = await complete_choices(completion_request, protocol_messages, tenant, weight, request_id)
+    if plan.store_in_cache:
+        await response_cache.set(plan.cache_key, results[0][0])
+
+    choices = []
+    completion_tokens = 0
+    served = []
+    for index, (response, route) in enumerate(results):
+        limiter = OutputLimiter(completion_request.max_tokens, completion_request.stop)
+        if limiter.active:
+            response = limiter.apply(response)
+        completion_tokens += await count_tokens_async(response)
+        choices.append({
+            "index": index,
+            "message": {
+                "role": "assistant",
+                "content": response
+            },
+            "finish_reason": limiter.finish_reason or "stop"
+        })
+        if route is not None and route.served is not None:
+            served.append(route.served)
+
+    # 计算使用量：提示词只计一次，各 choice 的输出累加
+    usage = await build_usage(completion_request.messages, completion_tokens)
+
+    served_model = completion_request.model
+    if bot_router.get(completion_request.model) is not None and served:
+        # 虚拟模型以实际提供服务的机器人作为 model，并通过响应头按 choice 顺序标明
+        served_model = served[0]
+        headers["X-Poe-Bot"] = ", ".join(served)
+        for bot in served:
+            VIRTUAL_MODEL_ROUTED.inc((completion_request.model, bot))
+
+    response_data = {
+        "id": request_id,
+        "object": "chat.completion",
+        "created": created_time,
+        "model": served_model,
+        "system_fingerprint": f"fp_{request_id}",
+        "choices": choices,
+        "usage": usage
+    }
+
+    observe_request(completion_request.model, False, "ok", started, usage=usage,
+                    details=request_details(request_id, [route for _, route in results], plan, compaction))
+
+    # 打印完整响应
+    logger.info(f"Non-stream response completed for [{request_id}]")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Response content: {response if len(choices) == 1 else [c['message']['content'] for c in choices]}")
+        logger.debug(f"Response data: {json.dumps(response_data, ensure_ascii=False)}")
+    return response_data, headers
 
 
 async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
@@ -307,14 +3268,23 @@ async def options_handler(full_path: str, request: Request):
 @router.post("/v1/chat/completions")
 @router.post("/chat/completions")
 async def create_completion(request: Request, token: str = Depends(verify_token)):
-    request_id = "chatcmpl-" + token[:6]
+    request_id = "chatcmpl-" + uuid.uuid4().hex
     created_time = int(asyncio.get_event_loop().time())
+    request_started = time.monotonic()
+    metrics_model = None  # 模型名校验通过后才计入指标，避免任意模型名成为标签
+    token_slot = None
+    compaction = None
 
     try:
+        token_slot = access_limiter.admit(token)
+
         # 获取并记录原始请求数据
-        raw_request = await request.json()
-        logger.debug(f"Raw request [{request_id}]:")
-        logger.debug(json.dumps(raw_request, ensure_ascii=False, indent=2))
+        raw_request = loads_json(await request.body())
+        # 日志级别高于 DEBUG 时不构造这些消息，避免为每个请求格式化整份提示词
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug(f"Raw request [{request_id}]:")
+            logger.debug(json.dumps(raw_request, ensure_ascii=False, indent=2))
 
         # 尝试解析为 CompletionRequest
         try:
@@ -336,170 +3306,258 @@ async def create_completion(request: Request, token: str = Depends(verify_token)
             )
 
         # 打印解析后的请求参数
-        logger.debug(f"Parsed request [{request_id}] - Full details:")
-        logger.debug(f"Model: {completion_request.model}")
-        logger.debug(f"Stream: {completion_request.stream}")
-        logger.debug(f"Temperature: {completion_request.temperature}")
-        logger.debug("Messages:")
-        for idx, msg in enumerate(completion_request.messages):
-            logger.debug(f"  [{idx}] Role: {msg.role}")
-            logger.debug(f"  [{idx}] Content: {msg.get_content_text()}")
-
-        if not api_key_cycle:
+        if debug:
+            logger.debug(f"Parsed request [{request_id}] - Full details:")
+            logger.debug(f"Model: {completion_request.model}")
+            logger.debug(f"Stream: {completion_request.stream}")
+            logger.debug(f"Temperature: {completion_request.temperature}")
+            logger.debug("Messages:")
+            for idx, msg in enumerate(completion_request.messages):
+                logger.debug(f"  [{idx}] Role: {msg.role}")
+                logger.debug(f"  [{idx}] Content: {msg.get_content_text()}")
+
+        if not len(key_pool):
             raise HTTPException(status_code=500, detail="No valid API tokens available")
 
-        model_lower = completion_request.model.lower()
-        if model_lower not in bot_names_map:
+        model_name, virtual_model = resolve_model(completion_request.model)
+        if model_name is None:
             return JSONResponse(
                 status_code=404,
-                content={
-                    "error": {
-                        "message": f"Model {completion_request.model} not found",
-                        "type": "invalid_request_error",
-                        "param": "model",
-                        "code": "model_not_found"
-                    }
-                }
+                content=error_body(f"Model {completion_request.model} not found", "invalid_request_error",
+                                   "model_not_found", "model")
             )
 
-        completion_request.model = bot_names_map[model_lower]
-        
-        protocol_messages = [
-            ProtocolMessage(
-                role=msg.role if msg.role in ["user", "system"] else "bot", 
-                content=msg.get_content_text()
-            )
-            for msg in completion_request.messages
-        ]
-        poe_token = next(api_key_cycle)
-        logger.info(f"Processing request [{request_id}] with model {completion_request.model}")
+        completion_request.model = model_name
+        metrics_model = completion_request.model
 
-        if completion_request.stream:
-            import re
-            async def response_generator():
-                total_response = ""
-                last_sent_base_content = None
-                elapsed_time_pattern = re.compile(r" \(\d+s elapsed\)$")
-                chunk_count = 0
+        await load_tokenizer()
+        compaction = await apply_context_budget(completion_request, request_id)
+        protocol_messages = await build_protocol_messages(completion_request.messages)
+        plan = await plan_completion(completion_request, protocol_messages,
+                                     request.headers.get("cache-control", "").lower(), request_id)
 
-                try:
-                    logger.info(f"Starting stream response for request [{request_id}]")
-                    async for partial in get_bot_response(protocol_messages, bot_name=completion_request.model, api_key=poe_token,
-                                                          session=proxy):
-                        if partial and partial.text:
-                            if partial.text.strip() in ["Thinking...", "Generating image..."]:
-                                logger.debug(f"Skipping status message: {partial.text}")
-                                continue
-                                
-                            base_content = elapsed_time_pattern.sub("", partial.text)
-
-                            if last_sent_base_content == base_content:
-                                continue
+        if not completion_request.stream:
+            response_data, headers = await complete_non_stream(completion_request, protocol_messages, plan, token,
+                                                               token_slot.weight, request_id, created_time,
+                                                               request_started, compaction)
+            return JSONResponse(content=response_data, headers=headers)
+
+        disconnected = asyncio.Event()
+        stream_flights: List[StreamFlight] = []
+        routes: List[Optional[BotRoute]] = [None]
+        flush_interval = 0.0
+        if plan.cached_response is not None:
+            sources = [replay_cached_response(plan.cached_response)]
+        else:
+            if plan.flight is not None:
+                stream_flights = [plan.flight]
+                routes = [plan.flight.route]
+            else:
+                # 每个 choice 各自在独立任务中调用上游，客户端断开时可以及时取消；密钥由该任务持有
+                routes = []
+                acquired = await acquire_routes(completion_request.model, completion_request.n or 1, token,
+                                                token_slot.weight, request_id)
+                for route, lease in acquired:
+                    hedge = hedge_policy.enabled_for(completion_request.model, request.headers.get("x-hedge"))
+                    stream_flights.append(single_flight.start_stream(
+                        plan.coalesce_key,
+                        stream_with_failover(protocol_messages, route, lease, request_id, hedge=hedge),
+                        cleanup=lease.release,
+                        replay=plan.coalesce_key is not None,
+                        route=route
+                    ))
+                    routes.append(route)
+            flush_interval = resolve_flush_interval(request)
+            sources = [flight.subscribe(disconnected, flush_interval, SSE_FLUSH_MAX_BYTES) for flight in stream_flights]
+        source = ChoiceStreams(sources)
+        limiters = [OutputLimiter(completion_request.max_tokens, completion_request.stop) for _ in sources]
+        encoder = SSEChunkEncoder(request_id, created_time, completion_request.model)
+        # 每个 choice 使用各自的编码器：虚拟模型的各 choice 可能由不同的机器人提供服务
+        encoders = [encoder] * len(sources)
+        stream_started = time.monotonic()
+
+        def log_cancelled(chunk_count: int):
+            elapsed = time.monotonic() - stream_started
+            saved = max(0.0, model_stream_duration.get(completion_request.model, elapsed) - elapsed)
+            logger.info(f"Client disconnected from [{request_id}] after {elapsed:.1f}s and {chunk_count} chunks, "
+                        f"upstream stream cancelled (~{saved:.1f}s of generation saved)")
+
+        async def response_generator():
+            served_encoders = {}
+            # 只在需要写缓存或打印完整响应时保留全文，否则每个流只占用常数内存
+            keep_text = plan.store_in_cache or debug
+            response_parts = [[] for _ in sources]
+            completion_counters = [IncrementalTokenCounter() for _ in sources]
+            choice_started = [False] * len(sources)
+            chunk_count = 0
+            upstream_deltas = 0
+            first_chunk_at = None
+            status = "error"
+            usage = None
+            watcher = None
+            if stream_flights:
+                watcher = asyncio.create_task(watch_disconnect(request, disconnected, stream_flights))
 
+            try:
+                logger.info(f"Starting stream response for request [{request_id}]")
+                async for index, batch in source:
+                    upstream_deltas += len(batch)
+                    limiter = limiters[index]
+                    for base_content in (("".join(batch),) if flush_interval > 0 else batch):
+                        if limiter.active:
+                            base_content = limiter.feed(base_content)
+                        if base_content:
+                            if first_chunk_at is None:
+                                first_chunk_at = time.monotonic()
+                            if not choice_started[index]:
+                                choice_started[index] = True
+                                route = routes[index]
+                                if virtual_model is not None and route is not None and route.served is not None:
+                                    # 虚拟模型的分块以实际提供该 choice 的机器人作为 model
+                                    if route.served not in served_encoders:
+                                        served_encoders[route.served] = SSEChunkEncoder(request_id, created_time,
+                                                                                        route.served)
+                                    encoders[index] = served_encoders[route.served]
+                                    VIRTUAL_MODEL_ROUTED.inc((completion_request.model, route.served))
                             chunk_count += 1
-                            total_response += base_content
-                            logger.debug(f"Stream chunk [{request_id}] #{chunk_count}: {base_content}")
-                            
-                            chunk = {
-                                "id": request_id,
-                                "object": "chat.completion.chunk",
-                                "created": created_time,
-                                "model": completion_request.model,
-                                "system_fingerprint": f"fp_{request_id}",
-                                "choices": [{
-                                    "delta": {
-                                        "content": base_content
-                                    },
-                                    "index": 0,
-                                    "finish_reason": None
-                                }]
-                            }
-                            yield f"data: {json.dumps(chunk)}\n\n"
-                            last_sent_base_content = base_content
-
-                    # 计算使用量
-                    usage = calculate_usage(completion_request.messages, total_response)
-                    
-                    # 发送结束标记
+                            completion_counters[index].feed(base_content)
+                            if keep_text:
+                                response_parts[index].append(base_content)
+                            if debug:
+                                logger.debug(f"Stream chunk [{request_id}] #{chunk_count}: {base_content}")
+                            yield encoders[index].content(base_content, index)
+                        if limiter.finish_reason is not None:
+                            break
+                    if limiter.finish_reason is not None:
+                        # 该 choice 已达到 max_tokens 或 stop，取消其上游调用，其余 choice 继续
+                        source.stop(index)
+
+                if disconnected.is_set():
+                    status = "cancelled"
+                    log_cancelled(chunk_count)
+                    return
+
+                for index, limiter in enumerate(limiters):
+                    if limiter.finish_reason is not None:
+                        logger.info(f"Stream [{request_id}] reached its {'max_tokens' if limiter.finish_reason == 'length' else 'stop'} "
+                                    f"limit, upstream stream cancelled")
+                        continue
+                    tail = limiter.flush() if limiter.active else ""
+                    if tail:
+                        chunk_count += 1
+                        completion_counters[index].feed(tail)
+                        if keep_text:
+                            response_parts[index].append(tail)
+                        yield encoders[index].content(tail, index)
+                if stream_flights and all(limiter.finish_reason is None for limiter in limiters):
+                    record_stream_duration(completion_request.model, time.monotonic() - stream_started)
+
+                total_responses = ["".join(parts) for parts in response_parts]
+                if plan.store_in_cache:
+                    # 写入缓存放到后台，不推迟结束分块与 [DONE] 的发送
+                    spawn_background(response_cache.set(plan.cache_key, total_responses[0]))
+
+                # 计算使用量：提示词只计一次，各 choice 的输出累加
+                usage = await build_usage(completion_request.messages,
+                                          sum(counter.tokens for counter in completion_counters))
+
+                # 发送结束标记
+                if flush_interval > 0:
+                    logger.info(f"Stream completed for [{request_id}] - Total chunks: {chunk_count} "
+                                f"(coalesced from {upstream_deltas} upstream deltas)")
+                else:
                     logger.info(f"Stream completed for [{request_id}] - Total chunks: {chunk_count}")
-                    logger.debug(f"Final response [{request_id}]: {total_response}")
-                    
-                    end_chunk = {
-                        "id": request_id,
-                        "object": "chat.completion.chunk",
-                        "created": created_time,
-                        "model": completion_request.model,
-                        "system_fingerprint": f"fp_{request_id}",
-                        "choices": [{
-                            "delta": {},
-                            "index": 0,
-                            "finish_reason": "stop"
-                        }],
-                        "usage": usage
-                    }
-                    yield f"data: {json.dumps(end_chunk)}\n\n"
-                    yield "data: [DONE]\n\n"
-
-                except BotError as be:
-                    error_message = f"BotError in stream generation for [{request_id}]:"
-                    error_message += f"\nError type: {type(be)}"
-                    error_message += f"\nError args: {be.args}"
-                    if hasattr(be, 'text'):
-                        error_message += f"\nError text: {be.text}"
-                    logger.error(error_message)
-                    
-                    error_response = {
-                        "error": {
-                            "message": str(be),
-                            "type": "bot_error",
-                            "param": None,
-                            "code": "bot_error"
-                        }
+                if debug:
+                    logger.debug(f"Final response [{request_id}]: "
+                                 f"{total_responses[0] if len(total_responses) == 1 else total_responses}")
+
+                status = "ok"
+                # 每个 choice 各有一个结束分块，使用量附在最后一个上
+                for index, limiter in enumerate(limiters):
+                    yield encoders[index].finish(limiter.finish_reason or "stop",
+                                                usage if index == len(limiters) - 1 else None, index)
+                yield encoder.DONE
+
+            except (BotError, KeyPoolExhausted) as be:
+                error_message = f"BotError in stream generation for [{request_id}]:"
+                error_message += f"\nError type: {type(be)}"
+                error_message += f"\nError args: {be.args}"
+                if hasattr(be, 'text'):
+                    error_message += f"\nError text: {be.text}"
+                logger.error(error_message)
+
+                error_response = {
+                    "error": {
+                        "message": str(be),
+                        "type": "bot_error",
+                        "param": None,
+                        "code": "bot_error"
                     }
-                    
-                    yield f"data: {json.dumps(error_response)}\n\n"
-                    yield "data: [DONE]\n\n"
-                except Exception as e:
-                    error_message = f"Error in stream generation for [{request_id}]:"
-                    error_message += f"\nError type: {type(e)}"
-                    error_message += f"\nError message: {str(e)}"
-                    error_message += f"\nError args: {e.args}"
-                    logger.error(error_message)
-                    raise
-
-            return StreamingResponse(response_generator(), media_type="text/event-stream")
-        else:
-            logger.info(f"Starting non-stream response for request [{request_id}]")
-            response = await get_responses(completion_request, poe_token)
-            
-            # 计算使用量
-            usage = calculate_usage(completion_request.messages, response)
-            
-            response_data = {
-                "id": request_id,
-                "object": "chat.completion",
-                "created": created_time,
-                "model": completion_request.model,
-                "system_fingerprint": f"fp_{request_id}",
-                "choices": [{
-                    "index": 0,
-                    "message": {
-                        "role": "assistant",
-                        "content": response
-                    },
-                    "finish_reason": "stop"
-                }],
-                "usage": usage
-            }
-            
-            # 打印完整响应
-            logger.info(f"Non-stream response completed for [{request_id}]")
-            logger.debug(f"Response content: {response}")
-            logger.debug(f"Response data: {json.dumps(response_data, ensure_ascii=False)}")
-            
-            return response_data
+                }
+
+                yield encoder.error(error_response)
+                yield encoder.DONE
+            except asyncio.CancelledError:
+                # 服务器检测到客户端断开后会取消响应任务
+                status = "cancelled"
+                log_cancelled(chunk_count)
+                raise
+            except Exception as e:
+                error_message = f"Error in stream generation for [{request_id}]:"
+                error_message += f"\nError type: {type(e)}"
+                error_message += f"\nError message: {str(e)}"
+                error_message += f"\nError args: {e.args}"
+                logger.error(error_message)
+                raise
+            finally:
+                sse_frame_stats["upstream_deltas"] += upstream_deltas
+                sse_frame_stats["frames_sent"] += chunk_count
+                observe_request(completion_request.model, True, status, request_started, first_chunk_at,
+                                chunk_count, usage, request_details(request_id, routes, plan, compaction))
+                if watcher is not None:
+                    watcher.cancel()
+                stream_slot.release()
+                # 退订后若已无其他订阅者，上游调用随之取消并归还密钥
+                await source.aclose()
+
+        # 并发名额交由流式响应持有，直到流结束
+        stream_slot = token_slot
+        token_slot = None
+
+        async def finish_stream():
+            # 若生成器从未被迭代（例如客户端提前断开），在这里兜底取消上游调用；在事件循环内执行，避免跨线程操作
+            for flight in stream_flights:
+                if not flight.replay:
+                    flight.abandon()
+            stream_slot.release()
+
+        return StreamingResponse(response_generator(), media_type="text/event-stream", headers=plan.headers,
+                                 background=BackgroundTask(finish_stream))
     except GeneratorExit:
         logger.info(f"GeneratorExit exception caught for request [{request_id}]")
+    except RateLimitExceeded as e:
+        logger.warning(f"Request [{request_id}] rate limited ({e.reason}): {str(e)}")
+        return rate_limit_response(e)
+    except KeyPoolExhausted as e:
+        logger.warning(f"Request [{request_id}] rejected: {str(e)}")
+        if metrics_model is not None:
+            observe_request(metrics_model, bool(completion_request.stream), "rejected", request_started,
+                            details=request_details(request_id, compaction=compaction))
+        return JSONResponse(
+            status_code=503,
+            content={
+                "error": {
+                    "message": f"{str(e)}, please retry later",
+                    "type": "server_overloaded",
+                    "param": None,
+                    "code": "key_pool_exhausted"
+                }
+            }
+        )
+    except AttachmentError as e:
+        logger.warning(f"Request [{request_id}] has an invalid attachment: {str(e)}")
+        return JSONResponse(status_code=400,
+                            content=error_body(str(e), "invalid_request_error", "invalid_attachment", "messages"))
     except json.JSONDecodeError as e:
         error_message = f"Invalid JSON in request body: {str(e)}"
         logger.error(error_message)
@@ -520,6 +3578,9 @@ async def create_completion(request: Request, token: str = Depends(verify_token)
         error_message += f"\nError message: {str(e)}"
         error_message += f"\nError args: {e.args}"
         logger.error(error_message)
+        if metrics_model is not None:
+            observe_request(metrics_model, bool(completion_request.stream), "error", request_started,
+                            details=request_details(request_id, compaction=compaction))
         return JSONResponse(
             status_code=500,
             content={
@@ -531,37 +3592,843 @@ async def create_completion(request: Request, token: str = Depends(verify_token)
                 }
             }
         )
+    finally:
+        # 非流式请求与提前返回的错误在这里归还并发名额，流式请求已交由响应自行释放
+        if token_slot is not None:
+            token_slot.release()
+
+
+BATCH_URLS = ("/v1/chat/completions", "/chat/completions")
+
+
+async def run_batch_body(body: Dict, token: str, weight: int, request_id: str) -> Tuple[int, Dict]:
+    """以非流式方式执行批量请求中的一个请求体，返回 (状态码, 响应体)；
+    密钥池饱和或可重试的上游错误在换密钥重试之外再整体重试 BATCH_MAX_RETRIES 次"""
+    try:
+        completion_request = CompletionRequest(**{**body, "stream": False})
+    except ValidationError as e:
+        return 422, error_body("Invalid request format", "invalid_request_error", details=str(e))
+    model_name, _ = resolve_model(completion_request.model)
+    if model_name is None:
+        return 404, error_body(f"Model {completion_request.model} not found", "invalid_request_error",
+                               "model_not_found", "model")
+    completion_request.model = model_name
+    await load_tokenizer()
+    compaction = await apply_context_budget(completion_request, request_id)
+    attempt = 0
+    while True:
+        started = time.monotonic()
+        try:
+            # 附件上传失败与上游调用失败一样整体重试，已上传的附件由缓存复用
+            protocol_messages = await build_protocol_messages(completion_request.messages)
+            plan = await plan_completion(completion_request, protocol_messages, "", request_id)
+            response_data, _ = await complete_non_stream(completion_request, protocol_messages, plan, token, weight,
+                                                         request_id, int(time.time()), started, compaction)
+            return 200, response_data
+        except AttachmentError as e:
+            return 400, error_body(str(e), "invalid_request_error", "invalid_attachment", "messages")
+        except Exception as e:
+            pool_exhausted = isinstance(e, KeyPoolExhausted)
+            if attempt < BATCH_MAX_RETRIES and (pool_exhausted or is_retryable_error(e)):
+                delay = retry_backoff(attempt)
+                logger.warning(f"Batch request [{request_id}] failed ({type(e).__name__}: {str(e)[:200]}), "
+                               f"retrying in {delay:.2f}s (retry {attempt + 1}/{BATCH_MAX_RETRIES})")
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            logger.error(f"Batch request [{request_id}] failed: {type(e).__name__}: {str(e)}")
+            observe_request(model_name, False, "rejected" if pool_exhausted else "error", started,
+                            details=request_details(request_id, compaction=compaction))
+            if pool_exhausted:
+                return 503, error_body(f"{str(e)}, please retry later", "server_overloaded", "key_pool_exhausted")
+            return 500, error_body(str(e), "internal_server_error", "internal_error")
+
+
+async def run_batch_line(index: int, line: str, batch_id: str, token: str, weight: int) -> Dict:
+    """执行 JSONL 中的一行，结果行与 OpenAI Batch 输出格式一致；出错时返回带错误信息的结果行而不抛出"""
+    result = {"id": f"{batch_id}_req_{index}", "custom_id": None, "response": None, "error": None}
+    try:
+        item = loads_json(line)
+    except json.JSONDecodeError as e:
+        result["error"] = {"code": "invalid_json", "message": f"Line {index + 1}: {str(e)}"}
+        return result
+    if not isinstance(item, dict) or not isinstance(item.get("body"), dict):
+        result["error"] = {"code": "invalid_request", "message": f"Line {index + 1}: expected an object with a body"}
+        return result
+    result["custom_id"] = item.get("custom_id")
+    url = item.get("url", BATCH_URLS[0])
+    method = item.get("method", "POST")
+    if not isinstance(url, str) or url not in BATCH_URLS or not isinstance(method, str) or method.upper() != "POST":
+        result["error"] = {"code": "invalid_url", "message": f"Line {index + 1}: only POST {BATCH_URLS[0]} is supported"}
+        return result
+    request_id = "chatcmpl-" + uuid.uuid4().hex
+    # 每一行与普通请求一样占用访问令牌的速率与并发额度，超限时排队等待
+    line_slot = await access_limiter.wait_admit(token)
+    try:
+        status_code, body = await run_batch_body(item["body"], token, weight, request_id)
+    except Exception as e:
+        # 单行的意外错误只影响该行，不能让 worker 退出导致整个批量响应挂起
+        logger.error(f"Batch {batch_id} line {index + 1} failed: {type(e).__name__}: {str(e)}")
+        result["error"] = {"code": "internal_error", "message": f"Line {index + 1}: {type(e).__name__}: {str(e)}"}
+        return result
+    finally:
+        line_slot.release()
+    result["response"] = {"status_code": status_code, "request_id": request_id, "body": body}
+    return result
+
+
+@router.post("/v1/batch/completions")
+async def create_batch(request: Request, token: str = Depends(verify_token)):
+    """批量补全：请求体为 JSONL（或 multipart 上传的 file 字段），每行一个 OpenAI Batch 格式的请求，
+    以 BATCH_CONCURRENCY 的并发执行，并按完成顺序以 JSONL 流式返回结果"""
+    try:
+        token_slot = access_limiter.admit(token)
+    except RateLimitExceeded as e:
+        logger.warning(f"Batch request rate limited ({e.reason}): {str(e)}")
+        return rate_limit_response(e)
+
+    try:
+        if request.headers.get("content-type", "").startswith("multipart/form-data"):
+            form = await request.form()
+            upload = form.get("file")
+            if upload is None or isinstance(upload, str):
+                token_slot.release()
+                return JSONResponse(status_code=400, content=error_body(
+                    "Multipart batch requests must upload the JSONL as the 'file' field", "invalid_request_error",
+                    "missing_file", "file"))
+            data = await upload.read()
+        else:
+            data = await request.body()
+        lines = [line for line in data.decode("utf-8").splitlines() if line.strip()]
+    except UnicodeDecodeError as e:
+        token_slot.release()
+        return JSONResponse(status_code=400, content=error_body(
+            f"Batch input must be UTF-8 encoded JSONL: {str(e)}", "invalid_request_error", "invalid_encoding"))
+    except BaseException:
+        token_slot.release()
+        raise
+    if not lines or len(lines) > BATCH_MAX_REQUESTS:
+        token_slot.release()
+        return JSONResponse(status_code=400, content=error_body(
+            f"Batch input must contain between 1 and {BATCH_MAX_REQUESTS} requests, got {len(lines)}",
+            "invalid_request_error", "invalid_batch_size"))
+
+    # 批量请求本身只在准入时计一次，之后由每一行各自占用令牌额度，避免批量请求绕过 TOKEN_RATE_LIMIT 与并发上限
+    weight = token_slot.weight
+    token_slot.release()
+    concurrency = max(1, min(BATCH_CONCURRENCY, len(lines)))
+    if access_limiter.max_concurrency(token) > 0:
+        concurrency = min(concurrency, access_limiter.max_concurrency(token))
+    batch_id = "batch_" + os.urandom(8).hex()
+    logger.info(f"Starting batch {batch_id} with {len(lines)} requests (concurrency {concurrency})")
+
+    async def result_lines():
+        pending = iter(enumerate(lines))
+        results = asyncio.Queue()
+
+        async def worker():
+            # 各 worker 共享同一个迭代器依次领取下一行，同时进行的请求数不超过 worker 数
+            for index, line in pending:
+                try:
+                    result = await run_batch_line(index, line, batch_id, token, weight)
+                except Exception as e:
+                    logger.error(f"Batch {batch_id} line {index + 1} failed: {type(e).__name__}: {str(e)}")
+                    result = {"id": f"{batch_id}_req_{index}", "custom_id": None, "response": None,
+                              "error": {"code": "internal_error", "message": f"Line {index + 1}: {str(e)}"}}
+                results.put_nowait(result)
+
+        workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+        failed = 0
+        try:
+            for _ in range(len(lines)):
+                result = await results.get()
+                if result["error"] is not None or result["response"]["status_code"] != 200:
+                    failed += 1
+                yield dumps_json(result) + b"\n"
+            logger.info(f"Batch {batch_id} completed: {len(lines) - failed} succeeded, {failed} failed")
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    return StreamingResponse(result_lines(), media_type="application/x-ndjson", headers={"X-Batch-Id": batch_id})
+
+
+@metrics.callback("poe_key_pool_keys", "API keys currently eligible for scheduling")
+def collect_key_count():
+    return [((), len(key_pool))]
+
+
+@metrics.callback("poe_key_pool_waiters", "Requests queued waiting for a free API key")
+def collect_key_waiters():
+    return [((), len(key_pool._waiters))]
+
+
+@metrics.callback("poe_key_inflight", "In-flight upstream calls per API key", ("key",))
+def collect_key_inflight():
+    return [((state.fingerprint,), state.inflight) for state in list(key_pool.keys.values())]
+
+
+@metrics.callback("poe_key_saturation", "In-flight calls divided by KEY_MAX_CONCURRENCY (0 when unlimited)", ("key",))
+def collect_key_saturation():
+    if KEY_MAX_CONCURRENCY <= 0:
+        return [((state.fingerprint,), 0) for state in list(key_pool.keys.values())]
+    return [((state.fingerprint,), state.inflight / KEY_MAX_CONCURRENCY) for state in list(key_pool.keys.values())]
+
+
+@metrics.callback("poe_key_circuit_open", "1 when the API key circuit breaker is open or half-open", ("key",))
+def collect_key_circuit():
+    now = time.monotonic()
+    return [((state.fingerprint,), 0 if state.circuit_state(now) == "closed" else 1)
+            for state in list(key_pool.keys.values())]
+
+
+@metrics.callback("poe_key_throttled", "1 while the API key is cooling down after a rate limit", ("key",))
+def collect_key_throttled():
+    now = time.monotonic()
+    return [((state.fingerprint,), 1 if state.is_throttled(now) else 0) for state in list(key_pool.keys.values())]
+
+
+@metrics.callback("poe_key_error_rate", "Exponentially weighted upstream error rate per API key", ("key",))
+def collect_key_error_rate():
+    return [((state.fingerprint,), state.error_rate) for state in list(key_pool.keys.values())]
+
+
+@metrics.callback("poe_response_cache_hits_total", "Response cache hits", type="counter")
+def collect_cache_hits():
+    return [((), response_cache.hits)]
+
+
+@metrics.callback("poe_response_cache_misses_total", "Response cache misses", type="counter")
+def collect_cache_misses():
+    return [((), response_cache.misses)]
+
+
+@metrics.callback("poe_response_cache_errors_total", "Response cache persistence errors (treated as misses)",
+                  ("op",), type="counter")
+def collect_cache_errors():
+    return [((op,), count) for op, count in response_cache.errors.items()]
+
+
+@metrics.callback("poe_coalesced_requests_total", "Requests that joined an identical in-flight upstream call",
+                  type="counter")
+def collect_coalesced():
+    return [((), single_flight.joined)]
+
+
+@metrics.callback("poe_sse_upstream_deltas_total", "Upstream text deltas received by streaming requests",
+                  type="counter")
+def collect_upstream_deltas():
+    return [((), sse_frame_stats["upstream_deltas"])]
+
+
+@metrics.callback("poe_sse_frames_sent_total", "SSE content frames written to clients", type="counter")
+def collect_frames_sent():
+    return [((), sse_frame_stats["frames_sent"])]
+
+
+@router.get("/metrics")
+async def get_metrics(request: Request):
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if METRICS_REQUIRE_AUTH:
+        scheme, _, credentials = request.headers.get("authorization", "").partition(" ")
+        if scheme.lower() != "bearer" or credentials not in ACCESS_TOKENS:
+            raise HTTPException(status_code=401, detail="Invalid API key", headers={"WWW-Authenticate": "Bearer"})
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@router.get("/v1/cache/stats")
+async def get_cache_stats(token: str = Depends(verify_token)):
+    return response_cache.stats()
 
 
 @router.get("/models")
 @router.get("/v1/models")
 async def get_models():
     model_list = [{"id": name, "object": "model", "type": "llm"} for name in BOT_NAMES]
+    model_list += [{"id": model.name, "object": "model", "type": "llm"} for model in bot_router.models.values()]
     return {"data": model_list, "object": "list"}
 
 
+# 后台任务引用，防止被垃圾回收
+background_tasks = set()
+
+
+def spawn_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def validate_tokens(tokens: List[str]) -> List[asyncio.Task]:
+    """以有限并发验证一批密钥，返回各密钥的验证任务"""
+    semaphore = asyncio.Semaphore(max(1, KEY_VALIDATION_CONCURRENCY))
+
+    async def validate(token: str):
+        async with semaphore:
+            return await add_token(token)
+
+    return [asyncio.create_task(validate(token)) for token in dict.fromkeys(token for token in tokens if token)]
+
+
+async def finish_background_validation(tasks: List[asyncio.Task], total: int):
+    await asyncio.gather(*tasks, return_exceptions=True)
+    logger.info(f"Background key validation finished: {len(key_pool)}/{total} API tokens valid")
+
+
 async def initialize_tokens(tokens: List[str]):
     if not tokens or all(not token for token in tokens):
         logger.error("No API keys found in the configuration.")
         sys.exit(1)
     else:
-        for token in tokens:
-            await add_token(token)
-        if not client_dict:
+        tasks = await validate_tokens(tokens)
+        if LAZY_KEY_VALIDATION:
+            # 只要有一个密钥验证通过就开始服务，其余密钥在后台继续验证
+            pending = set(tasks)
+            while pending and not len(key_pool):
+                _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            if pending:
+                logger.info(f"Validating remaining {len(pending)} API tokens in background")
+                spawn_background(finish_background_validation(list(pending), len(tasks)))
+        else:
+            await asyncio.gather(*tasks)
+        if not len(key_pool):
             logger.error("No valid tokens were added.")
             sys.exit(1)
         else:
-            global api_key_cycle
-            api_key_cycle = itertools.cycle(client_dict.values())
-            logger.info(f"Server initialized with {len(client_dict)} API tokens")
+            logger.info(f"Server initialized with {len(key_pool)} API tokens")
+
+
+async def revalidate_tokens_periodically(tokens: List[str]):
+    """定期重新验证配置中的密钥：连续多次验证失败的密钥移出调度，恢复后重新加入"""
+    failures: Dict[str, int] = {}
+    semaphore = asyncio.Semaphore(max(1, KEY_VALIDATION_CONCURRENCY))
+
+    async def revalidate(token: str):
+        async with semaphore:
+            ret = await probe_token(token)
+        if ret == "ok":
+            failures.pop(token, None)
+            if token not in key_pool:
+                key_pool.add(token)
+                logger.info(f"API key {token[:6]}... is valid again and has been restored")
+            return
+        failures[token] = failures.get(token, 0) + 1
+        if token in key_pool and failures[token] >= KEY_REVALIDATE_FAILURES:
+            key_pool.remove(token)
+            logger.warning(f"API key {token[:6]}... removed after {failures[token]} failed revalidations: {ret}")
+
+    while True:
+        await asyncio.sleep(KEY_REVALIDATE_INTERVAL)
+        logger.debug("Revalidating API tokens")
+        await asyncio.gather(*(revalidate(token) for token in dict.fromkeys(token for token in tokens if token)))
+
+
+def save_metrics_snapshot():
+    try:
+        metrics.write_snapshot()
+    except OSError as e:
+        logger.warning(f"Failed to write metrics snapshot: {str(e)}")
+
+
+async def write_metrics_periodically():
+    """多进程模式下定期写入本进程的指标快照，抓取请求由其他进程应答时也能汇总到本进程的计数"""
+    while True:
+        await asyncio.sleep(METRICS_SNAPSHOT_INTERVAL)
+        save_metrics_snapshot()
+
+
+# 运行时热重载：SIGHUP、.env 监视与管理接口共用同一套变更逻辑，同一时刻只进行一次重载
+reload_lock = asyncio.Lock()
+# 通过管理接口加入的密钥只保存在内存中：热重载 .env 时保留（不因不在 POE_API_KEYS 中而被移出），重启后失效
+admin_added_keys: set = set()
+
+
+async def check_keys(tokens: List[str], validate: bool = True) -> Dict[str, str]:
+    """以有限并发验证尚未在密钥池中的密钥，返回 密钥 -> "ok" 或失败原因，不改动密钥池"""
+    tokens = list(dict.fromkeys(token for token in tokens if token))
+    pending = [token for token in tokens if token not in key_pool]
+    results = dict.fromkeys(tokens, "ok")
+    if validate and pending:
+        semaphore = asyncio.Semaphore(max(1, KEY_VALIDATION_CONCURRENCY))
+
+        async def probe(token: str) -> str:
+            async with semaphore:
+                return await probe_token(token)
+
+        results.update(zip(pending, await asyncio.gather(*(probe(token) for token in pending))))
+    return results
+
+
+def commit_keys(checked: Dict[str, str], retire=()) -> Dict:
+    """一次性应用密钥变更：验证通过的密钥加入或恢复调度，retire 中的密钥排空后移出。
+    中间不经过 await，并发请求只会看到变更前或变更后的密钥池"""
+    summary = {"added": [], "resumed": [], "rejected": [], "retiring": []}
+    for token, result in checked.items():
+        fingerprint = key_fingerprint(token)
+        if result != "ok":
+            summary["rejected"].append({"key": fingerprint, "error": result})
+            continue
+        if token not in key_pool:
+            key_pool.add(token)
+            summary["added"].append(fingerprint)
+        elif token in key_pool.draining:
+            summary["resumed"].append(fingerprint)
+        else:
+            continue
+        key_pool.resume(token)
+        if token not in POE_API_KEYS:
+            POE_API_KEYS.append(token)
+        logger.info(f"API key {fingerprint} is now serving requests")
+    for token in retire:
+        if token in POE_API_KEYS:
+            POE_API_KEYS.remove(token)
+        # 验证失败而不在密钥池中的密钥只需从配置中删除
+        if token in key_pool.keys:
+            logger.info(f"API key {key_fingerprint(token)} is draining and will be removed once its in-flight "
+                        f"requests finish")
+            key_pool.drain(token, retire=True)
+            summary["retiring"].append(key_fingerprint(token))
+    return summary
+
+
+def set_models(bots: List[str], virtual_models: Dict) -> Dict:
+    """整体替换 BOT_NAMES 与虚拟模型，返回增删的模型名；进行中的请求已经选定机器人，不受影响"""
+    before = set(BOT_NAMES) | {model.name for model in bot_router.models.values()}
+    bots = list(dict.fromkeys(bot for bot in bots if isinstance(bot, str) and bot))
+    BOT_NAMES[:] = bots
+    bot_names_map.clear()
+    bot_names_map.update({name.lower(): name for name in bots})
+    bot_router.configure(virtual_models)
+    after = set(BOT_NAMES) | {model.name for model in bot_router.models.values()}
+    return {"added": sorted(after - before), "removed": sorted(before - after)}
+
+
+def reload_env_file() -> bool:
+    """按启动时的规则重新读取 .env：进程环境变量中已有的配置优先，不被 .env 覆盖，
+    上次从 .env 读取而这次已删除的变量从环境中移除；没有 .env 文件时返回 False"""
+    if not ENV_FILE:
+        return False
+    values = {name: value for name, value in dotenv_values(ENV_FILE).items()
+              if value is not None and name not in PROCESS_ENV_NAMES}
+    for name in DOTENV_NAMES - values.keys():
+        os.environ.pop(name, None)
+    os.environ.update(values)
+    DOTENV_NAMES.clear()
+    DOTENV_NAMES.update(values)
+    return True
+
+
+async def reload_config(source: str, plan: Optional[Dict] = None) -> Dict:
+    """重新读取 .env 中的 POE_API_KEYS、ACCESS_TOKENS、BOT_NAMES 与 VIRTUAL_MODELS 并应用差异：
+    新密钥验证通过后加入，配置中删除的密钥排空后移出，正在进行的流式请求不受影响。
+    多进程模式下由主进程验证新密钥并分配共享表中的行，工作进程按 plan 应用，不再各自验证"""
+    async with reload_lock:
+        if not reload_env_file():
+            logger.warning(f"No .env file to reload ({source}), keeping the current configuration")
+            return {}
+        try:
+            if plan is not None:
+                keys = plan["keys"]
+            else:
+                keys = list(dict.fromkeys(token for token in parse_json_env("POE_API_KEYS") if token))
+            access_tokens = set(parse_json_env("ACCESS_TOKENS"))
+            bots = parse_json_env("BOT_NAMES")
+            virtual_models = parse_json_env("VIRTUAL_MODELS") or {}
+            summary = {}
+            if keys:
+                if plan is not None:
+                    key_pool.share(key_pool.shared, plan["tokens"])
+                    key_pool.attach()
+                    checked = plan["checked"]
+                else:
+                    checked = await check_keys(keys)
+                current = dict.fromkeys(POE_API_KEYS + [token for token in key_pool.keys if token in key_pool])
+                summary["keys"] = commit_keys(checked, [token for token in current
+                                                        if token not in checked and token not in admin_added_keys])
+                # 验证失败的密钥仍保留在配置中，开启定期验证时恢复后自动加入
+                POE_API_KEYS[:] = dict.fromkeys(keys + [token for token in current if token in admin_added_keys])
+            else:
+                logger.warning("POE_API_KEYS is empty after reload, keeping the current API keys")
+            if access_tokens:
+                if plan is not None:
+                    access_limiter.attach(plan["access_tokens"])
+                summary["access_tokens"] = {"added": len(access_tokens - ACCESS_TOKENS),
+                                            "removed": len(ACCESS_TOKENS - access_tokens)}
+                ACCESS_TOKENS.clear()
+                ACCESS_TOKENS.update(access_tokens)
+            else:
+                logger.warning("ACCESS_TOKENS is empty after reload, keeping the current access tokens")
+            if bots:
+                summary["models"] = set_models(bots, virtual_models)
+            else:
+                logger.warning("BOT_NAMES is empty after reload, keeping the current models")
+        except Exception:
+            CONFIG_RELOADS.inc((source, "error"))
+            raise
+    CONFIG_RELOADS.inc((source, "ok"))
+    logger.info(f"Configuration reloaded ({source}): {json.dumps(summary)}")
+    return summary
+
+
+async def reload_in_background(source: str, plan: Optional[Dict] = None):
+    try:
+        await reload_config(source, plan)
+    except Exception as e:
+        logger.error(f"Configuration reload ({source}) failed: {str(e)}")
+
+
+def install_reload_signal(callback: Callable[[], None]):
+    """收到 SIGHUP 时调用 callback；Windows 没有 SIGHUP，只能通过 .env 监视或管理接口重载"""
+    sighup = getattr(signal, "SIGHUP", None)
+    if sighup is None:
+        return
+    try:
+        asyncio.get_running_loop().add_signal_handler(sighup, callback)
+    except (NotImplementedError, RuntimeError):
+        pass
+
+
+def env_file_signature():
+    try:
+        stat = os.stat(ENV_FILE)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+async def watch_env_file(on_change: Callable[[], Awaitable]):
+    """定期检查 .env 的修改时间与大小，变化时触发热重载"""
+    signature = env_file_signature()
+    while True:
+        await asyncio.sleep(CONFIG_WATCH_INTERVAL)
+        current = env_file_signature()
+        if current != signature:
+            signature = current
+            logger.info(f"{ENV_FILE} changed, reloading configuration")
+            await on_change()
+
+
+async def verify_admin_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    if not ADMIN_TOKENS:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not credentials or credentials.credentials not in ADMIN_TOKENS:
+        raise HTTPException(
+            status_code=401,
+            detail="Invalid admin token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return credentials.credentials
+
+
+def require_single_process():
+    # 多进程模式下管理请求只会到达其中一个工作进程，运行时变更改为修改 .env 后由主进程广播 SIGHUP
+    if WORKERS > 1:
+        raise HTTPException(status_code=409, detail="Runtime key and model changes are not supported with "
+                                                    "WORKERS > 1; edit .env and POST /admin/reload instead")
+
+
+async def read_admin_body(request: Request) -> Dict:
+    try:
+        body = loads_json(await request.body())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON body: {str(e)}")
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=400, detail="Request body must be a JSON object")
+    return body
+
+
+def admin_key(fingerprint: str) -> str:
+    token = key_pool.find(fingerprint, POE_API_KEYS)
+    if token is None:
+        raise HTTPException(status_code=404, detail=f"API key {fingerprint} not found")
+    return token
+
+
+def key_status(token: str) -> Dict:
+    state = key_pool.keys.get(token)
+    if state is None:
+        return {"fingerprint": key_fingerprint(token), "status": "removed"}
+    return dict(state.snapshot(), status=key_pool.status(state))
+
+
+@router.get("/admin/keys")
+async def admin_list_keys(token: str = Depends(verify_admin_token)):
+    return {"data": key_pool.snapshot(), "schedulable": len(key_pool), "waiters": len(key_pool._waiters)}
+
+
+@router.post("/admin/keys")
+async def admin_add_keys(request: Request, token: str = Depends(verify_admin_token)):
+    require_single_process()
+    body = await read_admin_body(request)
+    keys = body.get("keys")
+    if not isinstance(keys, list) or not keys or not all(isinstance(key, str) and key for key in keys):
+        raise HTTPException(status_code=400, detail='"keys" must be a non-empty list of Poe API keys')
+    async with reload_lock:
+        checked = await check_keys(keys, validate=body.get("validate", True) is not False)
+        admin_added_keys.update(key for key, result in checked.items() if result == "ok")
+        return commit_keys(checked)
+
+
+@router.post("/admin/keys/{fingerprint}/drain")
+async def admin_drain_key(fingerprint: str, token: str = Depends(verify_admin_token)):
+    require_single_process()
+    key = admin_key(fingerprint)
+    key_pool.drain(key)
+    logger.info(f"API key {fingerprint} is draining by admin request")
+    return key_status(key)
+
+
+@router.post("/admin/keys/{fingerprint}/resume")
+async def admin_resume_key(fingerprint: str, token: str = Depends(verify_admin_token)):
+    require_single_process()
+    key = admin_key(fingerprint)
+    if key not in key_pool:
+        raise HTTPException(status_code=409, detail=f"API key {fingerprint} is not in the pool; add it again instead")
+    key_pool.resume(key)
+    logger.info(f"API key {fingerprint} resumed by admin request")
+    return key_status(key)
+
+
+@router.delete("/admin/keys/{fingerprint}")
+async def admin_remove_key(fingerprint: str, token: str = Depends(verify_admin_token)):
+    require_single_process()
+    key = admin_key(fingerprint)
+    admin_added_keys.discard(key)
+    commit_keys({}, [key])
+    return key_status(key)
+
+
+@router.get("/admin/models")
+async def admin_list_models(token: str = Depends(verify_admin_token)):
+    return {
+        "bots": list(BOT_NAMES),
+        "virtual_models": bot_router.config,
+        "health": {bot: health.snapshot() for bot, health in list(bot_router.health.items())},
+    }
+
+
+@router.post("/admin/models")
+async def admin_add_models(request: Request, token: str = Depends(verify_admin_token)):
+    require_single_process()
+    body = await read_admin_body(request)
+    bots = body.get("bots") or []
+    virtual_models = body.get("virtual_models") or {}
+    if not isinstance(bots, list) or not all(isinstance(bot, str) and bot for bot in bots):
+        raise HTTPException(status_code=400, detail='"bots" must be a list of Poe bot names')
+    if not isinstance(virtual_models, dict) or not all(
+            isinstance(targets, (list, dict)) and targets for targets in virtual_models.values()):
+        raise HTTPException(status_code=400, detail='"virtual_models" must map names to a non-empty list or '
+                                                    'object of bots')
+    if not bots and not virtual_models:
+        raise HTTPException(status_code=400, detail='Nothing to add: provide "bots" or "virtual_models"')
+    names = {bot.lower() for bot in BOT_NAMES + bots}
+    shadowed = [name for name in virtual_models if name.lower() in names]
+    if shadowed:
+        raise HTTPException(status_code=400, detail=f"Virtual models {shadowed} shadow bots in BOT_NAMES")
+    async with reload_lock:
+        return set_models(BOT_NAMES + bots, dict(bot_router.config, **virtual_models))
+
+
+@router.delete("/admin/models/{name}")
+async def admin_remove_model(name: str, token: str = Depends(verify_admin_token)):
+    require_single_process()
+    model_lower = name.lower()
+    if model_lower not in bot_names_map and bot_router.get(name) is None:
+        raise HTTPException(status_code=404, detail=f"Model {name} not found")
+    async with reload_lock:
+        return set_models([bot for bot in BOT_NAMES if bot.lower() != model_lower],
+                          {model: bots for model, bots in bot_router.config.items() if model.lower() != model_lower})
+
+
+@router.post("/admin/reload")
+async def admin_reload(token: str = Depends(verify_admin_token)):
+    if not ENV_FILE:
+        raise HTTPException(status_code=409, detail="No .env file to reload; use the /admin/keys and /admin/models endpoints")
+    if WORKERS > 1:
+        # 交给主进程向所有工作进程广播 SIGHUP
+        sighup = getattr(signal, "SIGHUP", None)
+        if sighup is None:
+            raise HTTPException(status_code=409, detail="Reload is not supported with WORKERS > 1 on this platform")
+        os.kill(os.getppid(), sighup)
+        return JSONResponse({"status": "scheduled"}, status_code=202)
+    return await reload_config("admin")
 
 
 app.include_router(router)
+app.add_event_handler("shutdown", request_log.close)
+
+
+def run_worker(worker_id: int, sockets, tokens: List[str], key_table: SharedTable,
+               access_tokens: List[str], token_table: SharedTable, process_env_names: List[str],
+               dotenv_names: List[str], reload_conn, plan: Optional[Dict], metrics_dir: str):
+    """工作进程入口：挂载主进程创建的共享状态，在主进程已绑定的端口上提供服务，不再重复验证密钥；
+    热重载时主进程先经 reload_conn 发送方案再发送 SIGHUP"""
+    # 工作进程继承的环境变量已包含 .env 的值，热重载时按主进程启动时的环境变量区分来源
+    PROCESS_ENV_NAMES.clear()
+    PROCESS_ENV_NAMES.update(process_env_names)
+    DOTENV_NAMES.clear()
+    DOTENV_NAMES.update(dotenv_names)
+    key_pool.share(key_table, tokens)
+    key_pool.attach()
+    access_limiter.share(token_table, access_tokens)
+    if metrics_dir:
+        # 计数器与直方图写入共享目录，/metrics 汇总所有工作进程；退出时写入最后一次快照
+        metrics.share(metrics_dir)
+        app.add_event_handler("shutdown", save_metrics_snapshot)
+    if request_log.enabled:
+        # 各工作进程写入各自的请求日志文件，避免轮转时互相覆盖
+        root, ext = os.path.splitext(request_log.path)
+        request_log.path = f"{root}.worker{worker_id}{ext}"
+    logger.info(f"Worker {worker_id} (pid {os.getpid()}) serving with {len(key_pool)} API tokens")
+    conf = uvicorn.Config(app, log_level=LOG_LEVEL.lower())
+    server = uvicorn.Server(conf)
+
+    def on_reload():
+        latest = None
+        while reload_conn.poll():
+            latest = reload_conn.recv()
+        if latest is None:
+            logger.info(f"Worker {worker_id} ignored a SIGHUP; send it to the master process (pid {os.getppid()}) "
+                        f"to reload the configuration")
+            return
+        spawn_background(reload_in_background(latest["source"], latest))
+
+    async def serve():
+        if plan is not None:
+            # 热重载后重启的工作进程：按最近一次的方案排空已删除的密钥
+            await reload_config("startup", plan)
+        install_reload_signal(on_reload)
+        if metrics_dir:
+            spawn_background(write_metrics_periodically())
+        await prewarm_connections()
+        await server.serve(sockets=sockets)
+
+    asyncio.run(serve())
+
+
+async def serve_workers(tokens: List[str]):
+    """多进程模式：主进程验证一次密钥并绑定端口，派生的工作进程通过共享内存共用密钥池与限流状态，
+    主进程之后只负责定期重新验证密钥、热重载时验证新增的密钥，以及重启异常退出的工作进程"""
+    context = multiprocessing.get_context("spawn")
+    tokens = list(dict.fromkeys(token for token in tokens or [] if token))
+    access_tokens = sorted(ACCESS_TOKENS)
+    key_table = SharedTable(context, KEY_STATE_FIELDS, len(tokens) + SHARED_SPARE_ROWS)
+    token_table = SharedTable(context, ACCESS_TOKEN_FIELDS, len(access_tokens) + SHARED_SPARE_ROWS)
+    key_pool.share(key_table, tokens)
+    access_limiter.share(token_table, access_tokens, initialize=True)
+    await initialize_tokens(tokens)
+
+    conf = uvicorn.Config(app, host="0.0.0.0", port=PORT, log_level=LOG_LEVEL.lower())
+    sock = conf.bind_socket()
+
+    metrics_dir = tempfile.mkdtemp(prefix="poe-metrics-") if METRICS_ENABLED else ""
+    channels = {}
+    latest_plan = None  # 最近一次热重载的密钥方案，重启的工作进程据此恢复
+
+    def start_worker(worker_id: int):
+        reload_conn, channels[worker_id] = context.Pipe(duplex=False)
+        process = context.Process(
+            target=run_worker,
+            args=(worker_id, [sock], tokens, key_table, access_tokens, token_table, sorted(PROCESS_ENV_NAMES),
+                  sorted(DOTENV_NAMES), reload_conn, latest_plan, metrics_dir),
+            name=f"poe-worker-{worker_id}"
+        )
+        process.start()
+        reload_conn.close()
+        return process
+
+    processes = [start_worker(worker_id) for worker_id in range(WORKERS)]
+    logger.info(f"Started {WORKERS} workers on port {PORT}")
+    # 共享表的行号由 tokens 决定，只能在末尾追加；定期验证使用单独的列表，热重载删除的密钥不会被重新启用
+    revalidated = list(tokens)
+    if KEY_REVALIDATE_INTERVAL > 0:
+        spawn_background(revalidate_tokens_periodically(revalidated))
+
+    async def reload_workers(source: str):
+        # 新密钥只由主进程验证一次并在共享表中分配行（验证失败的同样分配，定期验证恢复后即可启用），
+        # 各工作进程收到方案后挂载同一份状态，再各自更新访问令牌与模型配置
+        nonlocal latest_plan
+        async with reload_lock:
+            if not reload_env_file():
+                logger.warning(f"No .env file to reload ({source}), keeping the current configuration")
+                return
+            keys = list(dict.fromkeys(token for token in parse_json_env("POE_API_KEYS") if token))
+            checked = await check_keys(keys) if keys else {}
+            for token in checked:
+                if token not in key_pool.rows:
+                    if key_pool.allocate(token):
+                        tokens.append(token)
+                    else:
+                        logger.warning(f"No spare shared rows for API key {key_fingerprint(token)}, each worker "
+                                       f"tracks its load separately until the server is restarted")
+            # 新增的访问令牌同样在共享表中分配行，各工作进程共用其速率与并发限制
+            for access_token in sorted(set(parse_json_env("ACCESS_TOKENS") or []) - set(access_limiter.rows)):
+                if access_limiter.allocate(access_token):
+                    access_tokens.append(access_token)
+                else:
+                    logger.warning("No spare shared rows for a new access token, each worker applies its rate and "
+                                   "concurrency limits separately until the server is restarted")
+            plan = {"source": source, "keys": keys, "checked": checked, "tokens": list(tokens),
+                    "access_tokens": list(access_tokens)}
+            if keys:
+                revalidated[:] = [token for token in tokens if token in checked]
+                latest_plan = plan
+            for worker_id, process in enumerate(processes):
+                if process.is_alive():
+                    try:
+                        channels[worker_id].send(plan)
+                        os.kill(process.pid, signal.SIGHUP)
+                    except OSError:
+                        # 刚刚退出的工作进程由下面的循环按最近一次的方案重启
+                        pass
+        logger.info(f"Forwarded configuration reload ({source}) to {len(processes)} workers")
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stopping.set)
+        except NotImplementedError:  # Windows 不支持，依赖 Ctrl+C 直接结束进程组
+            pass
+    install_reload_signal(lambda: spawn_background(reload_workers("sighup")))
+    if CONFIG_WATCH_INTERVAL > 0 and ENV_FILE:
+        spawn_background(watch_env_file(lambda: reload_workers("watch")))
+    try:
+        while not stopping.is_set():
+            try:
+                await asyncio.wait_for(stopping.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+            for worker_id, process in enumerate(processes):
+                if not process.is_alive() and not stopping.is_set():
+                    logger.warning(f"Worker {worker_id} exited with code {process.exitcode}, restarting")
+                    processes[worker_id] = start_worker(worker_id)
+    finally:
+        logger.info("Shutting down workers")
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            await asyncio.to_thread(process.join)
+        sock.close()
+        if metrics_dir:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
 
 
 async def main(tokens: List[str] = None):
     try:
+        if WORKERS > 1:
+            await serve_workers(tokens)
+            return
         await initialize_tokens(tokens)
+        await prewarm_connections()
+        if KEY_REVALIDATE_INTERVAL > 0:
+            spawn_background(revalidate_tokens_periodically(tokens))
+        install_reload_signal(lambda: spawn_background(reload_in_background("sighup")))
+        if CONFIG_WATCH_INTERVAL > 0 and ENV_FILE:
+            spawn_background(watch_env_file(lambda: reload_in_background("watch")))
         conf = uvicorn.Config(
             app,
             host="0.0.0.0",
@@ -0,0 +1,236 @@
+"""代理负载基准：在本地模拟的 Poe 接口上以逐级递增的并发驱动 /v1/chat/completions
+
+分别测量流式与非流式请求的首字延迟 p50/p95/p99、总耗时分位数、吞吐量、代理进程每个请求消耗的 CPU
+时间与内存占用（RSS），结果写入 JSON 文件，可用 --compare 与另一次提交的结果对比。
+CPU 与 RSS 通过 /proc 读取（包括多进程模式下的全部工作进程），非 Linux 系统上这两项为 null。
+
+用法：
+    python benchmarks/bench_load.py [--concurrency 1,8,32,64] [--modes stream,nonstream] [--duration 10]
+                                    [--workers 1] [--output bench_load.json] [--compare old.json]
+    模拟服务的参数（--ttft、--rate、--chunk-size、--status-frames、--error-rate 等）原样传给 fake_poe.py
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+
+from bench_workers import ACCESS_TOKEN, BENCH_DIR, ROOT_DIR, stop_process, wait_until_ready
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def process_tree(pid: int):
+    """返回 pid 及其全部子进程的 pid"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    pids, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        pids.append(current)
+        stack.extend(children.get(current, []))
+    return pids
+
+
+def sample_usage(pid: int):
+    """读取进程树累计的 CPU 时间（秒）与当前 RSS（字节），不支持 /proc 时返回 (None, None)"""
+    if not os.path.isdir("/proc"):
+        return None, None
+    cpu = 0.0
+    rss = 0
+    for current in process_tree(pid):
+        try:
+            with open(f"/proc/{current}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        cpu += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+        rss += int(fields[21]) * PAGE_SIZE
+    return cpu, rss
+
+
+def percentiles_ms(values) -> dict:
+    """最近秩法计算 p50/p95/p99（毫秒）"""
+    ordered = sorted(values)
+    result = {}
+    for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+        if not ordered:
+            result[name] = None
+            continue
+        index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+        result[name] = ordered[index] * 1000
+    return result
+
+
+async def one_request(client: httpx.AsyncClient, url: str, stream: bool, samples: dict):
+    body = {"model": "GPT-4o", "stream": stream, "messages": [{"role": "user", "content": "benchmark"}]}
+    headers = {"Authorization": f"Bearer {ACCESS_TOKEN}"}
+    started = time.perf_counter()
+    first = None
+    ok = False
+    try:
+        async with client.stream("POST", url, json=body, headers=headers) as response:
+            ok = response.status_code == 200
+            async for line in response.aiter_lines():
+                if not stream:
+                    continue
+                if line.startswith('data: {"error"'):
+                    # 流式请求的上游错误以带内错误帧的形式返回
+                    ok = False
+                elif first is None and line.startswith("data: {") and '"content"' in line:
+                    first = time.perf_counter()
+    except httpx.HTTPError:
+        ok = False
+    finished = time.perf_counter()
+    if not ok:
+        samples["errors"] += 1
+        return
+    samples["latency"].append(finished - started)
+    # 非流式请求的首字延迟即完整响应时间
+    samples["ttft"].append((first if stream and first is not None else finished) - started)
+
+
+async def run_level(url: str, stream: bool, concurrency: int, duration: float, proxy_pid: int):
+    samples = {"ttft": [], "latency": [], "errors": 0}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+        # 预热连接，避免建连开销计入结果
+        await asyncio.gather(*(one_request(client, url, stream, {"ttft": [], "latency": [], "errors": 0})
+                               for _ in range(concurrency)))
+        cpu_before, _ = sample_usage(proxy_pid)
+        peak_rss = 0
+        deadline = time.perf_counter() + duration
+        started = time.perf_counter()
+
+        async def worker():
+            while time.perf_counter() < deadline:
+                await one_request(client, url, stream, samples)
+
+        async def watch_rss():
+            nonlocal peak_rss
+            while time.perf_counter() < deadline:
+                _, rss = sample_usage(proxy_pid)
+                peak_rss = max(peak_rss, rss or 0)
+                await asyncio.sleep(0.5)
+
+        await asyncio.gather(watch_rss(), *(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        cpu_after, rss_after = sample_usage(proxy_pid)
+
+    completed = len(samples["latency"])
+    cpu_per_request = None
+    if cpu_before is not None and completed:
+        cpu_per_request = (cpu_after - cpu_before) / completed * 1000
+    return {
+        "mode": "stream" if stream else "nonstream",
+        "concurrency": concurrency,
+        "requests": completed,
+        "errors": samples["errors"],
+        "throughput_rps": completed / elapsed,
+        "ttft_ms": percentiles_ms(samples["ttft"]),
+        "latency_ms": percentiles_ms(samples["latency"]),
+        "cpu_ms_per_request": cpu_per_request,
+        "rss_mb": (max(peak_rss, rss_after or 0) / 1024 / 1024) if rss_after is not None else None,
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def format_ms(value) -> str:
+    return f"{value:8.1f}" if value is not None else "     n/a"
+
+
+def print_result(result: dict, previous: dict = None):
+    line = (f"  {result['mode']:<9} c={result['concurrency']:<4} {result['throughput_rps']:>8.1f} req/s  "
+            f"ttft p50/p95/p99 {format_ms(result['ttft_ms']['p50'])}{format_ms(result['ttft_ms']['p95'])}"
+            f"{format_ms(result['ttft_ms']['p99'])} ms  cpu {format_ms(result['cpu_ms_per_request'])} ms/req  "
+            f"rss {format_ms(result['rss_mb'])} MB  errors {result['errors']}")
+    if previous:
+        line += f"  (throughput x{result['throughput_rps'] / max(previous['throughput_rps'], 1e-9):.2f}"
+        if result["cpu_ms_per_request"] and previous.get("cpu_ms_per_request"):
+            line += f", cpu x{result['cpu_ms_per_request'] / previous['cpu_ms_per_request']:.2f}"
+        line += ")"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load benchmark against a local fake Poe upstream")
+    parser.add_argument("--concurrency", default="1,8,32,64", help="逗号分隔的并发级别")
+    parser.add_argument("--modes", default="stream,nonstream", help="stream、nonstream 或两者")
+    parser.add_argument("--duration", type=float, default=10, help="每个级别的压测时长（秒）")
+    parser.add_argument("--workers", type=int, default=1, help="代理的 WORKERS")
+    parser.add_argument("--keys", type=int, default=4, help="模拟的 Poe 密钥数量")
+    parser.add_argument("--output", default="bench_load.json", help="结果 JSON 文件路径")
+    parser.add_argument("--compare", help="与之前保存的结果 JSON 对比")
+    parser.add_argument("--proxy-port", type=int, default=3711)
+    parser.add_argument("--fake-port", type=int, default=8791)
+    parser.add_argument("--fake-workers", type=int, default=1)
+    args, fake_args = parser.parse_known_args()
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = {(item["mode"], item["concurrency"]): item for item in json.load(f)["results"]}
+
+    fake = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, "fake_poe.py"), "--port", str(args.fake_port),
+                             "--workers", str(args.fake_workers)] + fake_args)
+    env = dict(
+        os.environ,
+        WORKERS=str(args.workers),
+        PORT=str(args.proxy_port),
+        POE_BASE_URL=f"http://127.0.0.1:{args.fake_port}/bot/",
+        POE_API_KEYS=json.dumps([f"fake-key-{i}" for i in range(args.keys)]),
+        ACCESS_TOKENS=json.dumps([ACCESS_TOKEN]),
+        BOT_NAMES=json.dumps(["GPT-4o"]),
+        LOG_LEVEL="WARNING",
+    )
+    proxy = None
+    results = []
+    try:
+        wait_until_ready(f"http://127.0.0.1:{args.fake_port}/docs")
+        proxy = subprocess.Popen([sys.executable, os.path.join(ROOT_DIR, "app.py")], env=env, cwd=ROOT_DIR)
+        wait_until_ready(f"http://127.0.0.1:{args.proxy_port}/v1/models")
+        url = f"http://127.0.0.1:{args.proxy_port}/v1/chat/completions"
+        print(f"commit {git_commit()}, workers={args.workers}, fake upstream args: {' '.join(fake_args) or '(defaults)'}")
+        for mode in args.modes.split(","):
+            for concurrency in (int(value) for value in args.concurrency.split(",")):
+                result = asyncio.run(run_level(url, mode == "stream", concurrency, args.duration, proxy.pid))
+                results.append(result)
+                print_result(result, previous.get((result["mode"], concurrency)))
+    finally:
+        if proxy is not None:
+            stop_process(proxy)
+        stop_process(fake)
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "cpu_count": os.cpu_count(),
+        "args": vars(args),
+        "fake_args": fake_args,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""请求解析的微基准：在合成的长对话历史上对比逐条构造 ProtocolMessage 与复用缓存的解析开销
+
+模拟智能体类客户端的多轮对话：每一轮在上一轮的历史末尾追加一问一答后重发完整历史。
+"old" 为原来的 json.loads + CompletionRequest 校验 + 逐条构造 ProtocolMessage，
+"new" 为 loads_json + CompletionRequest 校验 + to_protocol_messages（按内容复用 ProtocolMessage）。
+两者产生的请求与 ProtocolMessage 列表逐项比较，无效请求体的错误信息也必须一致。
+
+用法：python benchmarks/bench_request_parsing.py [--messages 150] [--chars 600] [--turns 50]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from fastapi_poe.types import ProtocolMessage  # noqa: E402
+from pydantic import ValidationError  # noqa: E402
+
+from app import CompletionRequest, ProtocolMessageCache, loads_json, protocol_message_cache  # noqa: E402
+
+ROLES = ("user", "assistant", "tool")
+INVALID_BODIES = (
+    b"",
+    b"{not json",
+    b'{"model": "GPT-4o", "messages": []}',
+    b'{"model": "GPT-4o", "messages": [{"role": "robot", "content": "hi"}]}',
+    b'{"model": "GPT-4o", "messages": [{"role": "user", "content": 1}], "temperature": 3}',
+    b'{"messages": [{"role": "user", "content": "hi"}], "n": 0}',
+)
+
+
+def make_history(count: int, chars: int):
+    messages = [{"role": "system", "content": "You are a coding agent. " * 10}]
+    for index in range(count):
+        role = ROLES[index % len(ROLES)]
+        text = f"message {index}: " + "lorem ipsum dolor sit amet " * (chars // 27)
+        message = {"role": role, "content": text}
+        if role == "tool":
+            message["tool_call_id"] = f"call_{index}"
+        messages.append(message)
+    return messages
+
+
+def make_bodies(messages, turns: int):
+    # 每一轮追加一问一答，之前的历史原样重发
+    bodies = []
+    history = list(messages)
+    for turn in range(turns):
+        history = history + [{"role": "assistant", "content": f"answer {turn} " * 40},
+                             {"role": "user", "content": f"follow-up question {turn}"}]
+        bodies.append(json.dumps({"model": "GPT-4o", "messages": history, "stream": True,
+                                  "temperature": 0.2}).encode())
+    return bodies
+
+
+def old_parse(body: bytes):
+    request = CompletionRequest(**json.loads(body))
+    return request, [
+        ProtocolMessage(role=msg.role if msg.role in ["user", "system"] else "bot", content=msg.get_content_text())
+        for msg in request.messages
+    ]
+
+
+def new_parse(body: bytes):
+    request = CompletionRequest(**loads_json(body))
+    return request, protocol_message_cache.convert(request.messages)
+
+
+def outcome(parse, body: bytes) -> str:
+    try:
+        parse(body)
+    except (json.JSONDecodeError, ValidationError) as e:
+        return f"{type(e).__name__}: {str(e)}"
+    return "ok"
+
+
+def measure(parse, bodies, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        protocol_message_cache.clear()
+        started = time.process_time()
+        for body in bodies:
+            parse(body)
+        best = min(best, time.process_time() - started)
+    return best / len(bodies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=150, help="首轮历史消息数")
+    parser.add_argument("--chars", type=int, default=600, help="每条消息的字符数")
+    parser.add_argument("--turns", type=int, default=50, help="对话轮数")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    bodies = make_bodies(make_history(args.messages, args.chars), args.turns)
+    for body in bodies[:3] + bodies[-1:]:
+        old_request, old_messages = old_parse(body)
+        new_request, new_messages = new_parse(body)
+        assert old_request == new_request
+        assert [m.model_dump() for m in old_messages] == [m.model_dump() for m in new_messages]
+    for body in INVALID_BODIES:
+        assert outcome(old_parse, body) == outcome(new_parse, body), body
+
+    old_time = measure(old_parse, bodies, args.repeat)
+    new_time = measure(new_parse, bodies, args.repeat)
+    cold = ProtocolMessageCache(0, 0)
+    cold_time = measure(lambda body: cold.convert(CompletionRequest(**loads_json(body)).messages), bodies, args.repeat)
+    size = sum(len(body) for body in bodies) / len(bodies)
+    print(f"{args.turns} turns, {args.messages}+ messages x {args.chars} chars (avg body {size / 1024:.0f} KB)")
+    for name, cpu in (("old per-message build", old_time), ("new without reuse", cold_time),
+                      ("new with reuse", new_time)):
+        print(f"  {name:<22} {cpu * 1e6:9.1f} us/request CPU   x{old_time / cpu:.2f}")
+
+
+if __name__ == "__main__":
+    main()
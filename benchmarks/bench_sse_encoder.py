@@ -0,0 +1,98 @@
+"""SSE 分块编码的微基准：对比逐块构造字典 + json.dumps 与预渲染模板编码器的吞吐量
+
+用法：python benchmarks/bench_sse_encoder.py [--chunks 20000]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+
+
+def make_deltas(count: int):
+    random.seed(0)
+    pieces = ["Hello", " world", "，你好", "世界", " `code`", "\n", " \"quoted\"", " 123", "。"]
+    return ["".join(random.choice(pieces) for _ in range(random.randint(1, 4))) for _ in range(count)]
+
+
+def old_encode(deltas, request_id="chatcmpl-bench", created=0, model="GPT-4o"):
+    # 旧实现：每个分块重新构造完整字典，用 json.dumps 序列化后再由 StreamingResponse 编码为 UTF-8
+    for delta in deltas:
+        chunk = {
+            "id": request_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "system_fingerprint": f"fp_{request_id}",
+            "choices": [{
+                "delta": {
+                    "content": delta
+                },
+                "index": 0,
+                "finish_reason": None
+            }]
+        }
+        f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+
+
+def new_encode(deltas, request_id="chatcmpl-bench", created=0, model="GPT-4o"):
+    encoder = app.SSEChunkEncoder(request_id, created, model)
+    for delta in deltas:
+        encoder.content(delta)
+
+
+def stdlib_dumps(obj) -> bytes:
+    if isinstance(obj, str):
+        return json.encoder.encode_basestring_ascii(obj).encode()
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+
+def measure(func, deltas, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.process_time()
+        func(deltas)
+        best = min(best, time.process_time() - started)
+    return len(deltas) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chunks", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    deltas = make_deltas(args.chunks)
+    # 两种实现解析后的内容必须一致
+    encoder = app.SSEChunkEncoder("chatcmpl-bench", 0, "GPT-4o")
+    for delta in deltas[:100]:
+        assert json.loads(encoder.content(delta)[6:]) == json.loads(json.dumps({
+            "id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": 0, "model": "GPT-4o",
+            "system_fingerprint": "fp_chatcmpl-bench",
+            "choices": [{"delta": {"content": delta}, "index": 0, "finish_reason": None}]
+        }))
+
+    results = [("dict + json.dumps (old)", measure(old_encode, deltas, args.repeat))]
+    original_dumps = app.dumps_json
+    try:
+        app.dumps_json = stdlib_dumps
+        results.append(("template + stdlib", measure(new_encode, deltas, args.repeat)))
+    finally:
+        app.dumps_json = original_dumps
+    if app.orjson is not None:
+        results.append(("template + orjson", measure(new_encode, deltas, args.repeat)))
+    else:
+        print("orjson is not installed, skipping the orjson variant")
+
+    baseline = results[0][1]
+    for name, rate in results:
+        print(f"  {name:<26} {rate:>12,.0f} chunks/s   x{rate / baseline:.2f}")
+
+
+if __name__ == "__main__":
+    main()
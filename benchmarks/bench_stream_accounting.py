@@ -0,0 +1,74 @@
+"""流式响应累积与用量统计的微基准：对比旧的字符串拼接 + 整体分词与新的逐块增量计数
+
+使用 TOKENIZER 配置的分词器；超过 TOKEN_CARRY_MAX 个字符仍无空白的片段会被强制结算，
+此时增量计数与整体计数可能有极小的差异。
+
+用法：python benchmarks/bench_stream_accounting.py [--chunks 4000] [--chunk-size 100]
+"""
+import argparse
+import os
+import random
+import string
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app import IncrementalTokenCounter, count_tokens, get_tokenizer  # noqa: E402
+
+
+def make_chunks(count: int, size: int):
+    random.seed(0)
+    alphabet = string.ascii_letters + "     \n"
+    return ["".join(random.choice(alphabet) for _ in range(size)) for _ in range(count)]
+
+
+def old_accounting(chunks):
+    # 旧实现：每块都拼接到完整字符串上，结束时再对全文分词
+    total_response = ""
+    for chunk in chunks:
+        total_response += chunk
+    return count_tokens(total_response)
+
+
+def new_accounting(chunks):
+    counter = IncrementalTokenCounter()
+    for chunk in chunks:
+        counter.feed(chunk)
+    return counter.tokens
+
+
+def measure(func, chunks, repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.process_time()
+        result = func(chunks)
+        best = min(best, time.process_time() - started)
+    tracemalloc.start()
+    func(chunks)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chunks", type=int, default=4000)
+    parser.add_argument("--chunk-size", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    chunks = make_chunks(args.chunks, args.chunk_size)
+    old_tokens, old_time, old_peak = measure(old_accounting, chunks, args.repeat)
+    new_tokens, new_time, new_peak = measure(new_accounting, chunks, args.repeat)
+    assert abs(old_tokens - new_tokens) <= old_tokens / 1000, (old_tokens, new_tokens)
+
+    print(f"{args.chunks} chunks x {args.chunk_size} chars ({args.chunks * args.chunk_size / 1024:.0f} KB), "
+          f"{get_tokenizer().name} tokenizer, {new_tokens} tokens (whole-text count {old_tokens})")
+    for name, cpu, peak in (("old concat + split", old_time, old_peak), ("incremental counter", new_time, new_peak)):
+        print(f"  {name:<20} {cpu / args.chunks * 1e6:8.3f} us/chunk CPU   peak memory {peak / 1024:8.1f} KB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""多进程模式的扩展性压测：在本地模拟的 Poe 接口上，分别以不同 WORKERS 启动代理并测量吞吐量
+
+每一轮都会重新启动代理进程，压测客户端分布在多个进程中，避免客户端自身成为瓶颈。
+吞吐量能否随进程数近似线性增长取决于可用 CPU 核数，单核机器上各轮结果应基本持平。
+
+用法：python benchmarks/bench_workers.py [--workers 1,2,4] [--concurrency 64] [--duration 10] [--stream]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.join(BENCH_DIR, "..")
+ACCESS_TOKEN = "bench-token"
+
+
+def wait_until_ready(url: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not become ready within {timeout}s")
+
+
+def stop_process(process: subprocess.Popen):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+async def drive(url: str, concurrency: int, duration: float, stream: bool):
+    body = {"model": "GPT-4o", "stream": stream, "messages": [{"role": "user", "content": "benchmark"}]}
+    headers = {"Authorization": f"Bearer {ACCESS_TOKEN}"}
+    deadline = time.monotonic() + duration
+    completed = 0
+    errors = 0
+
+    async def worker(client: httpx.AsyncClient):
+        nonlocal completed, errors
+        while time.monotonic() < deadline:
+            try:
+                async with client.stream("POST", url, json=body, headers=headers) as response:
+                    async for _ in response.aiter_raw():
+                        pass
+                if response.status_code == 200:
+                    completed += 1
+                else:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=60, limits=limits) as client:
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+    return completed, errors
+
+
+def client_process(args):
+    return asyncio.run(drive(*args))
+
+
+def run_round(args, workers: int) -> dict:
+    env = dict(
+        os.environ,
+        WORKERS=str(workers),
+        PORT=str(args.proxy_port),
+        POE_BASE_URL=f"http://127.0.0.1:{args.fake_port}/bot/",
+        POE_API_KEYS=json.dumps([f"fake-key-{i}" for i in range(args.keys)]),
+        ACCESS_TOKENS=json.dumps([ACCESS_TOKEN]),
+        BOT_NAMES=json.dumps(["GPT-4o"]),
+        LOG_LEVEL="WARNING",
+        KEY_MAX_CONCURRENCY="0",
+        TOKEN_RATE_LIMIT="0",
+        TOKEN_MAX_CONCURRENCY="0",
+    )
+    proxy = subprocess.Popen([sys.executable, os.path.join(ROOT_DIR, "app.py")], env=env, cwd=ROOT_DIR)
+    try:
+        wait_until_ready(f"http://127.0.0.1:{args.proxy_port}/v1/models")
+        url = f"http://127.0.0.1:{args.proxy_port}/v1/chat/completions"
+        per_client = max(1, args.concurrency // args.clients)
+        started = time.monotonic()
+        with multiprocessing.get_context("spawn").Pool(args.clients) as pool:
+            results = pool.map(client_process, [(url, per_client, args.duration, args.stream)] * args.clients)
+        elapsed = time.monotonic() - started
+    finally:
+        stop_process(proxy)
+    completed = sum(result[0] for result in results)
+    errors = sum(result[1] for result in results)
+    return {"workers": workers, "requests": completed, "errors": errors, "rps": completed / elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure throughput scaling with WORKERS")
+    parser.add_argument("--workers", default="1,2,4", help="逗号分隔的工作进程数列表")
+    parser.add_argument("--concurrency", type=int, default=64, help="总并发请求数")
+    parser.add_argument("--duration", type=float, default=10, help="每轮压测时长（秒）")
+    parser.add_argument("--clients", type=int, default=max(1, (os.cpu_count() or 2) // 2), help="压测客户端进程数")
+    parser.add_argument("--keys", type=int, default=4, help="模拟的 Poe 密钥数量")
+    parser.add_argument("--stream", action="store_true", help="使用流式请求")
+    parser.add_argument("--proxy-port", type=int, default=3710)
+    parser.add_argument("--fake-port", type=int, default=8790)
+    parser.add_argument("--fake-workers", type=int, default=2, help="模拟 Poe 服务的进程数")
+    args = parser.parse_args()
+
+    fake = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, "fake_poe.py"), "--port", str(args.fake_port),
+                             "--workers", str(args.fake_workers)])
+    try:
+        wait_until_ready(f"http://127.0.0.1:{args.fake_port}/docs")
+        print(f"cpu count: {os.cpu_count()}, concurrency: {args.concurrency}, stream: {args.stream}")
+        results = []
+        for workers in (int(value) for value in args.workers.split(",")):
+            result = run_round(args, workers)
+            results.append(result)
+            baseline = results[0]["rps"] or 1
+            print(f"  workers={workers:<3} {result['rps']:>9.1f} req/s   x{result['rps'] / baseline:.2f}   "
+                  f"({result['requests']} ok, {result['errors']} errors)")
+    finally:
+        stop_process(fake)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""本地模拟的 Poe 机器人接口，用于在不消耗 Poe 积分的情况下压测代理本身的开销
+
+实现 fastapi_poe 客户端使用的 SSE 协议（meta / text / error / done 事件），任意密钥与机器人名称均可访问；
+收到密钥验证用的 "Please return 'OK'" 请求时总是立即返回 OK。可以模拟：
+- 首字延迟（--ttft）与输出速率（--rate，每秒单词数）、每个文本事件包含的单词数（--chunk-size）
+- 首字前的 "Thinking..." 状态帧及 "Thinking... (Ns elapsed)" 计时帧（--status-frames）
+- 按概率注入错误（--error-rate / --error-type），--error-after 控制在第几个单词后出错，0 表示首字节前
+另外提供文件上传接口（以 POE_UPLOAD_URL=http://127.0.0.1:8790/ 启动代理），返回按内容哈希生成的附件 URL。
+
+用法：
+    python benchmarks/fake_poe.py [--port 8790] [--words 50] [--ttft 0] [--rate 0] [--chunk-size 1]
+                                  [--status-frames] [--error-rate 0] [--error-type bot_error] [--workers 1]
+    然后以 POE_BASE_URL=http://127.0.0.1:8790/bot/ 启动代理
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import mimetypes
+import os
+import random
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+VALIDATION_PROMPT = "Please return 'OK'"
+ERROR_TYPES = ("bot_error", "no_retry", "rate_limit", "http_500", "disconnect")
+
+# 参数通过环境变量传递，便于 uvicorn 以多进程方式加载
+OPTIONS = {
+    "words": ("FAKE_POE_WORDS", int, 50),
+    "ttft": ("FAKE_POE_TTFT", float, 0.0),
+    "rate": ("FAKE_POE_RATE", float, 0.0),
+    "chunk_size": ("FAKE_POE_CHUNK_SIZE", int, 1),
+    "status_frames": ("FAKE_POE_STATUS_FRAMES", int, 0),
+    "status_interval": ("FAKE_POE_STATUS_INTERVAL", float, 1.0),
+    "error_rate": ("FAKE_POE_ERROR_RATE", float, 0.0),
+    "error_type": ("FAKE_POE_ERROR_TYPE", str, "bot_error"),
+    "error_after": ("FAKE_POE_ERROR_AFTER", int, 0),
+}
+
+
+def load_options() -> dict:
+    return {name: cast(os.getenv(env, default)) for name, (env, cast, default) in OPTIONS.items()}
+
+
+def sse_event(event: str, data: dict) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode()
+
+
+def error_event(error_type: str) -> bytes:
+    if error_type == "no_retry":
+        return sse_event("error", {"text": "Injected non-retryable error", "allow_retry": False})
+    if error_type == "rate_limit":
+        return sse_event("error", {"text": "Injected rate limit exceeded", "allow_retry": False})
+    return sse_event("error", {"text": "Injected bot error", "allow_retry": True})
+
+
+class InjectedDisconnect(Exception):
+    """中断响应体以模拟上游连接意外断开"""
+
+
+def create_app() -> FastAPI:
+    options = load_options()
+    if options["error_type"] not in ERROR_TYPES:
+        raise ValueError(f"error type must be one of {ERROR_TYPES}")
+    app = FastAPI()
+
+    async def think(until: float):
+        # 首字之前按间隔发送状态帧，模拟 Poe 推理类机器人的输出
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        yield sse_event("text", {"text": "Thinking..."})
+        while True:
+            remaining = until - loop.time()
+            if remaining <= 0:
+                return
+            await asyncio.sleep(min(options["status_interval"], remaining))
+            elapsed = int(loop.time() - started)
+            if elapsed > 0:
+                yield sse_event("text", {"text": f"Thinking... ({elapsed}s elapsed)"})
+
+    async def answer(fail: bool):
+        loop = asyncio.get_running_loop()
+        yield sse_event("meta", {"content_type": "text/markdown", "linkify": True, "suggested_replies": False})
+        if fail and options["error_after"] <= 0 and options["error_type"] != "disconnect":
+            yield error_event(options["error_type"])
+            return
+        if options["ttft"] > 0:
+            if options["status_frames"]:
+                async for frame in think(loop.time() + options["ttft"]):
+                    yield frame
+            else:
+                await asyncio.sleep(options["ttft"])
+        chunk_size = max(1, options["chunk_size"])
+        interval = chunk_size / options["rate"] if options["rate"] > 0 else 0
+        for start in range(0, options["words"], chunk_size):
+            if fail and start >= options["error_after"]:
+                if options["error_type"] == "disconnect":
+                    raise InjectedDisconnect()
+                yield error_event(options["error_type"])
+                return
+            if interval and start:
+                await asyncio.sleep(interval)
+            text = "".join(f"word{index} " for index in range(start, min(start + chunk_size, options["words"])))
+            yield sse_event("text", {"text": text})
+        yield sse_event("done", {})
+
+    @app.post("/bot/{bot_name}")
+    async def bot(bot_name: str, request: Request):
+        body = await request.json()
+        if body.get("type") != "query":
+            # report_error / report_feedback 等上报请求直接确认
+            return JSONResponse({})
+        messages = body.get("query") or []
+        prompt = messages[-1].get("content", "") if messages else ""
+        if prompt == VALIDATION_PROMPT:
+            frames = [sse_event("meta", {"content_type": "text/markdown"}),
+                      sse_event("text", {"text": "OK"}), sse_event("done", {})]
+            return StreamingResponse(iter(frames), media_type="text/event-stream")
+        fail = random.random() < options["error_rate"]
+        if fail and options["error_type"] == "http_500" and options["error_after"] <= 0:
+            return JSONResponse({"error": "Injected server error"}, status_code=500)
+        return StreamingResponse(answer(fail), media_type="text/event-stream")
+
+    @app.post("/file_upload_3RD_PARTY_POST")
+    async def upload(request: Request):
+        form = await request.form()
+        if "download_url" in form:
+            name = form.get("download_filename") or form["download_url"].rsplit("/", 1)[-1]
+            digest = hashlib.sha256(form["download_url"].encode()).hexdigest()
+        else:
+            file = form["file"]
+            name = file.filename
+            digest = hashlib.sha256(await file.read()).hexdigest()
+        return JSONResponse({"attachment_url": f"https://fake-poe.local/attachments/{digest}/{name}",
+                             "mime_type": mimetypes.guess_type(name)[0] or "application/octet-stream"})
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Poe bot server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8790)
+    parser.add_argument("--words", type=int, default=50, help="每个回复包含的单词数")
+    parser.add_argument("--ttft", type=float, default=0.0, help="首个文本事件之前的延迟（秒）")
+    parser.add_argument("--rate", type=float, default=0.0, help="输出速率（单词/秒），0 表示不限速")
+    parser.add_argument("--chunk-size", type=int, default=1, help="每个文本事件包含的单词数")
+    parser.add_argument("--status-frames", action="store_true", help="首字前发送 Thinking... 与计时状态帧")
+    parser.add_argument("--status-interval", type=float, default=1.0, help="状态帧间隔（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="注入错误的请求比例（0~1）")
+    parser.add_argument("--error-type", choices=ERROR_TYPES, default="bot_error")
+    parser.add_argument("--error-after", type=int, default=0, help="在输出多少个单词后出错，0 表示首字节前")
+    parser.add_argument("--workers", type=int, default=1, help="模拟服务自身的进程数，避免其成为压测瓶颈")
+    args = parser.parse_args()
+    for name, (env, _, _) in OPTIONS.items():
+        value = getattr(args, name)
+        os.environ[env] = str(int(value) if isinstance(value, bool) else value)
+    uvicorn.run("fake_poe:create_app", factory=True, host=args.host, port=args.port, workers=args.workers,
+                app_dir=os.path.dirname(os.path.abspath(__file__)), log_level="warning")
+
+
+if __name__ == "__main__":
+    main()